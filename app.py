@@ -1,5 +1,6 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import firebase_admin
 from firebase_admin import credentials, db
 from datetime import datetime, date, timedelta
@@ -7,13 +8,17 @@ import plotly.express as px
 from geopy.geocoders import Nominatim
 import time
 import io
-from docx import Document
-from docx.shared import Pt, Inches, RGBColor
-from docx.enum.text import WD_ALIGN_PARAGRAPH
+import os
+import gzip
+import base64
+import hashlib
+import json
+import atexit
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dateutil.relativedelta import relativedelta
-import locale
 from collections import Counter, defaultdict
-import geopandas as gpd
 from streamlit_calendar import calendar
 import pydeck as pdk
 import calendar as cal_mod
@@ -24,6 +29,13 @@ from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph,
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.enums import TA_CENTER, TA_LEFT
 import streamlit.components.v1 as components  
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+import geodados
+import ausencias
+import relatorios
+import visitas
+import produtividade
+import calendario
 
 # --- INTERFACE PRINCIPAL ---
 st.set_page_config(layout="wide", page_title="Sistema Vigilância em Saúde", page_icon="logo.png")
@@ -439,238 +451,1009 @@ def formatar_nome(nome_completo):
     return partes[0] if partes else ""
 
 def log_atividade(usuario, acao, detalhes=""):
+    # Só enfileira: a gravação no Firebase é feita em lote pelo gravador de logs.
     try:
-        ref = db.reference('logs_de_atividade')
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        log_id = str(int(time.time() * 1000))
-        ref.child(log_id).set({
+        gravador = _gravador_logs()
+        with gravador['lock_id']:
+            # Chave em milissegundos, estritamente crescente no processo.
+            log_id = max(int(time.time() * 1000), gravador['ultimo_id'] + 1)
+            gravador['ultimo_id'] = log_id
+        gravador['fila'].put((str(log_id), {
             "usuario": usuario,
             "acao": acao,
             "detalhes": detalhes,
             "timestamp": timestamp
-        })
+        }))
     except Exception as e:
         st.error(f"Erro ao registrar log de atividade: {e}")
 
 
-@st.cache_data
-def carregar_dados_firebase(node):
+# --- ESPELHO LOCAL DO FIREBASE (SINCRONIZAÇÃO INCREMENTAL) ---
+# Cada nó lido por carregar_dados_firebase tem uma cópia local no processo. Depois da
+# primeira leitura completa, só os filhos com 'updated_at' >= marca d'água são baixados
+# (order_by_child + start_at) e as remoções chegam pelas lápides em '_remocoes/{node}'.
+# As consultas exigem ".indexOn": "updated_at" nos nós e ".indexOn": ".value" em
+# '_remocoes/{node}' nas regras do banco; sem o índice, cai na leitura completa.
+#
+# Cada escrita também incrementa '_versoes/{node}' na mesma operação multi-caminho.
+# O cache de carregar_dados_firebase é indexado por (nó, versão), então uma escrita
+# invalida apenas os nós que tocou, para todos os usuários.
+#
+# Os nós de NOS_AO_VIVO ficam com um ouvinte (db.reference(...).listen()) aberto no
+# processo: o Firebase empurra cada alteração para o espelho compartilhado, que todas as
+# sessões leem sem consultar o banco. A versão desses nós passa a ser a revisão local do
+# espelho, então a escrita de um usuário aparece para os demais assim que o evento chega.
+# Cada evento só altera o dicionário e anota as chaves tocadas; o DataFrame é refeito
+# com elas na próxima leitura, então uma rajada de eventos custa uma reconstrução.
+# Se o ouvinte não abrir ou cair, o nó volta para a sincronização por consulta acima.
+MARGEM_MARCA_DAGUA_MS = 5000
+CARIMBO_SERVIDOR = {'.sv': 'timestamp'}
+INCREMENTO_VERSAO = {'.sv': {'increment': 1}}
+NOS_AO_VIVO = {
+    'funcionarios', 'folgas_ferias', 'boletins', 'avisos', 'denuncias',
+    'estoque_produtos', 'estoque_entregas', 'pe_ie_cadastros', 'boletins_pe_ie',
+}
+ESPERA_OUVINTE_S = 10
+INTERVALO_REABRIR_OUVINTE_S = 60
+
+# As operações devolvem os caminhos de uma escrita multi-caminho; gravar_em_lote junta
+# várias numa única requisição, que o Firebase aplica por inteiro ou não aplica.
+# Um lote não pode conter um caminho e um descendente dele (p.ex. gravar e atualizar
+# o mesmo registro).
+def operacao_gravar(node, chave, dados):
+    dados = dict(dados)
+    dados['updated_at'] = CARIMBO_SERVIDOR
+    return {
+        f'{node}/{chave}': dados,
+        f'_versoes/{node}': INCREMENTO_VERSAO
+    }
+
+def operacao_atualizar(node, chave, dados):
+    caminhos = {f'{node}/{chave}/{campo}': valor for campo, valor in dados.items()}
+    caminhos[f'{node}/{chave}/updated_at'] = CARIMBO_SERVIDOR
+    caminhos[f'_versoes/{node}'] = INCREMENTO_VERSAO
+    return caminhos
+
+def operacao_remover(node, chave):
+    # Remove o registro e grava a lápide na mesma escrita.
+    return {
+        f'{node}/{chave}': None,
+        f'_remocoes/{node}/{chave}': CARIMBO_SERVIDOR,
+        f'_versoes/{node}': INCREMENTO_VERSAO
+    }
+
+def incremento(valor):
+    # Soma no servidor, sem ler o valor atual (evita perder escritas concorrentes).
+    return {'.sv': {'increment': valor}}
+
+def gravar_em_lote(*operacoes):
+    caminhos = {}
+    for operacao in operacoes:
+        caminhos.update(operacao)
+    if caminhos:
+        db.reference('/').update(caminhos)
+        # A escrita confirmada já vai para os espelhos ao vivo, para que o rerun de quem
+        # gravou a veja sem esperar o eco do ouvinte (que depois traz os valores do servidor).
+        aplicar_escrita_nos_espelhos(caminhos)
+
+def gravar_registro(node, chave, dados):
+    gravar_em_lote(operacao_gravar(node, chave, dados))
+
+def atualizar_registro(node, chave, dados):
+    gravar_em_lote(operacao_atualizar(node, chave, dados))
+
+def remover_registro(node, chave):
+    gravar_em_lote(operacao_remover(node, chave))
+
+# --- GRAVADOR DE LOGS EM SEGUNDO PLANO ---
+# Uma thread do processo esvazia a fila de log_atividade a cada LOG_INTERVALO_S ou a
+# cada LOG_LOTE_MAXIMO entradas, numa única escrita multi-caminho. Se o Firebase não
+# responder, o lote vai para ARQUIVO_LOGS_PENDENTES e é reenviado junto com o próximo.
+# No encerramento normal do processo a fila é descarregada antes de sair.
+LOG_INTERVALO_S = 0.3
+LOG_LOTE_MAXIMO = 100
+ARQUIVO_LOGS_PENDENTES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs_pendentes.jsonl')
+
+def _enviar_logs(entradas):
+    gravar_em_lote(*[operacao_gravar(particao_log(dados['timestamp']), log_id, dados) for log_id, dados in entradas])
+
+def _ler_logs_pendentes():
+    try:
+        with open(ARQUIVO_LOGS_PENDENTES, encoding='utf-8') as f:
+            return [(e['id'], e['dados']) for e in (json.loads(linha) for linha in f if linha.strip())]
+    except FileNotFoundError:
+        return []
+
+def _guardar_logs_pendentes(entradas):
+    with open(ARQUIVO_LOGS_PENDENTES, 'a', encoding='utf-8') as f:
+        for log_id, dados in entradas:
+            f.write(json.dumps({'id': log_id, 'dados': dados}, ensure_ascii=False) + '\n')
+
+def _descarregar_logs(gravador, entradas):
+    with gravador['lock_envio']:
+        pendentes = _ler_logs_pendentes()
+        if not pendentes and not entradas:
+            return
+        try:
+            _enviar_logs(pendentes + entradas)
+        except Exception:
+            _guardar_logs_pendentes(entradas)
+            return
+        if pendentes:
+            os.remove(ARQUIVO_LOGS_PENDENTES)
+
+def _trabalhador_logs(gravador):
+    fila = gravador['fila']
+    _descarregar_logs(gravador, [])  # reenvia o que sobrou de uma execução anterior
+    while True:
+        entrada = fila.get()
+        if entrada is None:
+            return
+        entradas = [entrada]
+        limite = time.monotonic() + LOG_INTERVALO_S
+        encerrar = False
+        while len(entradas) < LOG_LOTE_MAXIMO:
+            restante = limite - time.monotonic()
+            if restante <= 0:
+                break
+            try:
+                entrada = fila.get(timeout=restante)
+            except queue.Empty:
+                break
+            if entrada is None:
+                encerrar = True
+                break
+            entradas.append(entrada)
+        _descarregar_logs(gravador, entradas)
+        if encerrar:
+            return
+
+def _encerrar_gravador_logs(gravador):
+    gravador['fila'].put(None)
+    gravador['thread'].join(timeout=10)
+    restantes = []
+    while True:
+        try:
+            entrada = gravador['fila'].get_nowait()
+        except queue.Empty:
+            break
+        if entrada is not None:
+            restantes.append(entrada)
+    _descarregar_logs(gravador, restantes)
+
+@st.cache_resource
+def _gravador_logs():
+    gravador = {'fila': queue.Queue(), 'lock_envio': threading.Lock(), 'lock_id': threading.Lock(), 'ultimo_id': 0}
+    gravador['thread'] = threading.Thread(target=_trabalhador_logs, args=(gravador,), name='gravador-logs', daemon=True)
+    gravador['thread'].start()
+    atexit.register(_encerrar_gravador_logs, gravador)
+    return gravador
+
+# --- LOGS PARTICIONADOS POR MÊS E ARQUIVAMENTO ---
+# Os logs ficam em 'logs_de_atividade/{AAAA}/{MM}/{id}', e cada mês é um nó com versão
+# e espelho próprios: a página de logs lê só os meses da janela escolhida. Meses com
+# mais de LOG_MESES_ONLINE podem ser arquivados pelo administrador. O mês vira um
+# .jsonl.gz em base64 guardado no próprio banco, em 'logs_arquivo/{AAAA-MM}' (o disco do
+# servidor é apagado a cada reinício), e as contagens por dia/usuário/ação vão para
+# 'logs_resumo/{AAAA-MM}'. Só depois de o arquivo ser relido e conferido é que os
+# registros daquela leitura saem da partição; o que chegar depois continua nela, é
+# mostrado junto com o arquivo e entra no próximo arquivamento do mês.
+LOG_RAIZ = 'logs_de_atividade'
+LOG_ARQUIVO_RAIZ = 'logs_arquivo'
+LOG_MESES_ONLINE = 6
+LOG_LOTE_MIGRACAO = 500
+# Strings do Realtime Database têm limite de 10 MB; o arquivo é repartido bem abaixo disso.
+LOG_TAMANHO_PARTE_ARQUIVO = 4 * 1024 * 1024
+
+def particao_log_mes(ano, mes):
+    return f'{LOG_RAIZ}/{ano:04d}/{mes:02d}'
+
+def particao_log(timestamp):
+    # timestamp no formato "%Y-%m-%d %H:%M:%S"
+    return particao_log_mes(int(timestamp[:4]), int(timestamp[5:7]))
+
+def meses_no_intervalo(inicio, fim):
+    meses = []
+    ano, mes = inicio.year, inicio.month
+    while (ano, mes) <= (fim.year, fim.month):
+        meses.append((ano, mes))
+        ano, mes = (ano + 1, 1) if mes == 12 else (ano, mes + 1)
+    return meses
+
+def _referencia_mes(ano, mes):
+    return f'{ano:04d}-{mes:02d}'
+
+def _codificar_arquivo_logs(registros):
+    linhas = ''.join(
+        json.dumps({'id': log_id, **dados}, ensure_ascii=False) + '\n'
+        for log_id, dados in sorted(registros.items()) if isinstance(dados, dict)
+    )
+    blob = base64.b64encode(gzip.compress(linhas.encode('utf-8'))).decode('ascii')
+    return [blob[i:i + LOG_TAMANHO_PARTE_ARQUIVO] for i in range(0, len(blob), LOG_TAMANHO_PARTE_ARQUIVO)]
+
+def _decodificar_arquivo_logs(arquivo):
+    partes = (arquivo or {}).get('partes') or []
+    if not partes:
+        return {}
+    texto = gzip.decompress(base64.b64decode(''.join(partes))).decode('utf-8')
+    registros = {}
+    for linha in texto.splitlines():
+        if linha.strip():
+            dados = json.loads(linha)
+            registros[str(dados.pop('id'))] = dados
+    return registros
+
+def _assinatura_arquivo_logs(partes):
+    return hashlib.sha256(''.join(partes).encode('ascii')).hexdigest()
+
+def migrar_logs_legados():
+    # Move os logs gravados direto em 'logs_de_atividade/{id}' para as partições mensais.
+    # A leitura rasa traz só as chaves; anos têm 4 dígitos, ids legados têm 13.
+    chaves = db.reference(LOG_RAIZ).get(shallow=True) or {}
+    legados = [chave for chave in chaves if len(str(chave)) > 4]
+    if not legados:
+        return 0
+    raiz = db.reference(LOG_RAIZ).get() or {}  # leitura completa, uma única vez
+    for inicio in range(0, len(legados), LOG_LOTE_MIGRACAO):
+        lote = legados[inicio:inicio + LOG_LOTE_MIGRACAO]
+        caminhos = {}
+        for chave in lote:
+            dados = raiz.get(chave)
+            if isinstance(dados, dict) and dados.get('timestamp'):
+                caminhos.update(operacao_gravar(particao_log(dados['timestamp']), chave, dados))
+            caminhos[f'{LOG_RAIZ}/{chave}'] = None
+        gravar_em_lote(caminhos)
+    return len(legados)
+
+@st.cache_resource
+def _migracao_logs_legados():
     try:
-        ref = db.reference(f'/{node}')
-        data = ref.get()
-        if data:
-            if isinstance(data, dict):
-                df = pd.DataFrame.from_dict(data, orient='index')
-                if 'id' not in df.columns:
-                    df['id'] = df.index
-                return df
-            elif isinstance(data, list) and all(isinstance(item, dict) for item in data if item):
-                return pd.DataFrame([item for item in data if item])
-            return pd.DataFrame()
+        return migrar_logs_legados()
+    except Exception:
+        return 0
+
+@st.cache_data(ttl=300, show_spinner=False)
+def listar_meses_logs():
+    # Meses ainda no Firebase, do mais recente ao mais antigo.
+    meses = []
+    for ano in (db.reference(LOG_RAIZ).get(shallow=True) or {}):
+        if str(ano).isdigit() and len(str(ano)) == 4:
+            for mes in (db.reference(f'{LOG_RAIZ}/{ano}').get(shallow=True) or {}):
+                meses.append((int(ano), int(mes)))
+    return sorted(meses, reverse=True)
+
+@st.cache_data(show_spinner=False)
+def _carregar_resumo_logs_versionado(versao):
+    return db.reference('logs_resumo').get() or {}
+
+def carregar_resumo_logs():
+    linhas = []
+    for mes_ref, registros in _carregar_resumo_logs_versionado(versao_no('logs_resumo')).items():
+        for registro in (registros.values() if isinstance(registros, dict) else registros or []):
+            if isinstance(registro, dict):
+                linhas.append({**registro, 'mes': mes_ref})
+    return pd.DataFrame(linhas, columns=['mes', 'dia', 'usuario', 'acao', 'quantidade'])
+
+@st.cache_data(max_entries=24, show_spinner=False)
+def _carregar_arquivo_logs_versionado(mes_ref, versao):
+    registros = _decodificar_arquivo_logs(db.reference(f'{LOG_ARQUIVO_RAIZ}/{mes_ref}').get())
+    return pd.DataFrame.from_dict(registros, orient='index') if registros else pd.DataFrame()
+
+def carregar_logs_periodo(inicio, fim):
+    meses_arquivados = set(carregar_resumo_logs()['mes'])
+    partes = []
+    for ano, mes in meses_no_intervalo(inicio, fim):
+        mes_ref = _referencia_mes(ano, mes)
+        if mes_ref in meses_arquivados:
+            partes.append(_carregar_arquivo_logs_versionado(mes_ref, versao_no(LOG_ARQUIVO_RAIZ)))
+        # Mesmo num mês arquivado, a partição pode ter recebido logs depois do arquivamento.
+        partes.append(carregar_dados_firebase(particao_log_mes(ano, mes)))
+    partes = [p for p in partes if not p.empty and 'timestamp' in p.columns]
+    if not partes:
         return pd.DataFrame()
+    df = pd.concat(partes)
+    df = df[~df.index.duplicated(keep='last')]
+    inicio_str, fim_str = inicio.strftime("%Y-%m-%d"), fim.strftime("%Y-%m-%d 23:59:59")
+    return df[(df['timestamp'] >= inicio_str) & (df['timestamp'] <= fim_str)]
+
+def arquivar_mes_logs(ano, mes):
+    node = particao_log_mes(ano, mes)
+    mes_ref = _referencia_mes(ano, mes)
+    # Uma única leitura da partição: é ela que vai para o arquivo e é ela que é apagada.
+    novos = {chave: dados for chave, dados in (db.reference(node).get() or {}).items() if isinstance(dados, dict)}
+    if not novos:
+        return 0
+    registros = {**_decodificar_arquivo_logs(db.reference(f'{LOG_ARQUIVO_RAIZ}/{mes_ref}').get()), **novos}
+    partes = _codificar_arquivo_logs(registros)
+    assinatura = _assinatura_arquivo_logs(partes)
+
+    contagens = Counter(
+        (str(dados.get('timestamp', ''))[:10], dados.get('usuario') or '', dados.get('acao') or '')
+        for dados in registros.values()
+    )
+    resumo = [
+        {'dia': dia, 'usuario': usuario, 'acao': acao, 'quantidade': quantidade}
+        for (dia, usuario, acao), quantidade in sorted(contagens.items())
+    ]
+    # Usuário e ação podem ter caracteres proibidos em chaves do Firebase ('/', '.'),
+    # por isso o resumo é uma lista de linhas e não um dicionário aninhado.
+    gravar_em_lote({
+        f'{LOG_ARQUIVO_RAIZ}/{mes_ref}': {'partes': partes, 'registros': len(registros), 'sha256': assinatura},
+        f'_versoes/{LOG_ARQUIVO_RAIZ}': INCREMENTO_VERSAO,
+        f'logs_resumo/{mes_ref}': resumo,
+        '_versoes/logs_resumo': INCREMENTO_VERSAO,
+    })
+    gravado = db.reference(f'{LOG_ARQUIVO_RAIZ}/{mes_ref}/partes').get() or []
+    if _assinatura_arquivo_logs(gravado) != assinatura:
+        raise RuntimeError(f"O arquivo de {mes_ref} não confere após a gravação; a partição foi mantida.")
+
+    chaves = sorted(novos)
+    for inicio in range(0, len(chaves), LOG_LOTE_MIGRACAO):
+        caminhos = {f'{node}/{chave}': None for chave in chaves[inicio:inicio + LOG_LOTE_MIGRACAO]}
+        caminhos[f'_versoes/{node}'] = INCREMENTO_VERSAO
+        gravar_em_lote(caminhos)
+    _espelhos_firebase().pop(node, None)
+    listar_meses_logs.clear()
+    return len(novos)
+
+@st.cache_data(ttl=5, show_spinner=False)
+def carregar_versoes_nos():
+    try:
+        return db.reference('_versoes').get() or {}
+    except Exception:
+        return {}
+
+def versao_no(node):
+    revisao = revisao_ao_vivo(node)
+    if revisao is not None:
+        return ('ao_vivo', revisao)
+    # Nós particionados ('logs_de_atividade/2025/03') têm a versão aninhada em '_versoes'.
+    versao = carregar_versoes_nos()
+    for parte in node.strip('/').split('/'):
+        versao = versao.get(parte, 0) if isinstance(versao, dict) else 0
+    return versao if isinstance(versao, (int, float)) else 0
+
+def recarregar_versoes_nos():
+    # Após uma escrita, descarta o cache das versões. O cache do st.cache_data é do
+    # processo, não da sessão: todas as sessões deste servidor releem '_versoes' no
+    # próximo acesso (uma leitura pequena cada). Só outros processos, se houver, esperam
+    # o TTL de carregar_versoes_nos expirar.
+    carregar_versoes_nos.clear()
+
+@st.cache_resource
+def _espelhos_firebase():
+    espelhos = {}
+    atexit.register(_encerrar_ouvintes, espelhos)
+    return espelhos
+
+def _obter_espelho(node):
+    espelhos = _espelhos_firebase()
+    espelho = espelhos.get(node)
+    if espelho is None:
+        lock = threading.Lock()
+        espelho = espelhos.setdefault(node, {
+            'lock': lock, 'condicao': threading.Condition(lock), 'dados': None,
+            'df': pd.DataFrame(), 'df_pendente': set(), 'marca_dagua': 0,
+            'ouvinte': None, 'ao_vivo': False, 'revisao': 0, 'falha_ouvinte': 0,
+        })
+    return espelho
+
+def _marca_registro(dados):
+    marca = dados.get('updated_at') if isinstance(dados, dict) else None
+    return marca if isinstance(marca, (int, float)) else 0
+
+def _dataframe_do_no(dados):
+    if not dados:
+        return pd.DataFrame()
+    df = pd.DataFrame.from_dict(dados, orient='index')
+    if 'id' not in df.columns:
+        df['id'] = df.index
+    return df
+
+def _normalizar_no(data):
+    if isinstance(data, list):
+        data = {str(i): item for i, item in enumerate(data) if isinstance(item, dict)}
+    return dict(data) if isinstance(data, dict) else {}
+
+def _atualizar_df_espelho(espelho, tocados):
+    dados = espelho['dados']
+    df = espelho['df']
+    if not df.empty:
+        df = df.drop(index=[c for c in tocados if c in df.index])
+    df_alterados = _dataframe_do_no({c: dados[c] for c in tocados if c in dados})
+    df = pd.concat([df, df_alterados]) if not df.empty else df_alterados
+    espelho['df'] = df.reindex(list(dados)) if dados else pd.DataFrame()
+
+def _df_espelho(espelho):
+    # Chamada com o lock do espelho: aplica ao DataFrame as chaves tocadas desde a
+    # última leitura (None pede a reconstrução inteira).
+    pendente = espelho['df_pendente']
+    if pendente is None:
+        espelho['df'] = _dataframe_do_no(espelho['dados'])
+    elif pendente:
+        _atualizar_df_espelho(espelho, pendente)
+    espelho['df_pendente'] = set()
+    return espelho['df']
+
+def _marcar_tocados(espelho, tocados):
+    if espelho['df_pendente'] is not None:
+        espelho['df_pendente'] |= set(tocados)
+
+def _carga_completa(node, espelho):
+    dados = _normalizar_no(db.reference(f'/{node}').get())
+    espelho['dados'] = dados
+    espelho['df'] = _dataframe_do_no(dados)
+    espelho['df_pendente'] = set()
+    espelho['marca_dagua'] = max((_marca_registro(v) for v in dados.values()), default=0)
+
+def _carga_incremental(node, espelho):
+    inicio = max(espelho['marca_dagua'] - MARGEM_MARCA_DAGUA_MS, 0)
+    alterados = db.reference(f'/{node}').order_by_child('updated_at').start_at(inicio).get() or {}
+    remocoes = db.reference(f'_remocoes/{node}').order_by_value().start_at(inicio).get() or {}
+    if not alterados and not remocoes:
+        return
+
+    dados = espelho['dados']
+    removidos = set()
+    for chave, marca_remocao in remocoes.items():
+        atual = dados.get(chave)
+        if atual is not None and marca_remocao >= _marca_registro(atual) and chave not in alterados:
+            del dados[chave]
+            removidos.add(chave)
+    dados.update(alterados)
+    _marcar_tocados(espelho, removidos | set(alterados))
+    marcas = [_marca_registro(v) for v in alterados.values()] + list(remocoes.values())
+    espelho['marca_dagua'] = max([espelho['marca_dagua']] + marcas)
+
+def _aplicar_no_caminho(dados, partes, valor):
+    # Copia o registro antes de alterar: quem recebeu um retrato (registros_espelho)
+    # continua vendo a versão anterior. Devolve a chave do registro tocado.
+    chave = partes[0]
+    if len(partes) == 1:
+        if valor is None:
+            dados.pop(chave, None)
+        else:
+            dados[chave] = valor
+        return chave
+    registro = dict(dados[chave]) if isinstance(dados.get(chave), dict) else {}
+    alvo = registro
+    for parte in partes[1:-1]:
+        filho = alvo.get(parte)
+        alvo[parte] = dict(filho) if isinstance(filho, dict) else {}
+        alvo = alvo[parte]
+    if valor is None:
+        alvo.pop(partes[-1], None)
+    else:
+        alvo[partes[-1]] = valor
+    if registro:
+        dados[chave] = registro
+    else:
+        dados.pop(chave, None)
+    return chave
+
+def _aplicar_evento(espelho, evento):
+    partes = [p for p in (evento.path or '/').split('/') if p]
+    with espelho['condicao']:
+        if not partes and evento.event_type == 'put':
+            # Retrato completo: chega ao abrir o ouvinte e a cada reconexão.
+            espelho['dados'] = _normalizar_no(evento.data)
+            espelho['df_pendente'] = None
+            espelho['marca_dagua'] = max((_marca_registro(v) for v in espelho['dados'].values()), default=0)
+        elif espelho['dados'] is not None:
+            if evento.event_type == 'patch':
+                itens = [(partes + [p for p in k.split('/') if p], v) for k, v in (evento.data or {}).items()]
+            else:
+                itens = [(partes, evento.data)]
+            tocados = {_aplicar_no_caminho(espelho['dados'], caminho, valor) for caminho, valor in itens if caminho}
+            _marcar_tocados(espelho, tocados)
+            marcas = [_marca_registro(espelho['dados'].get(chave)) for chave in tocados]
+            espelho['marca_dagua'] = max([espelho['marca_dagua']] + marcas)
+        else:
+            return
+        espelho['revisao'] += 1
+        espelho['ao_vivo'] = True
+        espelho['condicao'].notify_all()
+
+def _parar_ouvinte(espelho):
+    with espelho['condicao']:
+        registro = espelho['ouvinte']
+        espelho.update({'ouvinte': None, 'ao_vivo': False, 'dados': None, 'falha_ouvinte': time.time()})
+    if registro is not None:
+        # close() espera a thread do ouvinte; como isto pode rodar nela, fecha em outra.
+        threading.Thread(target=registro.close, daemon=True).start()
+
+def _receber_evento(espelho, evento):
+    try:
+        _aplicar_evento(espelho, evento)
+    except Exception:
+        _parar_ouvinte(espelho)
+
+def _garantir_ouvinte(node, espelho, esperar=True):
+    with espelho['condicao']:
+        if espelho['ao_vivo']:
+            return True
+        if espelho['ouvinte'] is None:
+            if time.time() - espelho['falha_ouvinte'] < INTERVALO_REABRIR_OUVINTE_S:
+                return False
+            try:
+                espelho['ouvinte'] = db.reference(f'/{node}').listen(
+                    lambda evento: _receber_evento(espelho, evento))
+            except Exception:
+                espelho['falha_ouvinte'] = time.time()
+                return False
+        if not esperar:
+            return False
+        return espelho['condicao'].wait_for(lambda: espelho['ao_vivo'], ESPERA_OUVINTE_S)
+
+def _encerrar_ouvintes(espelhos):
+    for espelho in list(espelhos.values()):
+        if espelho.get('ouvinte') is not None:
+            try:
+                espelho['ouvinte'].close()
+            except Exception:
+                pass
+
+def revisao_ao_vivo(node):
+    espelho = _espelhos_firebase().get(node)
+    return espelho['revisao'] if espelho is not None and espelho['ao_vivo'] else None
+
+def espelho_ao_vivo(node):
+    # Abre o ouvinte sem esperar o primeiro retrato; True quando o espelho já está ao vivo.
+    return node in NOS_AO_VIVO and _garantir_ouvinte(node, _obter_espelho(node), esperar=False)
+
+def _valor_local(valor, atual):
+    # Resolve localmente os valores de servidor de uma escrita ('.sv'): o carimbo vira a
+    # hora local e o incremento é somado ao valor do espelho.
+    if isinstance(valor, dict):
+        servidor = valor.get('.sv')
+        if servidor == 'timestamp':
+            return int(time.time() * 1000)
+        if isinstance(servidor, dict) and 'increment' in servidor:
+            return (atual if isinstance(atual, (int, float)) else 0) + servidor['increment']
+        atual = atual if isinstance(atual, dict) else {}
+        return {chave: _valor_local(filho, atual.get(chave)) for chave, filho in valor.items()}
+    return valor
+
+def _valor_no_caminho(dados, partes):
+    for parte in partes:
+        if not isinstance(dados, dict):
+            return None
+        dados = dados.get(parte)
+    return dados
+
+def aplicar_escrita_nos_espelhos(caminhos):
+    espelhos = _espelhos_firebase()
+    por_no = defaultdict(list)
+    for caminho, valor in caminhos.items():
+        partes = [p for p in caminho.split('/') if p]
+        if partes and partes[0] in NOS_AO_VIVO:
+            por_no[partes[0]].append((partes[1:], valor))
+    for node, itens in por_no.items():
+        espelho = espelhos.get(node)
+        if espelho is None:
+            continue
+        with espelho['condicao']:
+            if not espelho['ao_vivo'] or espelho['dados'] is None:
+                continue
+            for partes, valor in itens:
+                if not partes:
+                    espelho['dados'] = _normalizar_no(_valor_local(valor, None))
+                    espelho['df_pendente'] = None
+                    continue
+                valor = _valor_local(valor, _valor_no_caminho(espelho['dados'], partes))
+                _marcar_tocados(espelho, {_aplicar_no_caminho(espelho['dados'], partes, valor)})
+            espelho['revisao'] += 1
+            espelho['condicao'].notify_all()
+
+def sincronizar_espelho(node):
+    espelho = _obter_espelho(node)
+    if node in NOS_AO_VIVO and _garantir_ouvinte(node, espelho):
+        return espelho
+    with espelho['lock']:
+        if espelho['dados'] is None:
+            _carga_completa(node, espelho)
+        else:
+            try:
+                _carga_incremental(node, espelho)
+            except Exception:
+                _carga_completa(node, espelho)
+        return espelho
+
+def registros_espelho(node):
+    espelho = sincronizar_espelho(node)
+    with espelho['lock']:
+        if espelho['dados'] is None:
+            # O ouvinte caiu entre a sincronização e o lock: relê o nó inteiro.
+            _carga_completa(node, espelho)
+        return dict(espelho['dados'])
+
+
+def carregar_dados_firebase(node):
+    return _carregar_no_versionado(node, versao_no(node))
+
+@st.cache_data(max_entries=100)
+def _carregar_no_versionado(node, versao):
+    try:
+        espelho = sincronizar_espelho(node)
+        with espelho['lock']:
+            if espelho['dados'] is None:
+                _carga_completa(node, espelho)
+            return _df_espelho(espelho).copy()
     except Exception as e:
         st.error(f"Erro ao carregar dados do nó '{node}': {e}")
         return pd.DataFrame()
 
+def carregar_indice_ausencias():
+    return _indice_ausencias_versionado(versao_no('folgas_ferias'), versao_no('boletins'), versao_no('funcionarios'))
+
+def funcionarios_disponiveis(df_funcionarios, dia):
+    # Filtra pelo id: dois funcionários com o mesmo nome curto não se escondem um ao outro.
+    # Devolve o mapa nome curto -> nome completo de quem está disponível no dia e os nomes
+    # curtos de quem está de férias ou abonada.
+    if df_funcionarios.empty:
+        return {}, []
+    ids_de_licenca = ausencias.ids_ausentes_no_dia(carregar_indice_ausencias(), dia, tipos=ausencias.TIPOS_LICENCA)
+    de_licenca = df_funcionarios['id'].astype(str).isin(ids_de_licenca)
+    disponiveis = {formatar_nome(nome): nome for nome in df_funcionarios.loc[~de_licenca, 'nome']}
+    de_licenca_curtos = sorted({formatar_nome(nome) for nome in df_funcionarios.loc[de_licenca, 'nome']})
+    return disponiveis, de_licenca_curtos
+
+# Carga concorrente na entrada dos módulos: cada nó (ou carregador sem argumentos,
+# como carregar_contornos_quadras) vai para uma thread, e o tempo de entrada passa a
+# ser o da carga mais lenta em vez da soma de todas. As threads recebem o contexto da sessão
+# para que st.cache_data e st.error funcionem dentro delas.
+MAX_CARGAS_PARALELAS = 8
+
+def carregar_em_paralelo(*fontes):
+    carregar_versoes_nos()
+    contexto = get_script_run_ctx()
+
+    def carregar(fonte):
+        if contexto is not None:
+            add_script_run_ctx(threading.current_thread(), contexto)
+        return carregar_dados_firebase(fonte) if isinstance(fonte, str) else fonte()
+
+    unicas = list(dict.fromkeys(fontes))
+    if len(unicas) <= 1:
+        resultados = {fonte: carregar(fonte) for fonte in unicas}
+    else:
+        with ThreadPoolExecutor(max_workers=min(len(unicas), MAX_CARGAS_PARALELAS)) as executor:
+            resultados = dict(zip(unicas, executor.map(carregar, unicas)))
+    return [resultados[fonte] for fonte in fontes]
+
+@st.cache_resource(max_entries=4)
+def _indice_ausencias_versionado(versao_folgas, versao_boletins, versao_funcionarios):
+    # Reconstruído só quando algum dos três nós muda de versão.
+    return ausencias.construir_indice_ausencias(
+        carregar_dados_firebase('folgas_ferias'),
+        carregar_dados_firebase('boletins'),
+        carregar_dados_firebase('funcionarios'),
+    )
+
+def carregar_eventos_calendario(mes, filtro=None):
+    inicio, fim = calendario.janela_do_mes(mes)
+    return _eventos_calendario_versionado(
+        inicio, fim, filtro,
+        versao_no('folgas_ferias'), versao_no('boletins'), versao_no('funcionarios'), versao_no('avisos'),
+    )
+
+@st.cache_resource(max_entries=4)
+def _indice_avisos_versionado(versao_avisos):
+    return calendario.indexar_avisos(carregar_dados_firebase('avisos'))
+
+@st.cache_data(max_entries=48)
+def _eventos_calendario_versionado(inicio, fim, filtro, versao_folgas, versao_boletins, versao_funcionarios, versao_avisos):
+    # Uma entrada por (janela, filtro); as versões dos nós invalidam quando algo muda.
+    return calendario.eventos_do_periodo(
+        carregar_indice_ausencias(), _indice_avisos_versionado(versao_avisos),
+        inicio, fim, filtro, formatar_nome,
+    )
+
+def carregar_indice_visitas():
+    return _indice_visitas_versionado(versao_no('pe_ie_cadastros'), versao_no('boletins_pe_ie'))
+
+@st.cache_resource(max_entries=4)
+def _indice_visitas_versionado(versao_cadastros, versao_boletins):
+    return visitas.construir_indice_visitas(
+        carregar_dados_firebase('pe_ie_cadastros'),
+        carregar_dados_firebase('boletins_pe_ie'),
+    )
+
+LOTE_MIGRACAO_PE_IE = 200
+
+def migrar_ids_boletins_pe_ie():
+    # Grava 'imoveis_ids' nos boletins P.E/I.E antigos, que só tinham os rótulos.
+    resolvedor = visitas.construir_resolvedor(carregar_dados_firebase('pe_ie_cadastros'))
+    operacoes = [
+        operacao_atualizar('boletins_pe_ie', chave, {'imoveis_ids': visitas.ids_do_boletim(boletim, resolvedor)})
+        for chave, boletim in registros_espelho('boletins_pe_ie').items()
+        if isinstance(boletim, dict) and not isinstance(boletim.get('imoveis_ids'), list)
+    ]
+    for inicio in range(0, len(operacoes), LOTE_MIGRACAO_PE_IE):
+        gravar_em_lote(*operacoes[inicio:inicio + LOTE_MIGRACAO_PE_IE])
+    return len(operacoes)
+
+@st.cache_resource
+def _migracao_ids_boletins_pe_ie():
+    try:
+        return migrar_ids_boletins_pe_ie()
+    except Exception:
+        return 0
+
+def carregar_produtividade_diaria():
+    return _produtividade_diaria_versionada(versao_no('boletins'))
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def _produtividade_diaria_versionada(versao):
+    return produtividade.rollup_diario(produtividade.tabela_visitas(carregar_dados_firebase('boletins')))
+
+def operacoes_resumo_pe_ie(boletim, sinal, campos=None):
+    # Soma (sinal=1) ou desfaz (sinal=-1) a contribuição do boletim em 'resumo_pe_ie';
+    # entra no mesmo gravar_em_lote da gravação do boletim. Com `campos`, mexe só nos
+    # contadores indicados (p.ex. ('tratamentos',) ao editar o tratamento).
+    ids = visitas.ids_do_boletim(boletim, carregar_indice_visitas()['resolvedor'])
+    caminhos = {'_versoes/resumo_pe_ie': INCREMENTO_VERSAO}
+    for periodo, contribuicao in visitas.contribuicao_boletim(boletim, ids).items():
+        for campo in campos or ('boletins', 'positivos', 'tratamentos'):
+            if contribuicao[campo]:
+                caminhos[f'resumo_pe_ie/{periodo}/{campo}'] = incremento(sinal * contribuicao[campo])
+        if campos is None:
+            for chave in contribuicao['visitados']:
+                caminhos[f'resumo_pe_ie/{periodo}/visitados/{chave}'] = incremento(sinal)
+    return caminhos
+
+def carregar_resumo_pe_ie(periodo):
+    return _resumo_pe_ie_versionado(periodo, versao_no('resumo_pe_ie'))
+
+@st.cache_data(max_entries=50, show_spinner=False)
+def _resumo_pe_ie_versionado(periodo, versao):
+    try:
+        return db.reference(f'resumo_pe_ie/{periodo}').get() or {}
+    except Exception as e:
+        st.error(f"Erro ao carregar o resumo de P.E/I.E: {e}")
+        return {}
+
+def reconstruir_resumo_pe_ie():
+    resumo = visitas.resumir_boletins(
+        registros_espelho('boletins_pe_ie').values(),
+        visitas.construir_resolvedor(carregar_dados_firebase('pe_ie_cadastros')),
+    )
+    gravar_em_lote({'resumo_pe_ie': resumo or None, '_versoes/resumo_pe_ie': INCREMENTO_VERSAO})
+    return len(resumo)
+
+@st.cache_resource
+def _garantir_resumo_pe_ie():
+    # Na primeira execução (nó ainda inexistente), monta o resumo a partir do histórico.
+    try:
+        if db.reference('resumo_pe_ie').get(shallow=True) is None:
+            return reconstruir_resumo_pe_ie()
+    except Exception:
+        pass
+    return 0
+
+# Os carregadores da base geográfica separam a parte em cache da captura do erro: uma
+# exceção não entra no cache, então uma falha (arquivo ausente, disco cheio) é tentada
+# de novo no próximo acesso em vez de deixar a lista vazia até o processo reiniciar.
+@st.cache_resource
+def _base_geografica_compilada():
+    return geodados.garantir_base_compilada()
+
+def preparar_base_geografica():
+    # Compila a base (geodados.py) uma vez por processo, antes das cargas paralelas que a
+    # leem, em vez de deixar duas threads dessas cargas disputarem a compilação.
+    try:
+        _base_geografica_compilada()
+    except Exception as e:
+        st.error(f"Não foi possível compilar a base geográfica. Erro: {e}")
+
 @st.cache_data
+def _quarteiroes_compilados():
+    return geodados.carregar_quarteiroes()
+
 def carregar_quarteiroes_csv():
-    url_csv = 'https://raw.githubusercontent.com/fernandafrisson/sistema-gestao/main/Quarteirao.csv'
+    # Lido da base compilada local (geodados.py), recompilada se Quarteirao.csv mudar.
     try:
-        df_quarteiroes = pd.read_csv(url_csv, header=None, encoding='latin-1')
-        quarteiroes_lista = sorted(df_quarteiroes[0].astype(str).unique().tolist())
-        return quarteiroes_lista
+        return _quarteiroes_compilados()
     except Exception as e:
         st.error(f"Não foi possível carregar a lista de quarteirões. Erro: {e}")
         return []
 
-@st.cache_data
-def carregar_geo_kml():
-    url_kml = 'https://raw.githubusercontent.com/fernandafrisson/sistema-gestao/main/Quadras%20de%20Guar%C3%A1.kml'
+@st.cache_resource
+def _contornos_quadras_compilados():
+    return geodados.contornos_quadras_por_zoom()
+
+def carregar_contornos_quadras():
+    # Contornos das quadras já simplificados por nível de zoom (geodados.py).
     try:
-        gdf = gpd.read_file(url_kml, driver='KML')
-        pontos = []
-        for index, row in gdf.iterrows():
-            quadra_nome = row['Name']
-            if row['geometry'] is not None and hasattr(row['geometry'], 'geom_type'):
-                if row['geometry'].geom_type == 'Point':
-                    lon, lat = row['geometry'].x, row['geometry'].y
-                else:
-                    centroid = row['geometry'].centroid
-                    lon, lat = centroid.x, centroid.y
-                pontos.append({'quadra': str(quadra_nome), 'lat': lat, 'lon': lon})
-        df_geo = pd.DataFrame(pontos)
-        df_geo.dropna(subset=['lat', 'lon'], inplace=True)
-        return df_geo
+        return _contornos_quadras_compilados()
     except Exception as e:
         st.error(f"Não foi possível carregar os dados de geolocalização do KML. Erro: {e}")
-        return pd.DataFrame()
+        return {}
 
-# --- FUNÇÕES DE GERAÇÃO DE RELATÓRIOS .DOCX ---
-def create_abonada_word_report(data):
-    def format_date_pt(dt):
-        months = ("Janeiro", "Fevereiro", "Março", "Abril", "Maio", "Junho", "Julho", "Agosto", "Setembro", "Outubro", "Novembro", "Dezembro")
-        return f"{dt.day} de {months[dt.month - 1]} de {dt.year}"
-    document = Document()
-    black_color = RGBColor(0, 0, 0)
-    def add_black_run(p, text, bold=False, size=11):
-        run = p.add_run(text)
-        run.bold = bold
-        font = run.font
-        font.name = 'Calibri'
-        font.size = Pt(size)
-        font.color.rgb = black_color
-        p.paragraph_format.space_after = Pt(0)
-    for text in ["Fundo Municipal de Saúde", "Prefeitura Municipal da Estância Turística de Guaratinguetá", "São Paulo", "Secretaria Municipal da Saúde"]:
-        p = document.add_paragraph()
-        add_black_run(p, text)
-        p.alignment = WD_ALIGN_PARAGRAPH.CENTER
-    titulo = document.add_heading('FALTA ABONADA', level=1)
-    titulo.alignment = WD_ALIGN_PARAGRAPH.CENTER
-    for run in titulo.runs:
-        run.font.color.rgb = black_color
-    titulo.paragraph_format.space_before = Pt(18)
-    titulo.paragraph_format.space_after = Pt(18)
-    p_nome = document.add_paragraph(); add_black_run(p_nome, 'Nome: '); add_black_run(p_nome, data.get('nome', ''), bold=True)
-    p_funcao = document.add_paragraph(); add_black_run(p_funcao, 'Função: '); add_black_run(p_funcao, data.get('funcao', ''), bold=True)
-    p_unidade = document.add_paragraph(); add_black_run(p_unidade, 'Unidade de Trabalho: '); add_black_run(p_unidade, data.get('unidade', ''), bold=True)
-    solicitacao_text = f"Solicito que a minha falta ao serviço seja abonada no dia: {data.get('data_abonada', '')}"
-    p_solicitacao = document.add_paragraph(); add_black_run(p_solicitacao, solicitacao_text)
-    p_solicitacao.paragraph_format.space_before = Pt(18)
-    p_solicitacao.paragraph_format.space_after = Pt(18)
-    data_atual_formatada = format_date_pt(date.today())
-    p_data = document.add_paragraph(f"Guaratinguetá, {data_atual_formatada}"); p_data.alignment = WD_ALIGN_PARAGRAPH.RIGHT
-    for run in p_data.runs: run.font.color.rgb = black_color
-    p_data.paragraph_format.space_after = Pt(36)
-    p_ass1 = document.add_paragraph('____________________________'); p_ass1.alignment = WD_ALIGN_PARAGRAPH.CENTER
-    p_lab1 = document.add_paragraph('Assinatura do Servidor'); p_lab1.alignment = WD_ALIGN_PARAGRAPH.CENTER
-    p_ass2 = document.add_paragraph('_____________________________'); p_ass2.alignment = WD_ALIGN_PARAGRAPH.CENTER
-    p_lab2 = document.add_paragraph('Assinatura da Chefia Imediata'); p_lab2.alignment = WD_ALIGN_PARAGRAPH.CENTER
-    p_lab2.paragraph_format.space_after = Pt(18)
-    p_info = document.add_paragraph(); add_black_run(p_info, 'Informação da Seção de Pessoal:', bold=True)
-    add_black_run(document.add_paragraph(), "Refere-se à:       1ª (   )     2ª (   )   3ª (   ) do Primeiro Semestre de: ____________")
-    add_black_run(document.add_paragraph(), "           1ª (   )     2ª (   )   3ª (   ) do Segundo Semestre de: ____________")
-    p_visto = document.add_paragraph("      ___________________________________________");
-    p_visto_label = document.add_paragraph("          (visto do funcionário da seção de pessoal)")
-    p_abone = document.add_paragraph("                Abone-se: _____/_____/______")
-    p_abone.paragraph_format.space_after = Pt(18)
-    p_secretario_sig = document.add_paragraph("_________________________________"); p_secretario_sig.alignment = 1
-    p_secretario_label = document.add_paragraph("Secretário Municipal da Saúde"); p_secretario_label.alignment = 1
-    for p in document.paragraphs:
-        if not p.runs:
-            p.paragraph_format.space_after = Pt(0)
-        for run in p.runs:
-            if run.font.color.rgb is None:
-                run.font.color.rgb = black_color
-    buffer = io.BytesIO()
-    document.save(buffer)
-    buffer.seek(0)
-    return buffer.getvalue()
+@st.cache_resource
+def _niveis_ruas_compilados():
+    return geodados.construir_niveis_ruas()
 
-def create_word_report(data):
-    document = Document()
-    style = document.styles['Normal']; font = style.font; font.name = 'Calibri'; font.size = Pt(11)
-    titulo = document.add_heading('RELATÓRIO DE INSPEÇÃO ZOOSSANITÁRIA', level=1); titulo.alignment = 1
-    try: data_obj = datetime.strptime(data.get('data_denuncia', ''), '%Y-%m-%d'); data_formatada = data_obj.strftime('%d/%m/%Y')
-    except (ValueError, TypeError): data_formatada = "Data não informada"
-    p_data = document.add_paragraph(data_formatada); p_data.alignment = 2
-    document.add_paragraph('Vigilância Epidemiológica')
-    p = document.add_paragraph(); p.add_run('Responsável: ').bold = True; p.add_run(str(data.get('responsavel_atendimento', '')))
-    endereco_completo = f"{data.get('logradouro', '')}, {data.get('numero', '')} - {data.get('bairro', '')}"
-    p = document.add_paragraph(); p.add_run('Endereço: ').bold = True; p.add_run(endereco_completo)
-    document.add_paragraph(); p = document.add_paragraph(); p.add_run('Relato da Situação: ').bold = True
-    document.add_paragraph(str(data.get('detalhes_denuncia', '')))
-    document.add_paragraph(); p = document.add_paragraph(); p.add_run('Situação Encontrada: ').bold = True
-    document.add_paragraph(str(data.get('relatorio_atendimento', '')))
-    document.add_paragraph(); p = document.add_paragraph(); p.add_run('Conclusão: ').bold = True
-    document.add_paragraph(str(data.get('conclusao_atendimento', '')))
-    footer = document.sections[0].footer; footer_para = footer.paragraphs[0]
-    footer_para.text = ("PREFEITURA MUNICIPAL DA ESTÂNCIA TURÍSTICA DE GUARATINGUETÁ/SP\n"
-                        "Secretaria Municipal de Saúde - Fundo Municipal de Saúde\n"
-                        "Rua Jacques Felix, 02 – São Gonçalo - Guaratinguetá/SP - CEP 12.502-180\n"
-                        "Telefone / Fax: (12) 3123-2900 - e-mail: ccz@guaratingueta.sp.gov.br")
-    footer_para.alignment = 1
-    font_footer = footer_para.style.font
-    font_footer.name = 'Arial'; font_footer.size = Pt(8)
-    buffer = io.BytesIO(); document.save(buffer); buffer.seek(0)
-    return buffer.getvalue()
+def carregar_niveis_ruas():
+    # Malha de Ruas.kml simplificada por zoom; o mapa pede só a janela visível.
+    try:
+        return _niveis_ruas_compilados()
+    except Exception as e:
+        st.error(f"Não foi possível carregar as ruas do KML. Erro: {e}")
+        return {}
+
+@st.cache_resource
+def carregar_geocodificador():
+    # Índice de ruas (Ruas.kml) e polígonos de bairro, montado uma vez por processo.
+    return geodados.construir_indice_ruas()
+
+@st.cache_resource
+def carregar_indice_quadras():
+    # Árvore STR sobre as quadras do KML para consultas ponto->quadra, quadras por
+    # bairro e quadras numa janela (geodados.quadra_do_ponto / quadras_no_bairro /
+    # quadras_na_janela).
+    return geodados.construir_indice_quadras()
+
+# --- GEOCODIFICAÇÃO DAS DENÚNCIAS (EM SEGUNDO PLANO) ---
+# As coordenadas ficam gravadas em 'denuncias/{protocolo}' (lat, lon, geocode_status,
+# geocode_fonte, geocode_precisao). Ao registrar uma denúncia ou alterar o endereço,
+# o status volta a 'pendente' e o protocolo entra na fila de uma thread do processo,
+# que tenta o índice de ruas local e, se não achar e a consulta externa estiver ligada
+# ('geocodificacao_nominatim = true' nos secrets), o Nominatim. O mapa só lê o que está
+# gravado. O resultado só é gravado se a denúncia ainda existir com o mesmo endereço, e
+# uma falha ('erro') é tentada de novo até GEOCODE_MAX_TENTATIVAS vezes.
+CAMPOS_ENDERECO_DENUNCIA = ['logradouro', 'numero', 'bairro', 'cep']
+GEOCODE_PENDENTE = 'pendente'
+GEOCODE_ERRO = 'erro'
+GEOCODE_STATUS_FINAIS = ['ok', 'nao_encontrado']
+GEOCODE_MAX_TENTATIVAS = 3
+
+def nominatim_habilitado():
+    try:
+        return bool(st.secrets.get('geocodificacao_nominatim', False))
+    except Exception:
+        return False
+
+def geocodificacao_encerrada(df_denuncias):
+    # Máscara das denúncias que não voltam mais para a fila.
+    status = df_denuncias['geocode_status'] if 'geocode_status' in df_denuncias.columns else pd.Series(None, index=df_denuncias.index)
+    tentativas = pd.to_numeric(df_denuncias.get('geocode_tentativas', pd.Series(0, index=df_denuncias.index)), errors='coerce').fillna(0)
+    return status.isin(GEOCODE_STATUS_FINAIS) | ((status == GEOCODE_ERRO) & (tentativas >= GEOCODE_MAX_TENTATIVAS))
+
+def geocodificar_denuncia(indice_ruas, dados, geolocator=None):
+    logradouro = dados.get('logradouro') or dados.get('rua', '')
+    local = geodados.geocodificar_endereco(indice_ruas, logradouro, dados.get('bairro', ''))
+    if local:
+        return {'lat': local['lat'], 'lon': local['lon'], 'geocode_status': 'ok',
+                'geocode_fonte': 'ruas_kml', 'geocode_precisao': local['precisao']}
+    if geolocator is not None:
+        endereco = f"{logradouro}, {dados.get('numero', '')}, {dados.get('bairro', '')}, Guaratinguetá, SP, Brasil"
+        location = geolocator.geocode(endereco, timeout=10)
+        time.sleep(1)  # limite de uso do Nominatim: 1 requisição por segundo
+        if location:
+            return {'lat': location.latitude, 'lon': location.longitude, 'geocode_status': 'ok',
+                    'geocode_fonte': 'nominatim', 'geocode_precisao': 'endereco'}
+    return {'lat': None, 'lon': None, 'geocode_status': 'nao_encontrado',
+            'geocode_fonte': None, 'geocode_precisao': None}
+
+def _gravar_geocodificacao(protocolo, dados_lidos, resultado):
+    # Transação no registro: se a denúncia foi removida ou o endereço mudou durante a
+    # consulta, nada é gravado (a edição de endereço já enfileirou o protocolo de novo).
+    gravado = []
+    def aplicar(atual):
+        gravado.clear()
+        if not isinstance(atual, dict) or any(atual.get(c) != dados_lidos.get(c) for c in CAMPOS_ENDERECO_DENUNCIA + ['rua']):
+            return atual
+        gravado.append(True)
+        return {**atual, **resultado, 'updated_at': CARIMBO_SERVIDOR}
+    db.reference(f'denuncias/{protocolo}').transaction(aplicar)
+    if gravado:
+        gravar_em_lote({'_versoes/denuncias': INCREMENTO_VERSAO})
+
+def _trabalhador_geocodificacao(fila, indice_ruas, indice_quadras, geolocator=None):
+    while True:
+        protocolo = fila['fila'].get()
+        # Sai do conjunto antes de processar: uma edição de endereço feita durante a
+        # consulta enfileira o protocolo de novo em vez de ser descartada.
+        with fila['lock']:
+            fila['pendentes'].discard(protocolo)
+        try:
+            dados = db.reference(f'denuncias/{protocolo}').get()
+            if not isinstance(dados, dict):
+                continue
+            try:
+                resultado = geocodificar_denuncia(indice_ruas, dados, geolocator)
+                resultado['quadra'] = geodados.quadra_do_ponto(indice_quadras, resultado['lon'], resultado['lat']) if resultado['lat'] is not None else None
+            except Exception:
+                resultado = {'geocode_status': GEOCODE_ERRO, 'geocode_tentativas': int(dados.get('geocode_tentativas') or 0) + 1}
+            _gravar_geocodificacao(protocolo, dados, resultado)
+        except Exception:
+            pass
+
+@st.cache_resource
+def _fila_geocodificacao():
+    fila = {'fila': queue.Queue(), 'pendentes': set(), 'lock': threading.Lock()}
+    geolocator = Nominatim(user_agent="sistema_gestao_denuncias") if nominatim_habilitado() else None
+    threading.Thread(
+        target=_trabalhador_geocodificacao, args=(fila, carregar_geocodificador(), carregar_indice_quadras(), geolocator),
+        name='geocodificacao-denuncias', daemon=True
+    ).start()
+    return fila
+
+def enfileirar_geocodificacao(protocolos):
+    fila = _fila_geocodificacao()
+    with fila['lock']:
+        novos = [p for p in protocolos if p not in fila['pendentes']]
+        fila['pendentes'].update(novos)
+    for protocolo in novos:
+        fila['fila'].put(protocolo)
+    return len(novos)
+
+def enfileirar_denuncias_sem_coordenadas(df_denuncias):
+    if df_denuncias.empty:
+        return 0
+    faltantes = df_denuncias.loc[~geocodificacao_encerrada(df_denuncias), 'protocolo']
+    return enfileirar_geocodificacao(faltantes.astype(str).tolist())
+
+# --- FUNÇÕES DE GERAÇÃO DE RELATÓRIOS .DOCX ---
+@st.cache_resource
+def _cache_relatorios():
+    return relatorios.novo_cache_relatorios()
+
+def relatorio_sob_demanda(gerador, *entradas, modelo=None, nos=None):
+    # Devolve uma função para o data= do st.download_button: o documento só é gerado
+    # quando alguém clica, e sai do cache se as mesmas entradas já foram geradas.
+    # nos: nós do Firebase de onde vêm os DataFrames das entradas; a chave usa a versão
+    # de cada nó (versao_no) em vez de percorrer os dados a cada rerun.
+    versao = relatorios.versao_funcao(gerador)
+    if modelo:
+        versao = f"{versao}:{relatorios.versao_modelo(modelo)}"
+    identidade = entradas
+    if nos:
+        identidade = [{no: versao_no(no) for no in nos}] + [e for e in entradas if not isinstance(e, pd.DataFrame)]
+    chave = relatorios.chave_relatorio(gerador.__name__, versao, *identidade)
+    cache = _cache_relatorios()
+    return lambda: relatorios.obter_relatorio(cache, chave, lambda: gerador(*entradas))
+
+def create_abonada_word_report(data, data_emissao=None):
+    return relatorios.renderizar_modelo('abonada', {
+        'nome': data.get('nome', ''),
+        'funcao': data.get('funcao', ''),
+        'unidade': data.get('unidade', ''),
+        'data_abonada': data.get('data_abonada', ''),
+        'data_extenso': relatorios.formatar_data_extenso(data_emissao or date.today()),
+    })
 
 def create_boletim_word_report(data_boletim):
-    document = Document()
-    style = document.styles['Normal']
-    font = style.font
-    font.name = 'Calibri'
-    font.size = Pt(11)
-
-    titulo = document.add_heading('BOLETIM DE PROGRAMAÇÃO DIÁRIA', level=1)
-    titulo.alignment = WD_ALIGN_PARAGRAPH.CENTER
-    
-    try:
-        locale.setlocale(locale.LC_TIME, 'pt_BR.UTF-8')
-    except locale.Error:
-        locale.setlocale(locale.LC_TIME, '') 
-
-    data_formatada = pd.to_datetime(data_boletim.get('data')).strftime('%d de %B de %Y')
-    p_data = document.add_paragraph(data_formatada.title())
-    p_data.alignment = WD_ALIGN_PARAGRAPH.CENTER
-    p_data.paragraph_format.space_after = Pt(18)
-
-    document.add_heading('Informações Gerais', level=2)
-    p_bairros = document.add_paragraph()
-    p_bairros.add_run('Bairros Trabalhados: ').bold = True
-    p_bairros.add_run(data_boletim.get('bairros', 'Não informado'))
-
-    p_atividades = document.add_paragraph()
-    p_atividades.add_run('Atividades Gerais: ').bold = True
-    p_atividades.add_run(', '.join(data_boletim.get('atividades_gerais', ['Nenhuma'])))
-
-    p_motoristas = document.add_paragraph()
-    p_motoristas.add_run('Motorista(s): ').bold = True
-    motoristas_formatados = [formatar_nome(nome) for nome in data_boletim.get('motoristas', [])]
-    p_motoristas.add_run(', '.join(motoristas_formatados) if motoristas_formatados else 'Nenhum')
-    
-    document.add_heading('Ausências do Dia', level=2)
-    faltas_manha = data_boletim.get('faltas_manha', {})
-    nomes_manha = [formatar_nome(nome) for nome in faltas_manha.get('nomes', [])]
-    p_faltas_m = document.add_paragraph()
-    p_faltas_m.add_run('Manhã: ').bold = True
-    p_faltas_m.add_run(f"{', '.join(nomes_manha) if nomes_manha else 'Nenhuma'} - Motivo: {faltas_manha.get('motivo', 'N/A')}")
+    def nomes(lista, vazio):
+        formatados = [formatar_nome(nome) for nome in lista or []]
+        return ', '.join(formatados) if formatados else vazio
+
+    def equipes(lista):
+        if not lista or not isinstance(lista, list):
+            return []
+        return [{
+            'numero': i + 1,
+            'membros': nomes(equipe.get('membros'), 'Nenhum'),
+            'atividades': equipe.get('atividades', ['Nenhuma']),
+            'quarteiroes': equipe.get('quarteiroes', ['Nenhum']),
+        } for i, equipe in enumerate(lista)]
 
+    faltas_manha = data_boletim.get('faltas_manha', {})
     faltas_tarde = data_boletim.get('faltas_tarde', {})
-    nomes_tarde = [formatar_nome(nome) for nome in faltas_tarde.get('nomes', [])]
-    p_faltas_t = document.add_paragraph()
-    p_faltas_t.add_run('Tarde: ').bold = True
-    p_faltas_t.add_run(f"{', '.join(nomes_tarde) if nomes_tarde else 'Nenhuma'} - Motivo: {faltas_tarde.get('motivo', 'N/A')}")
-    
-    def adicionar_secao_turno(turno_nome, equipes):
-        document.add_heading(f'Turno da {turno_nome}', level=2)
-        if not equipes or not isinstance(equipes, list):
-            document.add_paragraph('Nenhuma equipe registrada para este turno.')
-            return
-            
-        for i, equipe in enumerate(equipes):
-            document.add_heading(f'Equipe {i + 1}', level=3)
-            
-            membros_formatados = [formatar_nome(nome) for nome in equipe.get('membros', [])]
-            p_membros = document.add_paragraph()
-            p_membros.add_run('Membros: ').bold = True
-            p_membros.add_run(', '.join(membros_formatados) if membros_formatados else 'Nenhum')
-
-            p_atividades_eq = document.add_paragraph()
-            p_atividades_eq.add_run('Atividades: ').bold = True
-            p_atividades_eq.add_run(', '.join(equipe.get('atividades', ['Nenhuma'])))
-
-            p_quarteiroes = document.add_paragraph()
-            p_quarteiroes.add_run('Quarteirões: ').bold = True
-            p_quarteiroes.add_run(', '.join(equipe.get('quarteiroes', ['Nenhum'])))
-            p_quarteiroes.paragraph_format.space_after = Pt(12)
-
-    adicionar_secao_turno("Manhã", data_boletim.get('equipes_manha'))
-    adicionar_secao_turno("Tarde", data_boletim.get('equipes_tarde'))
-    
-    buffer = io.BytesIO()
-    document.save(buffer)
-    buffer.seek(0)
-    return buffer.getvalue()
+    return relatorios.renderizar_modelo('boletim', {
+        'data_extenso': relatorios.formatar_data_extenso(pd.to_datetime(data_boletim.get('data'))),
+        'bairros': data_boletim.get('bairros', 'Não informado'),
+        'atividades_gerais': data_boletim.get('atividades_gerais', ['Nenhuma']),
+        'motoristas': nomes(data_boletim.get('motoristas'), 'Nenhum'),
+        'faltas_manha': nomes(faltas_manha.get('nomes'), 'Nenhuma'),
+        'motivo_manha': faltas_manha.get('motivo', 'N/A'),
+        'faltas_tarde': nomes(faltas_tarde.get('nomes'), 'Nenhuma'),
+        'motivo_tarde': faltas_tarde.get('motivo', 'N/A'),
+        'equipes_manha': equipes(data_boletim.get('equipes_manha')),
+        'equipes_tarde': equipes(data_boletim.get('equipes_tarde')),
+    })
 
 # --- FUNÇÕES ESPECÍFICAS DO MÓDULO RH ---
 def calcular_status_ferias_saldo(employee_row, all_folgas_df):
@@ -756,45 +1539,146 @@ def calcular_status_ferias_saldo(employee_row, all_folgas_df):
     except Exception as e:
         return "Erro de Cálculo", f"Erro: {e}", "ERROR"
 
-def get_abonadas_ano(employee_id, all_folgas_df):
+CORES_STATUS_FERIAS = {
+    "PENDING": '#fff2cc',
+    "SCHEDULED": '#d4e6f1',
+    "ON_VACATION": '#d5f5e3',
+    "RISK_EXPIRING": '#f5b7b1',
+}
+
+def _datas_mistas(valores):
+    # Cada valor é interpretado isoladamente, como faria pd.to_datetime num escalar.
+    return pd.to_datetime(valores, errors='coerce', format='mixed').dt.normalize()
+
+def calcular_status_ferias_equipe(df_funcionarios, all_folgas_df):
+    # Versão em lote de calcular_status_ferias_saldo: mesma regra e mesmos textos,
+    # calculados para a equipe inteira sobre a grade funcionário x período aquisitivo.
+    # Devolve (período de referência, status, código) com o índice de df_funcionarios.
+    # Funcionários com datas que a função original trataria como erro passam por ela,
+    # para que a mensagem seja idêntica.
+    colunas = ['periodo_referencia', 'status', 'status_code']
+    resultado = pd.DataFrame(index=df_funcionarios.index, columns=colunas, dtype=object)
+    if df_funcionarios.empty:
+        return resultado
+
+    hoje = pd.Timestamp(date.today())
+    ids = df_funcionarios['id'].astype(str)
+    if 'data_admissao' in df_funcionarios.columns:
+        admissao_bruta = df_funcionarios['data_admissao']
+    else:
+        admissao_bruta = pd.Series(None, index=df_funcionarios.index, dtype=object)
+    admissao = _datas_mistas(admissao_bruta)
+    invalida = admissao_bruta.isna()
+    recalcular = ~invalida & admissao.isna()
+
+    ferias = pd.DataFrame({'id': pd.Series(dtype=object), 'inicio': pd.Series(dtype='datetime64[ns]'), 'fim': pd.Series(dtype='datetime64[ns]')})
+    if not all_folgas_df.empty and 'id_funcionario' in all_folgas_df.columns:
+        if not {'tipo', 'data_inicio', 'data_fim'}.issubset(all_folgas_df.columns):
+            recalcular = ~invalida
+        else:
+            registros = all_folgas_df[
+                (all_folgas_df['tipo'] == 'Férias') &
+                all_folgas_df['id_funcionario'].map(lambda v: isinstance(v, str))
+            ]
+            ferias = pd.DataFrame({
+                'id': registros['id_funcionario'],
+                'inicio': _datas_mistas(registros['data_inicio']),
+                'fim': _datas_mistas(registros['data_fim']),
+            })
+            com_erro = ferias['inicio'].isna() | ferias['fim'].isna()
+            recalcular |= ~invalida & ids.isin(ferias.loc[com_erro, 'id'])
+            ferias = ferias[~com_erro]
+
+    resultado.loc[invalida] = ["Admissão Inválida", "Erro", "ERROR"]
+    for linha in recalcular[recalcular].index:
+        resultado.loc[linha] = list(calcular_status_ferias_saldo(df_funcionarios.loc[linha], all_folgas_df))
+
+    # Em gozo: a primeira férias (na ordem dos registros) que cobre hoje.
+    em_gozo = ferias[(ferias['inicio'] <= hoje) & (hoje <= ferias['fim'])].drop_duplicates('id')
+    desde = ids.map(em_gozo.set_index('id')['inicio']) if not em_gozo.empty else pd.Series(pd.NaT, index=ids.index)
+    gozando = ~invalida & ~recalcular & desde.notna()
+    if gozando.any():
+        resultado.loc[gozando, 'periodo_referencia'] = "Em gozo desde " + desde[gozando].dt.strftime('%d/%m/%Y')
+        resultado.loc[gozando, 'status'] = "EM FÉRIAS"
+        resultado.loc[gozando, 'status_code'] = "ON_VACATION"
+
+    calcular = ~invalida & ~recalcular & ~gozando
+    if not calcular.any():
+        return resultado
+
+    # Grade de períodos: k = 0..(anos desde a admissão + 1). Assim como o laço original,
+    # que soma um ano de cada vez, uma admissão em 29/02 passa a 28/02 a partir do 2º período.
+    adm = admissao[calcular]
+    n_periodos = (hoje.year - adm.dt.year + 2).clip(lower=1)
+    grade = pd.DataFrame({'linha': adm.index.repeat(n_periodos)})
+    grade['k'] = grade.groupby('linha', sort=False).cumcount()
+    adm_grade = adm.loc[grade['linha']].reset_index(drop=True)
+    dia = adm_grade.dt.day.where(~((grade['k'] > 0) & (adm_grade.dt.month == 2) & (adm_grade.dt.day == 29)), 28)
+    grade['inicio_aq'] = pd.to_datetime(pd.DataFrame({'year': adm_grade.dt.year + grade['k'], 'month': adm_grade.dt.month, 'day': dia}))
+    grade['fim_aq'] = grade['inicio_aq'] + pd.DateOffset(years=1) - pd.Timedelta(days=1)
+    grade['fim_con'] = grade['fim_aq'] + pd.DateOffset(years=1)
+    grade['id'] = ids.loc[grade['linha']].to_numpy()
+
+    concluidos = grade[grade['fim_aq'] <= hoje].copy()
+    cruzado = concluidos[['linha', 'k', 'id', 'fim_aq', 'fim_con']].merge(ferias, on='id')
+    cruzado = cruzado[(cruzado['inicio'] > cruzado['fim_aq']) & (cruzado['inicio'] <= cruzado['fim_con'])]
+    dias = ((cruzado['fim'] - cruzado['inicio']).dt.days + 1).groupby([cruzado['linha'], cruzado['k']]).sum()
+    chave = pd.MultiIndex.from_arrays([concluidos['linha'], concluidos['k']])
+    concluidos['dias_gozados'] = dias.reindex(chave).fillna(0).astype(int).to_numpy()
+
+    pendentes = concluidos[concluidos['dias_gozados'] < 30]
+    mais_antigo = pendentes.drop_duplicates('linha').set_index('linha').reindex(adm.index)
+    qtd_pendentes = pendentes.groupby('linha').size().reindex(adm.index, fill_value=0)
+    proximo = grade.drop(index=concluidos.index).drop_duplicates('linha').set_index('linha').reindex(adm.index)
+
+    dias_ate_vencer = (mais_antigo['fim_con'] - hoje).dt.days
+    vencida = (qtd_pendentes >= 2) & (hoje >= mais_antigo['fim_con'])
+    vencendo = (qtd_pendentes >= 2) & ~vencida & (dias_ate_vencer <= 90)
+    pendente = (qtd_pendentes >= 1) & ~vencida & ~vencendo
+    parcial = pendente & (mais_antigo['dias_gozados'] > 0)
+    em_aquisicao = (qtd_pendentes == 0) & (hoje <= proximo['fim_aq'])
+
+    fim_con_str = mais_antigo['fim_con'].dt.strftime('%d/%m/%Y')
+    ref_antigo = mais_antigo['inicio_aq'].dt.strftime('%d/%m/%Y') + " a " + mais_antigo['fim_aq'].dt.strftime('%d/%m/%Y')
+    ref_proximo = proximo['inicio_aq'].dt.strftime('%d/%m/%Y') + " a " + proximo['fim_aq'].dt.strftime('%d/%m/%Y')
+    dias_str = mais_antigo['dias_gozados'].fillna(0).astype(int).astype(str)
+
+    condicoes = [vencida, vencendo, parcial, pendente, em_aquisicao]
+    resultado.loc[adm.index, 'periodo_referencia'] = np.select(
+        condicoes, ["Venceu em: " + fim_con_str, "Vencimento em: " + fim_con_str, ref_antigo, ref_antigo, ref_proximo], "N/A")
+    resultado.loc[adm.index, 'status'] = np.select(
+        condicoes, ["RISCO: 2ª FÉRIAS VENCIDA!", "RISCO: VENCIMENTO DE 2ª FÉRIAS!",
+                    "Parcialmente Agendada (" + dias_str + "/30)", "PENDENTE DE AGENDAMENTO", "Em Aquisição"], "Em dia")
+    resultado.loc[adm.index, 'status_code'] = np.select(
+        condicoes, ["RISK_EXPIRING", "RISK_EXPIRING", "SCHEDULED", "PENDING", "ACQUIRING"], "OK")
+    return resultado
+
+def estilo_status_ferias(df_exibicao, status_codes):
+    # Styler.apply(axis=None): uma única chamada devolve o CSS de todas as células.
+    css = 'background-color: ' + status_codes.map(CORES_STATUS_FERIAS).fillna('')
+    return pd.DataFrame({coluna: css for coluna in df_exibicao.columns}, index=df_exibicao.index)
+
+def get_abonadas_ano(employee_id, indice_ausencias):
     try:
-        current_year = date.today().year
-        if all_folgas_df.empty or 'id_funcionario' not in all_folgas_df.columns:
-            return 0
-        abonadas_funcionario = all_folgas_df[(all_folgas_df['id_funcionario'] == str(employee_id)) & (all_folgas_df['tipo'] == 'Abonada') & (pd.to_datetime(all_folgas_df['data_inicio']).dt.year == current_year)]
-        return len(abonadas_funcionario)
+        return len(ausencias.historico_funcionario(indice_ausencias, employee_id, tipos=['Abonada'], ano=date.today().year))
     except Exception:
         return 0
 
-def get_datas_abonadas_ano(employee_id, all_folgas_df):
+def get_datas_abonadas_ano(employee_id, indice_ausencias):
     try:
-        current_year = date.today().year
-        if all_folgas_df.empty or 'id_funcionario' not in all_folgas_df.columns:
-            return []
-        
-        abonadas_df = all_folgas_df[
-            (all_folgas_df['id_funcionario'] == str(employee_id)) & 
-            (all_folgas_df['tipo'] == 'Abonada') & 
-            (pd.to_datetime(all_folgas_df['data_inicio']).dt.year == current_year)
-        ]
-        
-        if abonadas_df.empty:
-            return []
-            
-        return [pd.to_datetime(d).strftime('%d/%m/%Y') for d in abonadas_df['data_inicio']]
+        abonadas = ausencias.historico_funcionario(indice_ausencias, employee_id, tipos=['Abonada'], ano=date.today().year)
+        return [abonada['inicio'].strftime('%d/%m/%Y') for abonada in abonadas]
     except Exception:
         return []
 
-def get_ultimas_ferias(employee_id, all_folgas_df):
+def get_ultimas_ferias(employee_id, indice_ausencias):
     try:
-        if all_folgas_df.empty or 'id_funcionario' not in all_folgas_df.columns:
+        if not indice_ausencias['tem_folgas']:
             return "Nenhum registro"
-        ferias_do_funcionario = all_folgas_df[(all_folgas_df['id_funcionario'] == str(employee_id)) & (all_folgas_df['tipo'] == 'Férias')].copy()
-        if ferias_do_funcionario.empty:
+        ferias = ausencias.historico_funcionario(indice_ausencias, employee_id, tipos=['Férias'])
+        if not ferias:
             return "Nenhuma férias registrada"
-        ferias_do_funcionario['data_inicio'] = pd.to_datetime(ferias_do_funcionario['data_inicio'])
-        ultima_ferias = ferias_do_funcionario.sort_values(by='data_inicio', ascending=False).iloc[0]
-        return ultima_ferias['data_inicio'].strftime('%d/%m/%Y')
+        return ferias[-1]['inicio'].strftime('%d/%m/%Y')
     except Exception:
         return "Erro"
 
@@ -807,8 +1691,8 @@ def modulo_rh():
             <p>Gestao de equipe, ferias, abonadas e cadastro de funcionarios</p>
         </div>
     """, unsafe_allow_html=True)
-    df_funcionarios = carregar_dados_firebase('funcionarios')
-    df_folgas = carregar_dados_firebase('folgas_ferias')
+    df_funcionarios, df_folgas, _ = carregar_em_paralelo('funcionarios', 'folgas_ferias', 'boletins')
+    indice_ausencias = carregar_indice_ausencias()
 
     if not df_funcionarios.empty:
         nome_map = {formatar_nome(nome): nome for nome in df_funcionarios['nome']}
@@ -822,7 +1706,13 @@ def modulo_rh():
     with tab_rh1:
         st.subheader("Registro de Férias e Abonadas")
         if lista_nomes_curtos:
-            nome_curto_selecionado = st.selectbox("Selecione o Funcionário", lista_nomes_curtos)
+            # A escolha é pelo id: nomes curtos repetidos não trocam o funcionário do registro.
+            nomes_por_id = dict(zip(df_funcionarios['id'].astype(str), df_funcionarios['nome']))
+            id_funcionario = st.selectbox(
+                "Selecione o Funcionário",
+                options=sorted(nomes_por_id, key=lambda id_func: formatar_nome(nomes_por_id[id_func])),
+                format_func=lambda id_func: formatar_nome(nomes_por_id[id_func]),
+            )
             tipo_evento = st.selectbox("Tipo de Evento", ["Férias", "Abonada"], key="tipo_evento_selector")
             
             if 'doc_data' not in st.session_state:
@@ -844,34 +1734,36 @@ def modulo_rh():
                 submit_evento = st.form_submit_button("Registrar Evento")
                 
                 if submit_evento:
-                    nome_completo = nome_map[nome_curto_selecionado]
+                    nome_completo = nomes_por_id[id_funcionario]
+                    conflitos = ausencias.sobreposicoes(indice_ausencias, id_funcionario, data_inicio, data_fim, tipos=ausencias.TIPOS_LICENCA)
                     if tipo_evento == "Férias" and data_inicio > data_fim:
                         st.error("A data de início não pode ser posterior à data de fim.")
+                    elif conflitos:
+                        periodos = ", ".join(f"{c['tipo']} de {c['inicio'].strftime('%d/%m/%Y')} a {c['fim'].strftime('%d/%m/%Y')}" for c in conflitos)
+                        st.error(f"{nome_completo} já possui ausência registrada nesse período: {periodos}.")
                     else:
                         try:
-                            id_funcionario = df_funcionarios[df_funcionarios['nome'] == nome_completo]['id'].iloc[0]
                             evento_id = str(int(time.time() * 1000))
-                            ref = db.reference(f'folgas_ferias/{evento_id}')
-                            ref.set({'id_funcionario': id_funcionario,'nome_funcionario': nome_completo,'tipo': tipo_evento,'data_inicio': data_inicio.strftime("%Y-%m-%d"),'data_fim': data_fim.strftime("%Y-%m-%d")})
+                            gravar_registro('folgas_ferias', evento_id, {'id_funcionario': id_funcionario,'nome_funcionario': nome_completo,'tipo': tipo_evento,'data_inicio': data_inicio.strftime("%Y-%m-%d"),'data_fim': data_fim.strftime("%Y-%m-%d")})
                             
                             log_atividade(st.session_state.get('username'), f"Registrou {tipo_evento}", f"Funcionário: {nome_completo}, Período: {data_inicio} a {data_fim}")
 
                             st.success(f"{tipo_evento} para {nome_completo} registrado com sucesso!")
                             
                             if tipo_evento == "Abonada":
-                                dados_func = df_funcionarios[df_funcionarios['id'] == id_funcionario].iloc[0]
+                                dados_func = df_funcionarios[df_funcionarios['id'].astype(str) == id_funcionario].iloc[0]
                                 doc_data = {'nome': dados_func.get('nome', ''),'funcao': dados_func.get('funcao', ''),'unidade': dados_func.get('unidade_trabalho', ''),'data_abonada': data_inicio.strftime('%d-%m-%Y'),}
                                 st.session_state.doc_data = doc_data
                             else:
                                 st.session_state.doc_data = None
                             
-                            st.cache_data.clear()
+                            recarregar_versoes_nos()
                             st.rerun()
                         except Exception as e:
                             st.error(f"Erro ao registrar evento: {e}")
 
             if st.session_state.doc_data:
-                word_bytes = create_abonada_word_report(st.session_state.doc_data)
+                word_bytes = relatorio_sob_demanda(create_abonada_word_report, st.session_state.doc_data, date.today(), modelo='abonada')
                 st.download_button(label="📥 Baixar Requerimento de Abonada (.docx)",data=word_bytes,file_name=f"Abonada_{st.session_state.doc_data['nome']}_{st.session_state.doc_data['data_abonada']}.docx",mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document")
         else:
             st.info("Nenhum funcionário cadastrado.")
@@ -908,17 +1800,23 @@ def modulo_rh():
                         submit_edit = st.form_submit_button("Salvar Alterações")
 
                         if submit_edit:
+                            conflitos_edit = [
+                                c for c in ausencias.sobreposicoes(indice_ausencias, dados_evento.get('id_funcionario'), data_inicio_edit, data_fim_edit, tipos=ausencias.TIPOS_LICENCA)
+                                if c['chave'] != str(evento_id)
+                            ]
                             if tipo_evento_edit == "Férias" and data_inicio_edit > data_fim_edit:
                                 st.error("A data de início não pode ser posterior à data de fim.")
+                            elif conflitos_edit:
+                                periodos = ", ".join(f"{c['tipo']} de {c['inicio'].strftime('%d/%m/%Y')} a {c['fim'].strftime('%d/%m/%Y')}" for c in conflitos_edit)
+                                st.error(f"Já existe ausência registrada nesse período: {periodos}.")
                             else:
                                 try:
-                                    ref = db.reference(f'folgas_ferias/{evento_id}')
-                                    ref.update({'data_inicio': data_inicio_edit.strftime("%Y-%m-%d"),'data_fim': data_fim_edit.strftime("%Y-%m-%d")})
+                                    atualizar_registro('folgas_ferias', evento_id, {'data_inicio': data_inicio_edit.strftime("%Y-%m-%d"),'data_fim': data_fim_edit.strftime("%Y-%m-%d")})
                                     
                                     log_atividade(st.session_state.get('username'), "Editou ausência", f"Registro: {dados_evento['label']}, Novas datas: {data_inicio_edit} a {data_fim_edit}")
                                     
                                     st.success("Registro atualizado com sucesso!")
-                                    st.cache_data.clear()
+                                    recarregar_versoes_nos()
                                     st.rerun()
                                 except Exception as e:
                                     st.error(f"Erro ao atualizar o registro: {e}")
@@ -929,10 +1827,10 @@ def modulo_rh():
                         st.warning("Tem certeza que deseja apagar este registro? Esta ação é irreversível.")
                         if st.button("Confirmar Deleção", key=f"del_folga_{evento_id}", type="primary"):
                             try:
-                                db.reference(f'folgas_ferias/{evento_id}').delete()
+                                remover_registro('folgas_ferias', evento_id)
                                 log_atividade(st.session_state.get('username'), "Deletou ausência", f"Registro apagado: {dados_evento['label']}")
                                 st.success("Registro apagado com sucesso!")
-                                st.cache_data.clear()
+                                recarregar_versoes_nos()
                                 time.sleep(1)
                                 st.rerun()
                             except Exception as e:
@@ -979,30 +1877,19 @@ def modulo_rh():
             st.subheader("Equipe e Status de Férias")
             if not df_funcionarios.empty and 'id' in df_funcionarios.columns:
                 
-                ferias_info_completa = [calcular_status_ferias_saldo(func, df_folgas) for _, func in df_funcionarios.iterrows()]
+                ferias_info_completa = calcular_status_ferias_equipe(df_funcionarios, df_folgas)
                 
                 df_display = df_funcionarios.copy()
                 df_display['nome_formatado'] = df_display['nome'].apply(formatar_nome)
-                df_display['Período Aquisitivo de Referência'] = [info[0] for info in ferias_info_completa]
-                df_display['Status Agendamento'] = [info[1] for info in ferias_info_completa]
-                df_display['status_code'] = [info[2] for info in ferias_info_completa] 
-                df_display['Abonadas no Ano'] = [get_abonadas_ano(func_id, df_folgas) for func_id in df_funcionarios['id']]
-
-                def style_status_code(code):
-                    color = ''
-                    if code == "PENDING": color = '#fff2cc'
-                    elif code == "SCHEDULED": color = '#d4e6f1'
-                    elif code == "ON_VACATION": color = '#d5f5e3'
-                    elif code == "RISK_EXPIRING": color = '#f5b7b1'
-                    return f'background-color: {color}'
+                df_display['Período Aquisitivo de Referência'] = ferias_info_completa['periodo_referencia']
+                df_display['Status Agendamento'] = ferias_info_completa['status']
+                df_display['status_code'] = ferias_info_completa['status_code']
+                df_display['Abonadas no Ano'] = [get_abonadas_ano(func_id, indice_ausencias) for func_id in df_funcionarios['id']]
 
                 df_para_exibir = df_display[['nome_formatado', 'funcao', 'Período Aquisitivo de Referência', 'Status Agendamento', 'Abonadas no Ano']]
                 df_renomeado = df_para_exibir.rename(columns={'nome_formatado': 'Nome', 'funcao': 'Função'})
                 
-                styler = df_renomeado.style.apply(
-                    lambda row: [style_status_code(df_display.loc[row.name, 'status_code'])] * len(row),
-                    axis=1
-                )
+                styler = df_renomeado.style.apply(estilo_status_ferias, status_codes=df_display['status_code'], axis=None)
                 
                 st.dataframe(
                     styler,
@@ -1047,10 +1934,10 @@ def modulo_rh():
                     st.divider()
                     st.markdown("**Histórico Recente:**")
 
-                    datas_abonadas = get_datas_abonadas_ano(dados_func.get('id'), df_folgas)
+                    datas_abonadas = get_datas_abonadas_ano(dados_func.get('id'), indice_ausencias)
                     st.markdown(f"- **Abonadas no ano ({len(datas_abonadas)}):** {', '.join(datas_abonadas) if datas_abonadas else 'Nenhuma'}")
                     
-                    ultimas_ferias = get_ultimas_ferias(dados_func.get('id'), df_folgas)
+                    ultimas_ferias = get_ultimas_ferias(dados_func.get('id'), indice_ausencias)
                     st.markdown(f"- **Últimas Férias:** {ultimas_ferias}")
             else:
                 st.info("Nenhum funcionário.")
@@ -1082,7 +1969,6 @@ def modulo_rh():
             if submit_funcionario and nome and funcao and unidade_trabalho:
                 try:
                     novo_id = str(int(time.time() * 1000))
-                    ref = db.reference(f'funcionarios/{novo_id}')
                     dados_novos = {
                         'id': novo_id, 'nome': nome, 'matricula': matricula, 
                         'telefone': telefone, 'funcao': funcao, 'unidade_trabalho': unidade_trabalho, 
@@ -1092,12 +1978,12 @@ def modulo_rh():
                         'numero_bota': numero_bota,
                         'numero_chave': numero_chave
                     }
-                    ref.set(dados_novos)
+                    gravar_registro('funcionarios', novo_id, dados_novos)
                     
                     log_atividade(st.session_state.get('username'), "Cadastrou novo funcionário", f"Nome: {nome}")
                     
                     st.success(f"Funcionário {nome} cadastrado com sucesso!")
-                    st.cache_data.clear(); st.rerun()
+                    recarregar_versoes_nos(); st.rerun()
                 except Exception as e:
                     st.error(f"Erro ao cadastrar funcionário: {e}")
         st.divider()
@@ -1141,13 +2027,12 @@ def modulo_rh():
                             'numero_bota': numero_bota_edit,
                             'numero_chave': numero_chave_edit
                         }
-                        ref = db.reference(f"funcionarios/{dados_func_originais['id']}")
-                        ref.update(dados_atualizados)
+                        atualizar_registro('funcionarios', dados_func_originais['id'], dados_atualizados)
                         
                         log_atividade(st.session_state.get('username'), "Editou funcionário", f"Nome: {nome_edit}")
                         
                         st.success("Dados do funcionário atualizados com sucesso!")
-                        st.cache_data.clear(); st.rerun()
+                        recarregar_versoes_nos(); st.rerun()
         st.divider()
         st.subheader("🚨 Deletar Funcionário")
         if lista_nomes_curtos:
@@ -1158,20 +2043,149 @@ def modulo_rh():
                 if st.button("Confirmar Deleção", type="primary"):
                     try:
                         id_func_deletar = df_funcionarios[df_funcionarios['nome'] == nome_completo_para_deletar]['id'].iloc[0]
-                        db.reference(f'funcionarios/{id_func_deletar}').delete()
-                        folgas_ref = db.reference('folgas_ferias')
-                        folgas_para_deletar = folgas_ref.order_by_child('id_funcionario').equal_to(id_func_deletar).get()
-                        if folgas_para_deletar:
-                            for key in folgas_para_deletar:
-                                folgas_ref.child(key).delete()
+                        folgas_para_deletar = [
+                            chave for chave, folga in registros_espelho('folgas_ferias').items()
+                            if isinstance(folga, dict) and str(folga.get('id_funcionario')) == str(id_func_deletar)
+                        ]
+                        # Funcionário e ausências saem na mesma requisição: ou tudo, ou nada.
+                        gravar_em_lote(
+                            operacao_remover('funcionarios', id_func_deletar),
+                            *[operacao_remover('folgas_ferias', chave) for chave in folgas_para_deletar]
+                        )
                         
                         log_atividade(st.session_state.get('username'), "Deletou funcionário", f"Nome: {nome_completo_para_deletar}")
 
                         st.success(f"Funcionário {nome_completo_para_deletar} deletado com sucesso.")
-                        st.cache_data.clear(); st.rerun()
+                        recarregar_versoes_nos(); st.rerun()
                     except Exception as e:
                         st.error(f"Ocorreu um erro ao deletar: {e}")
 
+# --- CONSULTAS DE DENÚNCIAS (PAGINADAS E FILTRADAS) ---
+# As telas buscam só o que exibem: as últimas N por data (todas ou de um status) ou as
+# de um período, via order_by_child no servidor. Exigem ".indexOn": ["data_denuncia"]
+# em 'denuncias'; sem o índice, a consulta é respondida filtrando o espelho local.
+# As chaves (protocolo = número + ano) não seguem a ordem cronológica, por isso a
+# paginação usa data_denuncia e não order_by_key. O histórico completo é opcional.
+DENUNCIAS_POR_PAGINA = 50
+STATUS_DENUNCIA = ["Não atendida", "Atendida", "Arquivada"]
+
+def _padronizar_denuncias(denuncias_data):
+    denuncias_padronizadas = []
+    for protocolo, dados in (denuncias_data or {}).items():
+        if isinstance(dados, dict):
+            dados = dict(dados)
+            dados['protocolo'] = protocolo
+            dados.setdefault('data_denuncia', '')
+            dados.setdefault('logradouro', dados.get('rua', ''))
+            dados.setdefault('conclusao_atendimento', '')
+            dados.setdefault('cep', '')
+            dados.setdefault('status', 'Não atendida')
+            dados.setdefault('auto_infracao', 'Não')
+            dados.setdefault('protocolo_auto_infracao', '')
+            dados.setdefault('auto_imposicao_penalidade', 'Não')
+            dados.setdefault('protocolo_auto_imposicao_penalidade', '')
+            dados.setdefault('responsavel_atendimento', '')
+            dados.setdefault('relatorio_atendimento', '')
+            dados.setdefault('data_atendimento', None)
+            dados.setdefault('responsavel_imovel', '')
+            dados.setdefault('rg_responsavel', '')
+            dados.setdefault('cpf_responsavel', '')
+            denuncias_padronizadas.append(dados)
+    if not denuncias_padronizadas:
+        return pd.DataFrame()
+    df = pd.DataFrame(denuncias_padronizadas)
+    return df.sort_values(by=['data_denuncia', 'protocolo'], ascending=False).reset_index(drop=True)
+
+def _consultar_denuncias(consulta, filtro_local, limite=None):
+    # Com o espelho ao vivo, filtra a cópia do processo; senão consulta o banco.
+    if not espelho_ao_vivo('denuncias'):
+        try:
+            return consulta(db.reference('denuncias')).get() or {}
+        except Exception:
+            pass
+    filtrados = [(k, v) for k, v in registros_espelho('denuncias').items() if isinstance(v, dict) and filtro_local(v)]
+    if limite:
+        filtrados = sorted(filtrados, key=lambda item: (item[1].get('data_denuncia') or '', item[0]))[-limite:]
+    return dict(filtrados)
+
+def _ultimas_denuncias_com_status(status, limite):
+    # O Realtime Database ordena por um só campo: busca as últimas por data_denuncia
+    # numa janela que dobra até reunir `limite` denúncias com o status ou esgotar o nó.
+    janela = limite * 2
+    while True:
+        recentes = _consultar_denuncias(
+            lambda ref: ref.order_by_child('data_denuncia').limit_to_last(janela),
+            lambda d: True, limite=janela)
+        com_status = [
+            (k, v) for k, v in recentes.items()
+            if isinstance(v, dict) and v.get('status', 'Não atendida') == status
+        ]
+        if len(com_status) >= limite or len(recentes) < janela:
+            com_status.sort(key=lambda item: (item[1].get('data_denuncia') or '', item[0]))
+            return dict(com_status[-limite:])
+        janela *= 2
+
+@st.cache_data(max_entries=50, show_spinner=False)
+def _carregar_denuncias_versionado(modo, parametro, versao):
+    try:
+        if modo == 'recentes':
+            dados = _consultar_denuncias(
+                lambda ref: ref.order_by_child('data_denuncia').limit_to_last(parametro),
+                lambda d: True, limite=parametro)
+        elif modo == 'status':
+            status, limite = parametro
+            dados = _ultimas_denuncias_com_status(status, limite)
+        elif modo == 'periodo':
+            inicio, fim = parametro
+            dados = _consultar_denuncias(
+                lambda ref: ref.order_by_child('data_denuncia').start_at(inicio).end_at(fim),
+                lambda d: inicio <= (d.get('data_denuncia') or '') <= fim)
+        else:
+            dados = registros_espelho('denuncias')
+        return _padronizar_denuncias(dados)
+    except Exception as e:
+        st.error(f"Erro ao carregar denúncias: {e}")
+        return pd.DataFrame()
+
+def carregar_denuncias(modo='completo', parametro=None):
+    # modo: 'recentes' (parametro = quantidade), 'status' (parametro = (status, quantidade)),
+    # 'periodo' (parametro = (inicio, fim) em "%Y-%m-%d") ou 'completo'.
+    return _carregar_denuncias_versionado(modo, parametro, versao_no('denuncias'))
+
+def exportacao_em_lote(df_resumo):
+    col_status, col_inicio, col_fim = st.columns(3)
+    status_lote = col_status.multiselect("Status", options=STATUS_DENUNCIA, default=STATUS_DENUNCIA, key="lote_status")
+    datas = pd.to_datetime(df_resumo['data_denuncia'], errors='coerce')
+    inicio_padrao = datas.min().date() if datas.notna().any() else date.today()
+    fim_padrao = datas.max().date() if datas.notna().any() else date.today()
+    inicio_lote = col_inicio.date_input("De", value=inicio_padrao, format="DD/MM/YYYY", key="lote_inicio")
+    fim_lote = col_fim.date_input("Até", value=fim_padrao, format="DD/MM/YYYY", key="lote_fim")
+
+    selecao = df_resumo[df_resumo['status'].isin(status_lote) & (datas.dt.date >= inicio_lote) & (datas.dt.date <= fim_lote)]
+    st.caption(f"{len(selecao)} relatório(s) no filtro.")
+    if st.button("Gerar ZIP", disabled=selecao.empty, key="lote_gerar"):
+        registros = selecao.astype(object).where(selecao.notna(), '').to_dict('records')
+        barra = st.progress(0.0, text="Gerando relatórios...")
+        buffer = io.BytesIO()
+        try:
+            gerados = relatorios.exportar_relatorios_zip(
+                registros, buffer,
+                progresso=lambda feitos, total: barra.progress(feitos / total, text=f"{feitos} de {total} relatórios"))
+            log_atividade(st.session_state.get('username'), "Exportou relatórios em lote", f"{gerados} relatório(s), {inicio_lote:%d/%m/%Y} a {fim_lote:%d/%m/%Y}")
+        except Exception as e:
+            st.error(f"Erro ao gerar os relatórios: {e}")
+            return
+        finally:
+            barra.empty()
+        # Os bytes vão só para o botão, não para o session_state; com on_click="ignore"
+        # o download não provoca um rerun que faria o botão sumir.
+        st.success(f"{gerados} relatório(s) gerado(s).")
+        st.download_button(
+            "📥 Baixar ZIP", data=buffer.getvalue(),
+            file_name=f"Relatorios_Inspecao_{inicio_lote:%Y%m%d}_{fim_lote:%Y%m%d}.zip",
+            mime="application/zip", on_click="ignore", key="lote_baixar",
+        )
+
 def modulo_denuncias():
     st.markdown("""
         <div class="mod-header">
@@ -1196,65 +2210,6 @@ def modulo_denuncias():
     else:
         lista_responsaveis = []
         
-    @st.cache_data
-    def geocode_addresses(df):
-        geolocator = Nominatim(user_agent=f"streamlit_app_{int(time.time())}")
-        latitudes, longitudes = [], []
-        df_copy = df.copy()
-        for col in ['logradouro', 'numero', 'bairro', 'cep']:
-            if col not in df_copy.columns: df_copy[col] = ''
-        for index, row in df_copy.iterrows():
-            address = f"{row.get('logradouro', '')}, {row.get('numero', '')}, {row.get('bairro', '')}, Guaratinguetá, SP, Brasil"
-            try:
-                location = geolocator.geocode(address, timeout=10)
-                if location:
-                    latitudes.append(location.latitude)
-                    longitudes.append(location.longitude)
-                else:
-                    latitudes.append(None)
-                    longitudes.append(None)
-                time.sleep(1)
-            except Exception as e:
-                latitudes.append(None)
-                longitudes.append(None)
-        df_copy['lat'], df_copy['lon'] = latitudes, longitudes
-        return df_copy.dropna(subset=['lat', 'lon'])
-
-    def carregar_e_cachear_denuncias():
-        ref = db.reference('denuncias')
-        denuncias_data = ref.get()
-        if denuncias_data:
-            denuncias_padronizadas = []
-            for protocolo, dados in denuncias_data.items():
-                if isinstance(dados, dict):
-                    dados['protocolo'] = protocolo
-                    dados.setdefault('logradouro', dados.get('rua', ''))
-                    dados.setdefault('conclusao_atendimento', '')
-                    dados.setdefault('cep', '')
-                    dados.setdefault('status', 'Não atendida')
-                    dados.setdefault('auto_infracao', 'Não')
-                    dados.setdefault('protocolo_auto_infracao', '')
-                    dados.setdefault('auto_imposicao_penalidade', 'Não')
-                    dados.setdefault('protocolo_auto_imposicao_penalidade', '')
-                    dados.setdefault('responsavel_atendimento', '')
-                    dados.setdefault('relatorio_atendimento', '')
-                    dados.setdefault('data_atendimento', None)
-                    dados.setdefault('responsavel_imovel', '')
-                    dados.setdefault('rg_responsavel', '')
-                    dados.setdefault('cpf_responsavel', '')
-                    denuncias_padronizadas.append(dados)
-            df = pd.DataFrame(denuncias_padronizadas)
-            if 'protocolo' in df.columns:
-                df['protocolo_int'] = df['protocolo'].apply(lambda x: int(x) if str(x).isdigit() else 0)
-                df = df.sort_values(by='protocolo_int', ascending=False)
-                del df['protocolo_int']
-            st.session_state.denuncias_df = df
-        else:
-            st.session_state.denuncias_df = pd.DataFrame()
-
-    if 'denuncias_df' not in st.session_state:
-        carregar_e_cachear_denuncias()
-    
     tab1, tab2, tab3 = st.tabs(["📋 Registrar Denúncia", "🛠️ Gerenciamento", "📊 Dashboard"])
     
     with tab1:
@@ -1288,32 +2243,55 @@ def modulo_denuncias():
                         "auto_infracao": "Não", "protocolo_auto_infracao": "", 
                         "auto_imposicao_penalidade": "Não", "protocolo_auto_imposicao_penalidade": "", 
                         "responsavel_atendimento": "", "relatorio_atendimento": "", "conclusao_atendimento": "",
-                        "data_atendimento": None, "responsavel_imovel": "", "rg_responsavel": "", "cpf_responsavel": ""
+                        "data_atendimento": None, "responsavel_imovel": "", "rg_responsavel": "", "cpf_responsavel": "",
+                        "geocode_status": GEOCODE_PENDENTE
                     }
-                    ref = db.reference(f'denuncias/{protocolo_gerado}')
-                    ref.set(nova_denuncia)
+                    gravar_registro('denuncias', protocolo_gerado, nova_denuncia)
+                    enfileirar_geocodificacao([protocolo_gerado])
                     
                     log_atividade(st.session_state.get('username'), "Registrou nova denúncia", f"Protocolo: {protocolo_gerado}")
 
                     st.success(f"Denúncia registrada com sucesso! Protocolo: {protocolo_gerado}")
-                    carregar_e_cachear_denuncias()
-                    st.cache_data.clear()
+                    recarregar_versoes_nos()
                     st.rerun()
             else:
                 st.warning("Por favor, preencha os campos obrigatórios (Motivo, Bairro, Logradouro).")
         st.divider()
         st.subheader("Denúncias Recentes")
-        if 'denuncias_df' in st.session_state and not st.session_state.denuncias_df.empty:
+        if 'denuncias_limite' not in st.session_state:
+            st.session_state.denuncias_limite = DENUNCIAS_POR_PAGINA
+        df_recentes = carregar_denuncias('recentes', st.session_state.denuncias_limite)
+        if not df_recentes.empty:
             cols = ['protocolo', 'data_denuncia', 'motivo_denuncia', 'bairro', 'logradouro', 'numero']
-            df_display = st.session_state.denuncias_df[[c for c in cols if c in st.session_state.denuncias_df.columns]]
+            df_display = df_recentes[[c for c in cols if c in df_recentes.columns]]
             df_display = df_display.rename(columns={'protocolo': 'PROTOCOLO','data_denuncia': 'DATA','motivo_denuncia': 'MOTIVO','bairro': 'BAIRRO','logradouro': 'LOGRADOURO','numero': 'Nº'})
             st.dataframe(df_display,hide_index=True,use_container_width=True)
+            if len(df_recentes) >= st.session_state.denuncias_limite:
+                if st.button(f"Carregar mais {DENUNCIAS_POR_PAGINA}", key="denuncias_carregar_mais"):
+                    st.session_state.denuncias_limite += DENUNCIAS_POR_PAGINA
+                    st.rerun()
 
     with tab2:
-        if 'denuncias_df' in st.session_state and not st.session_state.denuncias_df.empty:
-            protocolo_selecionado = st.selectbox("Selecione o Protocolo para Gerenciar", options=st.session_state.denuncias_df['protocolo'].tolist(), index=None, placeholder="Selecione um protocolo...")
+        # Padrão: todas as denúncias. Com ou sem filtro de status, a lista vem das mais
+        # recentes para as mais antigas, em páginas de DENUNCIAS_POR_PAGINA.
+        filtro_status_ger = st.selectbox("Exibir denúncias", options=["Todas"] + STATUS_DENUNCIA, key="filtro_status_gerenciamento")
+        if st.session_state.get('denuncias_filtro_gerenciamento') != filtro_status_ger:
+            st.session_state.denuncias_filtro_gerenciamento = filtro_status_ger
+            st.session_state.denuncias_limite_gerenciamento = DENUNCIAS_POR_PAGINA
+        limite_ger = st.session_state.denuncias_limite_gerenciamento
+        if filtro_status_ger in STATUS_DENUNCIA:
+            df_gerenciamento = carregar_denuncias('status', (filtro_status_ger, limite_ger))
+        else:
+            df_gerenciamento = carregar_denuncias('recentes', limite_ger)
+        if len(df_gerenciamento) >= limite_ger:
+            st.caption(f"Exibindo as {len(df_gerenciamento)} denúncias mais recentes.")
+            if st.button(f"Carregar mais {DENUNCIAS_POR_PAGINA}", key="denuncias_gerenciamento_carregar_mais"):
+                st.session_state.denuncias_limite_gerenciamento += DENUNCIAS_POR_PAGINA
+                st.rerun()
+        if not df_gerenciamento.empty:
+            protocolo_selecionado = st.selectbox("Selecione o Protocolo para Gerenciar", options=df_gerenciamento['protocolo'].tolist(), index=None, placeholder="Selecione um protocolo...")
             if protocolo_selecionado:
-                dados_denuncia = st.session_state.denuncias_df[st.session_state.denuncias_df['protocolo'] == protocolo_selecionado].iloc[0]
+                dados_denuncia = df_gerenciamento[df_gerenciamento['protocolo'] == protocolo_selecionado].iloc[0]
                 with st.form("gerenciamento_form"):
                     st.subheader(f"Atualizando Protocolo: {protocolo_selecionado}")
                     
@@ -1328,6 +2306,16 @@ def modulo_denuncias():
                         data_retorno = data_atendimento + timedelta(days=14)
                         st.info(f"ℹ️ Data de Retorno: {data_retorno.strftime('%d/%m/%Y')}")
 
+                    st.divider()
+                    st.markdown("**Endereço**")
+                    col_end1, col_end2 = st.columns([3, 1])
+                    with col_end1:
+                        logradouro_edit = st.text_input("Logradouro", value=dados_denuncia.get('logradouro', '') or '')
+                        bairro_edit = st.text_input("Bairro", value=dados_denuncia.get('bairro', '') or '')
+                    with col_end2:
+                        numero_edit = st.text_input("Nº", value=dados_denuncia.get('numero', '') or '')
+                        cep_edit = st.text_input("CEP", value=dados_denuncia.get('cep', '') or '')
+
                     st.divider()
                     st.markdown("**Dados do Responsável pelo Imóvel**")
                     responsavel_imovel = st.text_input("Nome do Responsável do Imóvel", value=dados_denuncia.get('responsavel_imovel', ''))
@@ -1369,30 +2357,45 @@ def modulo_denuncias():
                                 "auto_imposicao_penalidade": auto_penalidade, 
                                 "protocolo_auto_imposicao_penalidade": protocolo_auto_penalidade
                             }
-                            ref = db.reference(f'denuncias/{protocolo_selecionado}')
-                            ref.update(dados_para_atualizar)
+                            endereco_editado = {"logradouro": logradouro_edit, "numero": numero_edit, "bairro": bairro_edit, "cep": cep_edit}
+                            endereco_mudou = any(str(dados_denuncia.get(campo, '') or '') != valor for campo, valor in endereco_editado.items())
+                            if endereco_mudou:
+                                dados_para_atualizar.update(endereco_editado)
+                                dados_para_atualizar.update({"lat": None, "lon": None, "quadra": None, "geocode_status": GEOCODE_PENDENTE, "geocode_fonte": None, "geocode_precisao": None, "geocode_tentativas": 0})
+                            atualizar_registro('denuncias', protocolo_selecionado, dados_para_atualizar)
+                            if endereco_mudou:
+                                enfileirar_geocodificacao([protocolo_selecionado])
                             
                             log_atividade(st.session_state.get('username'), "Atualizou denúncia", f"Protocolo: {protocolo_selecionado}, Status: {status}")
 
                             st.success(f"Denúncia {protocolo_selecionado} atualizada!")
-                            carregar_e_cachear_denuncias()
-                            st.cache_data.clear()
+                            recarregar_versoes_nos()
                             st.rerun()
 
                 with st.expander("🚨 Deletar Denúncia"):
                     if st.button("Eu entendo o risco, deletar denúncia", type="primary"):
-                        ref = db.reference(f'denuncias/{protocolo_selecionado}'); ref.delete()
+                        remover_registro('denuncias', protocolo_selecionado)
                         
                         log_atividade(st.session_state.get('username'), "Deletou denúncia", f"Protocolo: {protocolo_selecionado}")
 
                         st.success(f"Denúncia {protocolo_selecionado} deletada!")
-                        carregar_e_cachear_denuncias(); st.cache_data.clear(); st.rerun()
+                        recarregar_versoes_nos(); st.rerun()
         else:
-            st.info("Nenhuma denúncia registrada para gerenciar.")
+            st.info("Nenhuma denúncia encontrada para gerenciar.")
 
     with tab3:
-        if 'denuncias_df' in st.session_state and not st.session_state.denuncias_df.empty:
-            df_resumo = st.session_state.denuncias_df.copy()
+        col_periodo, col_historico = st.columns([1, 2])
+        with col_historico:
+            historico_completo = st.checkbox("Carregar histórico completo", key="denuncias_historico_completo")
+        with col_periodo:
+            ano_atual_dash = date.today().year
+            ano_dashboard = st.selectbox("Ano", options=list(range(ano_atual_dash, ano_atual_dash - 6, -1)), key="denuncias_ano_dashboard", disabled=historico_completo)
+        if historico_completo:
+            df_resumo = carregar_denuncias('completo')
+        else:
+            df_resumo = carregar_denuncias('periodo', (f"{ano_dashboard}-01-01", f"{ano_dashboard}-12-31"))
+        if not df_resumo.empty:
+            df_resumo = df_resumo.copy()
             st.subheader("Métricas Gerais"); status_counts = df_resumo['status'].value_counts()
             col1, col2, col3, col4 = st.columns(4)
             col1.metric("Denúncias Totais", len(df_resumo)); col2.metric("Atendidas", status_counts.get('Atendida', 0))
@@ -1402,13 +2405,15 @@ def modulo_denuncias():
             protocolo_relatorio = st.selectbox("Selecione um Protocolo para gerar relatório", options=df_resumo['protocolo'].tolist(), index=None, placeholder="Escolha o protocolo...")
             if protocolo_relatorio:
                 dados_relatorio = df_resumo[df_resumo['protocolo'] == protocolo_relatorio].iloc[0]
-                report_bytes = create_word_report(dados_relatorio)
-                st.download_button(label="📥 Baixar Relatório em Word", data=report_bytes, file_name=f"Relatorio_Inspecao_{protocolo_relatorio}.docx", mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document")
+                report_bytes = relatorio_sob_demanda(relatorios.create_word_report, dados_relatorio, modelo='inspecao')
+                st.download_button(label="📥 Baixar Relatório em Word", data=report_bytes, file_name=relatorios.nome_relatorio_inspecao(protocolo_relatorio), mime=relatorios.MIME_DOCX)
+            with st.expander("📦 Exportar relatórios em lote (.zip)"):
+                exportacao_em_lote(df_resumo)
             st.divider()
             st.subheader("Tabela de Resumo")
-            cols_resumo = ['protocolo', 'data_denuncia', 'motivo_denuncia', 'status', 'responsavel_atendimento', 'data_atendimento', 'responsavel_imovel']
+            cols_resumo = ['protocolo', 'data_denuncia', 'motivo_denuncia', 'status', 'quadra', 'responsavel_atendimento', 'data_atendimento', 'responsavel_imovel']
             df_resumo_display = df_resumo[[c for c in cols_resumo if c in df_resumo.columns]]
-            st.dataframe(df_resumo_display.rename(columns={'protocolo': 'Protocolo', 'data_denuncia': 'Data Denúncia', 'motivo_denuncia': 'Motivo', 'status': 'Status', 'responsavel_atendimento': 'Resp. Atendimento', 'data_atendimento': 'Data Atendimento', 'responsavel_imovel': 'Resp. Imóvel'}), use_container_width=True)
+            st.dataframe(df_resumo_display.rename(columns={'protocolo': 'Protocolo', 'data_denuncia': 'Data Denúncia', 'motivo_denuncia': 'Motivo', 'status': 'Status', 'quadra': 'Quadra', 'responsavel_atendimento': 'Resp. Atendimento', 'data_atendimento': 'Data Atendimento', 'responsavel_imovel': 'Resp. Imóvel'}), use_container_width=True)
             st.divider()
             st.subheader("Análise Gráfica")
             col1, col2 = st.columns(2)
@@ -1430,17 +2435,36 @@ def modulo_denuncias():
                 st.plotly_chart(fig_pie, use_container_width=True)
             st.divider()
             st.subheader("Geolocalização das Denúncias")
-            with st.spinner("Geocodificando endereços..."):
-                df_mapeado = geocode_addresses(df_resumo)
+            # Lê as coordenadas gravadas pelo geocodificador em segundo plano.
+            df_geo_denuncias = df_resumo
+            enfileirar_denuncias_sem_coordenadas(df_geo_denuncias)
+            if {'lat', 'lon'}.issubset(df_geo_denuncias.columns):
+                df_mapeado = df_geo_denuncias.dropna(subset=['lat', 'lon'])
+            else:
+                df_mapeado = pd.DataFrame()
+            status_geo = df_geo_denuncias['geocode_status'] if 'geocode_status' in df_geo_denuncias.columns else pd.Series(dtype=object)
+            aguardando = int((~geocodificacao_encerrada(df_geo_denuncias)).sum())
+            nao_encontradas = int((geocodificacao_encerrada(df_geo_denuncias) & (status_geo != 'ok')).sum()) if not status_geo.empty else 0
+            if aguardando:
+                st.caption(f"⏳ {aguardando} denúncia(s) aguardando geocodificação; o mapa é atualizado conforme forem processadas.")
+            if nao_encontradas:
+                st.caption(f"📍 {nao_encontradas} endereço(s) não localizado(s).")
             if not df_mapeado.empty:
                 st.map(df_mapeado, latitude='lat', longitude='lon', size=10)
             else:
                 st.warning("Não foi possível geolocalizar nenhum endereço.")
         else:
-            st.info("Nenhuma denúncia registrada.")
+            st.info("Nenhuma denúncia registrada no período.")
 
 # --- MÓDULO DO BOLETIM (LAYOUT CORRIGIDO) ---
-def gerar_pdf_pe_ie(df_cadastros, tipo_filtro):
+# Altura do mapa de atividades; a largura acompanha a página (use_container_width).
+ALTURA_MAPA_ATIVIDADES_PX = 600
+
+
+def gerar_pdf_pe_ie(df_cadastros, tipo_filtro, resumos=None, data_referencia=None):
+    # resumos: {'P.E': resumo da quinzena, 'I.E': resumo do trimestre}, de carregar_resumo_pe_ie.
+    # data_referencia define a quinzena/trimestre do título; vem como argumento para
+    # entrar na chave do cache de relatórios.
     buffer = io.BytesIO()
     doc = SimpleDocTemplate(buffer, pagesize=landscape(A4), topMargin=15*mm, bottomMargin=15*mm, leftMargin=15*mm, rightMargin=15*mm)
 
@@ -1450,7 +2474,7 @@ def gerar_pdf_pe_ie(df_cadastros, tipo_filtro):
     style_cell = ParagraphStyle('CellPE', parent=styles['Normal'], fontSize=9, leading=12)
     style_header = ParagraphStyle('HeaderPE', parent=styles['Normal'], fontSize=9, leading=12, textColor=colors.white, alignment=TA_CENTER)
 
-    hoje = date.today()
+    hoje = data_referencia or date.today()
     meses_pt = ["Janeiro", "Fevereiro", "Marco", "Abril", "Maio", "Junho", "Julho", "Agosto", "Setembro", "Outubro", "Novembro", "Dezembro"]
     nome_mes = meses_pt[hoje.month - 1]
     quinzena_num = "1a" if hoje.day <= 15 else "2a"
@@ -1486,6 +2510,12 @@ def gerar_pdf_pe_ie(df_cadastros, tipo_filtro):
             titulo_texto = f"Imovel Especial (I.E) — {trimestre_num}o Trimestre de {hoje.year}"
             subtitulo_texto = f"Frequencia: Trimestral | {trimestre_num}o Trimestre de {hoje.year}"
 
+        resumo = (resumos or {}).get(tipo)
+        visitados = visitas.visitados_no_resumo(resumo)
+        if resumo is not None:
+            feitos = sum(1 for chave in df_tipo.index if str(chave) in visitados)
+            subtitulo_texto += f" | Realizados: {feitos} de {len(df_tipo)} | Com criadouro: {resumo.get('positivos', 0)} | Com tratamento: {resumo.get('tratamentos', 0)}"
+
         story.append(Paragraph(titulo_texto, style_title))
         story.append(Paragraph(subtitulo_texto, style_subtitle))
 
@@ -1496,11 +2526,12 @@ def gerar_pdf_pe_ie(df_cadastros, tipo_filtro):
             Paragraph("<b>Amostras</b>", style_header),
             Paragraph("<b>Positivo</b>", style_header),
             Paragraph("<b>Data do Tratamento</b>", style_header),
+            Paragraph("<b>Situacao</b>", style_header),
         ]
 
         table_data = [header_row]
 
-        for _, row in df_tipo.iterrows():
+        for chave, row in df_tipo.iterrows():
             table_data.append([
                 Paragraph(str(row.get('numero_cadastro', '')), style_cell),
                 Paragraph(str(row.get('nome_fantasia', '')), style_cell),
@@ -1508,9 +2539,10 @@ def gerar_pdf_pe_ie(df_cadastros, tipo_filtro):
                 "",  
                 "",  
                 "",  
+                Paragraph("Feito" if str(chave) in visitados else "", style_cell),
             ])
 
-        col_widths = [55*mm, 80*mm, 35*mm, 30*mm, 30*mm, 50*mm]
+        col_widths = [40*mm, 75*mm, 30*mm, 28*mm, 28*mm, 42*mm, 25*mm]
 
         table = Table(table_data, colWidths=col_widths, repeatRows=1)
         table.setStyle(TableStyle([
@@ -1538,44 +2570,74 @@ def gerar_pdf_pe_ie(df_cadastros, tipo_filtro):
     return buffer.getvalue()
 
 
-def gerar_pdf_historico_boletins(df_boletins, quinzena, mes, ano):
+MESES_PDF = ["Janeiro", "Fevereiro", "Marco", "Abril", "Maio", "Junho", "Julho", "Agosto", "Setembro", "Outubro", "Novembro", "Dezembro"]
+LINHAS_POR_BLOCO_PDF = 200
+
+def periodo_quinzena(quinzena, mes, ano):
+    if quinzena == 1:
+        inicio, fim = date(ano, mes, 1), date(ano, mes, 15)
+    else:
+        inicio, fim = date(ano, mes, 16), date(ano, mes, cal_mod.monthrange(ano, mes)[1])
+    return (inicio, fim, f"{quinzena}a Quinzena de {MESES_PDF[mes - 1]} de {ano}")
+
+def periodos_quinzenas_ano(ano):
+    return [periodo_quinzena(quinzena, mes, ano) for mes in range(1, 13) for quinzena in (1, 2)]
+
+def _vazio(valor):
+    return valor is None or (isinstance(valor, float) and np.isnan(valor)) or valor == '' or valor == []
+
+def _colunas_historico_pe_ie(df):
+    # Normaliza de uma vez as colunas que o PDF usa; as linhas da tabela e o resumo
+    # saem destas mesmas séries, sem iterrows nem apply por linha.
+    def coluna(nome):
+        return df[nome] if nome in df.columns else pd.Series(None, index=df.index, dtype=object)
+
+    def juntar(valor):
+        if isinstance(valor, list):
+            return "<br/>".join(str(v) for v in valor)
+        return "" if _vazio(valor) else str(valor)
+
+    def equipes(valor):
+        if not isinstance(valor, list):
+            return ""
+        return "<br/>".join(
+            f"Eq{i + 1}: {', '.join(formatar_nome(m) for m in eq.get('membros', []))}"
+            for i, eq in enumerate(valor) if isinstance(eq, dict))
+
+    criadouro = coluna('criadouro_encontrado').eq(True)
+    tratamento = coluna('tratamento_realizado').eq(True)
+    data_tratamento = pd.to_datetime(coluna('data_tratamento'), errors='coerce')
+    recipientes = coluna('recipientes').map(juntar)
+    return pd.DataFrame({
+        'data_dt': df['data_dt'],
+        'data': df['data_dt'].map(lambda d: d.strftime('%d/%m/%Y')),
+        'imoveis': coluna('imoveis_trabalhados').map(juntar),
+        'equipes': coluna('equipes').map(equipes),
+        'criadouro': np.where(criadouro, "Sim", "Nao"),
+        'recipientes': recipientes.where(recipientes != "", "-"),
+        'tratamento': np.select(
+            [tratamento & data_tratamento.notna(), tratamento, criadouro],
+            ["Sim - " + data_tratamento.dt.strftime('%d/%m/%Y').fillna(''), "Sim", "Nao"], default="-"),
+        'observacoes': coluna('observacoes').map(lambda v: "-" if _vazio(v) else str(v)),
+        'tem_criadouro': criadouro,
+        'tem_tratamento': tratamento,
+    }, index=df.index)
+
+def gerar_pdf_historico_boletins(df_boletins, periodos):
+    """PDF do histórico de boletins P.E/I.E para uma lista de períodos (inicio, fim, rotulo),
+    como uma quinzena, as 24 quinzenas de um ano ou um intervalo livre. As tabelas são
+    quebradas em blocos de LINHAS_POR_BLOCO_PDF linhas, e as páginas vão sendo fechadas
+    no canvas à medida que os blocos são gerados (relatorios.escrever_pdf_em_blocos)."""
     buffer = io.BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=landscape(A4), topMargin=15*mm, bottomMargin=15*mm, leftMargin=12*mm, rightMargin=12*mm)
 
     styles = getSampleStyleSheet()
     style_title = ParagraphStyle('TitleHist', parent=styles['Title'], fontSize=14, spaceAfter=4*mm, textColor=colors.HexColor('#1B4F72'), alignment=TA_CENTER)
     style_subtitle = ParagraphStyle('SubHist', parent=styles['Normal'], fontSize=10, spaceAfter=6*mm, textColor=colors.HexColor('#566573'), alignment=TA_CENTER)
+    style_periodo = ParagraphStyle('PeriodoHist', parent=styles['Heading3'], fontSize=10, spaceBefore=4*mm, spaceAfter=2*mm, textColor=colors.HexColor('#1B4F72'))
     style_cell = ParagraphStyle('CellHist', parent=styles['Normal'], fontSize=8, leading=10)
     style_cell_center = ParagraphStyle('CellHistC', parent=styles['Normal'], fontSize=8, leading=10, alignment=TA_CENTER)
     style_header = ParagraphStyle('HeaderHist', parent=styles['Normal'], fontSize=8, leading=10, textColor=colors.white, alignment=TA_CENTER)
-
-    meses_pt = ["Janeiro", "Fevereiro", "Marco", "Abril", "Maio", "Junho", "Julho", "Agosto", "Setembro", "Outubro", "Novembro", "Dezembro"]
-    nome_mes = meses_pt[mes - 1]
-    quinzena_label = f"{quinzena}a Quinzena de {nome_mes} de {ano}"
-
-    if quinzena == 1:
-        dia_inicio = date(ano, mes, 1)
-        dia_fim = date(ano, mes, 15)
-    else:
-        dia_inicio = date(ano, mes, 16)
-        ultimo_dia = cal_mod.monthrange(ano, mes)[1]
-        dia_fim = date(ano, mes, ultimo_dia)
-
-    df_filtrado = df_boletins.copy()
-    df_filtrado['data_dt'] = pd.to_datetime(df_filtrado['data']).dt.date
-    df_filtrado = df_filtrado[(df_filtrado['data_dt'] >= dia_inicio) & (df_filtrado['data_dt'] <= dia_fim)]
-    df_filtrado = df_filtrado.sort_values(by='data_dt')
-
-    story = []
-
-    story.append(Paragraph(f"Historico de Boletins P.E / I.E", style_title))
-    story.append(Paragraph(f"Periodo: {quinzena_label} ({dia_inicio.strftime('%d/%m/%Y')} a {dia_fim.strftime('%d/%m/%Y')})", style_subtitle))
-
-    if df_filtrado.empty:
-        story.append(Paragraph("Nenhum boletim registrado neste periodo.", style_cell))
-        doc.build(story)
-        buffer.seek(0)
-        return buffer.getvalue()
+    style_resumo = ParagraphStyle('Resumo', parent=styles['Normal'], fontSize=9, textColor=colors.HexColor('#566573'), alignment=TA_CENTER)
 
     header_row = [
         Paragraph("<b>Data</b>", style_header),
@@ -1586,60 +2648,8 @@ def gerar_pdf_historico_boletins(df_boletins, quinzena, mes, ano):
         Paragraph("<b>Tratamento</b>", style_header),
         Paragraph("<b>Observacoes</b>", style_header),
     ]
-
-    table_data = [header_row]
-
-    for _, bol in df_filtrado.iterrows():
-        data_str = pd.to_datetime(bol['data']).strftime('%d/%m/%Y')
-
-        imoveis = bol.get('imoveis_trabalhados', [])
-        if isinstance(imoveis, list):
-            imoveis_txt = "\n".join([str(im) for im in imoveis])
-        else:
-            imoveis_txt = str(imoveis) if imoveis else ""
-
-        equipes = bol.get('equipes', [])
-        equipes_txt = ""
-        if isinstance(equipes, list):
-            for eq_i, eq in enumerate(equipes):
-                if isinstance(eq, dict):
-                    membros = [formatar_nome(m) for m in eq.get('membros', [])]
-                    equipes_txt += f"Eq{eq_i+1}: {', '.join(membros)}\n"
-
-        tem_criad = bol.get('criadouro_encontrado', False)
-        criad_txt = "Sim" if tem_criad else "Nao"
-
-        recips = bol.get('recipientes', [])
-        if isinstance(recips, list) and recips:
-            recips_txt = "\n".join([str(r) for r in recips])
-        else:
-            recips_txt = "-"
-
-        trat = bol.get('tratamento_realizado', False)
-        data_trat = bol.get('data_tratamento', None)
-        if trat and data_trat:
-            trat_txt = f"Sim - {pd.to_datetime(data_trat).strftime('%d/%m/%Y')}"
-        elif trat:
-            trat_txt = "Sim"
-        else:
-            trat_txt = "Nao" if tem_criad else "-"
-
-        obs_txt = str(bol.get('observacoes', '')) if bol.get('observacoes') else "-"
-
-        table_data.append([
-            Paragraph(data_str, style_cell_center),
-            Paragraph(imoveis_txt.replace("\n", "<br/>"), style_cell),
-            Paragraph(equipes_txt.replace("\n", "<br/>"), style_cell),
-            Paragraph(criad_txt, style_cell_center),
-            Paragraph(recips_txt.replace("\n", "<br/>"), style_cell),
-            Paragraph(trat_txt, style_cell_center),
-            Paragraph(obs_txt, style_cell),
-        ])
-
     col_widths = [28*mm, 62*mm, 55*mm, 22*mm, 45*mm, 32*mm, 36*mm]
-
-    table = Table(table_data, colWidths=col_widths, repeatRows=1)
-    table.setStyle(TableStyle([
+    table_style = TableStyle([
         ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#1B4F72')),
         ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
         ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
@@ -1654,19 +2664,56 @@ def gerar_pdf_historico_boletins(df_boletins, quinzena, mes, ano):
         ('BOTTOMPADDING', (0, 0), (-1, -1), 5),
         ('LEFTPADDING', (0, 0), (-1, -1), 4),
         ('RIGHTPADDING', (0, 0), (-1, -1), 4),
-    ]))
-
-    story.append(table)
+    ])
 
-    story.append(Spacer(1, 8*mm))
-    total = len(df_filtrado)
-    com_criadouro = len(df_filtrado[df_filtrado.apply(lambda r: r.get('criadouro_encontrado', False), axis=1)])
-    com_tratamento = len(df_filtrado[df_filtrado.apply(lambda r: r.get('tratamento_realizado', False), axis=1)])
-    resumo_txt = f"Total de boletins: {total}  |  Com criadouro: {com_criadouro}  |  Com tratamento: {com_tratamento}"
-    style_resumo = ParagraphStyle('Resumo', parent=styles['Normal'], fontSize=9, textColor=colors.HexColor('#566573'), alignment=TA_CENTER)
-    story.append(Paragraph(resumo_txt, style_resumo))
+    inicio_geral = min(p[0] for p in periodos)
+    fim_geral = max(p[1] for p in periodos)
+    df_filtrado = df_boletins.copy() if not df_boletins.empty else pd.DataFrame(columns=['data'])
+    df_filtrado['data_dt'] = pd.to_datetime(df_filtrado['data'], errors='coerce').dt.date
+    df_filtrado = df_filtrado[df_filtrado['data_dt'].notna()]
+    df_filtrado = df_filtrado[(df_filtrado['data_dt'] >= inicio_geral) & (df_filtrado['data_dt'] <= fim_geral)]
+    colunas = _colunas_historico_pe_ie(df_filtrado.sort_values(by='data_dt'))
+
+    titulo_periodo = periodos[0][2] if len(periodos) == 1 else f"{len(periodos)} periodos"
+    totais = {'boletins': 0, 'criadouro': 0, 'tratamento': 0}
+
+    def blocos():
+        yield [
+            Paragraph("Historico de Boletins P.E / I.E", style_title),
+            Paragraph(f"Periodo: {titulo_periodo} ({inicio_geral.strftime('%d/%m/%Y')} a {fim_geral.strftime('%d/%m/%Y')})", style_subtitle),
+        ]
+        for inicio, fim, rotulo in periodos:
+            do_periodo = colunas[(colunas['data_dt'] >= inicio) & (colunas['data_dt'] <= fim)]
+            if len(periodos) > 1:
+                if do_periodo.empty:
+                    continue
+                yield [Paragraph(f"{rotulo} ({inicio.strftime('%d/%m/%Y')} a {fim.strftime('%d/%m/%Y')})", style_periodo)]
+            totais['boletins'] += len(do_periodo)
+            totais['criadouro'] += int(do_periodo['tem_criadouro'].sum())
+            totais['tratamento'] += int(do_periodo['tem_tratamento'].sum())
+            for posicao in range(0, len(do_periodo), LINHAS_POR_BLOCO_PDF):
+                trecho = do_periodo.iloc[posicao:posicao + LINHAS_POR_BLOCO_PDF]
+                linhas = [header_row] + [
+                    [
+                        Paragraph(data_str, style_cell_center), Paragraph(imoveis, style_cell),
+                        Paragraph(equipes, style_cell), Paragraph(criadouro, style_cell_center),
+                        Paragraph(recipientes, style_cell), Paragraph(tratamento, style_cell_center),
+                        Paragraph(observacoes, style_cell),
+                    ]
+                    for data_str, imoveis, equipes, criadouro, recipientes, tratamento, observacoes in zip(
+                        trecho['data'], trecho['imoveis'], trecho['equipes'], trecho['criadouro'],
+                        trecho['recipientes'], trecho['tratamento'], trecho['observacoes'])
+                ]
+                tabela = Table(linhas, colWidths=col_widths, repeatRows=1)
+                tabela.setStyle(table_style)
+                yield [tabela]
+        if totais['boletins'] == 0:
+            yield [Paragraph("Nenhum boletim registrado neste periodo.", style_cell)]
+            return
+        resumo_txt = f"Total de boletins: {totais['boletins']}  |  Com criadouro: {totais['criadouro']}  |  Com tratamento: {totais['tratamento']}"
+        yield [Spacer(1, 8*mm), Paragraph(resumo_txt, style_resumo)]
 
-    doc.build(story)
+    relatorios.escrever_pdf_em_blocos(buffer, blocos(), landscape(A4), (12*mm, 15*mm, 12*mm, 15*mm))
     buffer.seek(0)
     return buffer.getvalue()
 
@@ -1679,10 +2726,12 @@ def modulo_boletim():
         </div>
     """, unsafe_allow_html=True)
 
-    df_funcionarios = carregar_dados_firebase('funcionarios')
-    df_boletins = carregar_dados_firebase('boletins')
-    lista_quarteiroes = carregar_quarteiroes_csv()
-    df_geo_quarteiroes = carregar_geo_kml()
+    preparar_base_geografica()
+    (df_funcionarios, df_boletins, lista_quarteiroes, contornos_quadras,
+     df_pe_ie, df_boletins_pe_ie, _) = carregar_em_paralelo(
+        'funcionarios', 'boletins', carregar_quarteiroes_csv, carregar_contornos_quadras,
+        'pe_ie_cadastros', 'boletins_pe_ie', 'folgas_ferias',
+    )
 
     if 'num_equipes_manha' not in st.session_state:
         st.session_state.num_equipes_manha = 1
@@ -1718,7 +2767,13 @@ def modulo_boletim():
                 lista_nomes_curtos_full = []
                 st.warning("Não há funcionários cadastrados para criar um boletim.")
 
-            motoristas_curtos = st.multiselect("Motorista(s)", options=lista_nomes_curtos_full)
+            # Quem está de férias ou abonada na data do boletim não aparece nas equipes.
+            nome_map_disponiveis, de_licenca_curtos = funcionarios_disponiveis(df_funcionarios, data_boletim) if nome_map else ({}, [])
+            if de_licenca_curtos:
+                st.caption(f"🌴 De férias/abonada em {data_boletim.strftime('%d/%m/%Y')}: {', '.join(de_licenca_curtos)}")
+            lista_nomes_disponiveis = sorted(nome_map_disponiveis.keys())
+
+            motoristas_curtos = st.multiselect("Motorista(s)", options=lista_nomes_disponiveis)
             st.markdown("</div>", unsafe_allow_html=True) 
 
             st.markdown("<div class='sys-card'>", unsafe_allow_html=True)
@@ -1730,7 +2785,7 @@ def modulo_boletim():
                 st.markdown("#### Manhã")
                 equipes_manha = []
                 membros_selecionados_manha = []
-                nomes_disponiveis_manha = [nome for nome in lista_nomes_curtos_full]
+                nomes_disponiveis_manha = [nome for nome in lista_nomes_disponiveis]
                 
                 if 'faltas_manha_curtos' in st.session_state and st.session_state.faltas_manha_curtos is not None:
                     nomes_disponiveis_manha = [nome for nome in nomes_disponiveis_manha if nome not in st.session_state.faltas_manha_curtos]
@@ -1749,7 +2804,7 @@ def modulo_boletim():
                     quarteiroes = st.multiselect("Quarteirões", options=lista_quarteiroes, key=f"manha_quarteiroes_{i}")
                     
                     if membros_curtos:
-                        membros_completos = [nome_map[nome] for nome in membros_curtos]
+                        membros_completos = [nome_map_disponiveis[nome] for nome in membros_curtos]
                         equipes_manha.append({"membros": membros_completos, "atividades": atividades, "quarteiroes": quarteiroes})
                         membros_selecionados_manha.extend(membros_curtos)
 
@@ -1761,7 +2816,7 @@ def modulo_boletim():
                 st.markdown("#### Tarde")
                 equipes_tarde = []
                 membros_selecionados_tarde = []
-                nomes_disponiveis_tarde = [nome for nome in lista_nomes_curtos_full]
+                nomes_disponiveis_tarde = [nome for nome in lista_nomes_disponiveis]
                 
                 if 'faltas_tarde_curtos' in st.session_state and st.session_state.faltas_tarde_curtos is not None:
                     nomes_disponiveis_tarde = [nome for nome in nomes_disponiveis_tarde if nome not in st.session_state.faltas_tarde_curtos]
@@ -1780,7 +2835,7 @@ def modulo_boletim():
                     quarteiroes = st.multiselect("Quarteirões ", options=lista_quarteiroes, key=f"tarde_quarteiroes_{i}")
                     
                     if membros_curtos:
-                        membros_completos = [nome_map[nome] for nome in membros_curtos]
+                        membros_completos = [nome_map_disponiveis[nome] for nome in membros_curtos]
                         equipes_tarde.append({"membros": membros_completos, "atividades": atividades, "quarteiroes": quarteiroes})
                         membros_selecionados_tarde.extend(membros_curtos)
 
@@ -1807,7 +2862,7 @@ def modulo_boletim():
             st.markdown("</div>", unsafe_allow_html=True) 
             
         if st.button("Salvar Boletim", use_container_width=True, type="primary", key="save_boletim_button"):
-            motoristas_completos = [nome_map[nome] for nome in motoristas_curtos]
+            motoristas_completos = [nome_map_disponiveis[nome] for nome in motoristas_curtos]
             faltas_manha_completos = [nome_map[nome] for nome in faltas_manha_curtos]
             faltas_tarde_completos = [nome_map[nome] for nome in faltas_tarde_curtos]
             
@@ -1823,12 +2878,12 @@ def modulo_boletim():
                 "faltas_tarde": {"nomes": faltas_tarde_completos, "motivo": motivo_falta_tarde}
             }
             try:
-                ref = db.reference(f'boletins/{boletim_id}'); ref.set(boletim_data)
+                gravar_registro('boletins', boletim_id, boletim_data)
                 
                 log_atividade(st.session_state.get('username'), "Criou novo boletim", f"Data: {boletim_id}, Bairros: {bairros}")
 
                 st.success(f"Boletim para o dia {data_boletim.strftime('%d/%m/%Y')} salvo com sucesso!")
-                st.cache_data.clear()
+                recarregar_versoes_nos()
                 time.sleep(1)
                 st.rerun()
             except Exception as e:
@@ -1843,9 +2898,6 @@ def modulo_boletim():
             </div>
         """, unsafe_allow_html=True)
 
-        df_pe_ie = carregar_dados_firebase('pe_ie_cadastros')
-        df_boletins_pe_ie = carregar_dados_firebase('boletins_pe_ie')
-
         if isinstance(df_funcionarios, pd.DataFrame) and not df_funcionarios.empty:
             nome_map_pe = {formatar_nome(nome): nome for nome in df_funcionarios['nome']}
             lista_nomes_pe = sorted(list(nome_map_pe.keys()))
@@ -1853,11 +2905,16 @@ def modulo_boletim():
             nome_map_pe = {}
             lista_nomes_pe = []
 
+        _migracao_ids_boletins_pe_ie()
+        _garantir_resumo_pe_ie()
+        indice_visitas = carregar_indice_visitas()
+
         lista_pe_ie_opcoes = []
         if not df_pe_ie.empty:
             for idx_pe, row_pe in df_pe_ie.iterrows():
-                label = f"{row_pe.get('tipo', '')} - {row_pe.get('nome_fantasia', '')} (No {row_pe.get('numero_cadastro', '')})"
+                label = visitas.rotulo_cadastro(row_pe)
                 lista_pe_ie_opcoes.append({"id": idx_pe, "label": label, "tipo": row_pe.get('tipo', ''), "dados": row_pe})
+        rotulos_pe_ie = {item["id"]: item["label"] for item in lista_pe_ie_opcoes}
 
         total_pe = len(df_pe_ie[df_pe_ie['tipo'] == 'P.E']) if not df_pe_ie.empty and 'tipo' in df_pe_ie.columns else 0
         total_ie = len(df_pe_ie[df_pe_ie['tipo'] == 'I.E']) if not df_pe_ie.empty and 'tipo' in df_pe_ie.columns else 0
@@ -1930,13 +2987,12 @@ def modulo_boletim():
                         "data_cadastro": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
                     }
                     try:
-                        ref = db.reference(f'pe_ie_cadastros/{cadastro_id}')
-                        ref.set(cadastro_data)
+                        gravar_registro('pe_ie_cadastros', cadastro_id, cadastro_data)
 
                         log_atividade(st.session_state.get('username'), f"Cadastrou {tipo_sigla}", f"No Cadastro: {numero_cadastro}, Nome: {nome_fantasia}")
 
                         st.success(f"{tipo_sigla} — {nome_fantasia} cadastrado com sucesso!")
-                        st.cache_data.clear()
+                        recarregar_versoes_nos()
                         st.rerun()
                     except Exception as e:
                         st.error(f"Erro ao salvar o cadastro: {e}")
@@ -1961,11 +3017,12 @@ def modulo_boletim():
 
                     filtro_tipo_boletim = st.selectbox("Filtrar imoveis por tipo", ["Todos", "P.E", "I.E"], key="filtro_tipo_boletim_pe")
 
-                    opcoes_imoveis = [item["label"] for item in lista_pe_ie_opcoes if filtro_tipo_boletim == "Todos" or item["tipo"] == filtro_tipo_boletim]
+                    opcoes_imoveis = [item["id"] for item in lista_pe_ie_opcoes if filtro_tipo_boletim == "Todos" or item["tipo"] == filtro_tipo_boletim]
 
                     imoveis_selecionados = st.multiselect(
                         "Selecione os imoveis trabalhados",
                         options=opcoes_imoveis,
+                        format_func=lambda chave: rotulos_pe_ie.get(chave, chave),
                         key="imoveis_selecionados_pe_ie"
                     )
 
@@ -2087,7 +3144,8 @@ def modulo_boletim():
                         boletim_pe_id = str(int(time.time() * 1000))
                         boletim_pe_data = {
                             "data": data_boletim_pe.strftime("%Y-%m-%d"),
-                            "imoveis_trabalhados": imoveis_selecionados,
+                            "imoveis_ids": imoveis_selecionados,
+                            "imoveis_trabalhados": [rotulos_pe_ie[chave] for chave in imoveis_selecionados],
                             "equipes": equipes_pe_ie,
                             "observacoes": observacoes_pe,
                             "criadouro_encontrado": encontrou_criadouro,
@@ -2096,8 +3154,10 @@ def modulo_boletim():
                             "data_criacao": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
                         }
                         try:
-                            ref = db.reference(f'boletins_pe_ie/{boletim_pe_id}')
-                            ref.set(boletim_pe_data)
+                            gravar_em_lote(
+                                operacao_gravar('boletins_pe_ie', boletim_pe_id, boletim_pe_data),
+                                operacoes_resumo_pe_ie(boletim_pe_data, 1),
+                            )
 
                             log_atividade(
                                 st.session_state.get('username'),
@@ -2107,7 +3167,7 @@ def modulo_boletim():
 
                             st.success(f"Boletim P.E/I.E para {data_boletim_pe.strftime('%d/%m/%Y')} salvo com sucesso!")
                             st.session_state.num_equipes_pe_ie = 1
-                            st.cache_data.clear()
+                            recarregar_versoes_nos()
                             time.sleep(1)
                             st.rerun()
                         except Exception as e:
@@ -2144,23 +3204,10 @@ def modulo_boletim():
                 fim_trimestre = date(hoje.year, ultimo_mes_trim, ultimo_dia_trim)
                 trimestre_label = f"{trimestre_num}o Trimestre ({inicio_trimestre.strftime('%d/%m')} a {fim_trimestre.strftime('%d/%m/%Y')})"
 
-                imoveis_feitos_quinzena = set()
-                imoveis_feitos_trimestre = set()
-
-                if not df_boletins_pe_ie.empty:
-                    for _, bol in df_boletins_pe_ie.iterrows():
-                        data_bol = pd.to_datetime(bol['data']).date()
-                        imoveis_bol = bol.get('imoveis_trabalhados', [])
-                        if not isinstance(imoveis_bol, list):
-                            imoveis_bol = []
-
-                        if inicio_quinzena <= data_bol <= fim_quinzena:
-                            for im in imoveis_bol:
-                                imoveis_feitos_quinzena.add(im)
-
-                        if inicio_trimestre <= data_bol <= fim_trimestre:
-                            for im in imoveis_bol:
-                                imoveis_feitos_trimestre.add(im)
+                resumo_quinzena = carregar_resumo_pe_ie(visitas.chave_quinzena(hoje))
+                resumo_trimestre = carregar_resumo_pe_ie(visitas.chave_trimestre(hoje))
+                visitados_quinzena = visitas.visitados_no_resumo(resumo_quinzena)
+                visitados_trimestre = visitas.visitados_no_resumo(resumo_trimestre)
 
                 df_pe = df_pe_ie[df_pe_ie['tipo'] == 'P.E'] if 'tipo' in df_pe_ie.columns else pd.DataFrame()
                 df_ie = df_pe_ie[df_pe_ie['tipo'] == 'I.E'] if 'tipo' in df_pe_ie.columns else pd.DataFrame()
@@ -2170,7 +3217,10 @@ def modulo_boletim():
                         <div class="sys-card-title">🟢 Controle de P.E — Quinzenal</div>
                         <div style="font-size:0.9rem; color:#566573; margin-bottom:16px;">
                             Periodo atual: <strong>{quinzena_label}</strong>  · 
-                            Dias restantes: <strong>{(fim_quinzena - hoje).days}</strong>
+                            Dias restantes: <strong>{(fim_quinzena - hoje).days}</strong>  · 
+                            Boletins: <strong>{resumo_quinzena.get('boletins', 0)}</strong>  · 
+                            Com criadouro: <strong>{resumo_quinzena.get('positivos', 0)}</strong>  · 
+                            Com tratamento: <strong>{resumo_quinzena.get('tratamentos', 0)}</strong>
                         </div>
                     </div>
                 """, unsafe_allow_html=True)
@@ -2180,12 +3230,13 @@ def modulo_boletim():
                     pe_realizados = []
 
                     for idx_pe, row_pe in df_pe.iterrows():
-                        label_pe = f"P.E - {row_pe.get('nome_fantasia', '')} (No {row_pe.get('numero_cadastro', '')})"
-                        foi_feito = any(label_pe in item for item in imoveis_feitos_quinzena)
+                        foi_feito = str(idx_pe) in visitados_quinzena
+                        ultima = visitas.ultima_visita(indice_visitas, idx_pe)
 
                         dados_pe = {
                             "id": idx_pe,
-                            "label": label_pe,
+                            "label": rotulos_pe_ie.get(idx_pe, ''),
+                            "ultima_visita": ultima.strftime('%d/%m/%Y') if ultima else "Nunca",
                             "nome_fantasia": row_pe.get('nome_fantasia', ''),
                             "numero_cadastro": row_pe.get('numero_cadastro', ''),
                             "endereco": row_pe.get('endereco', ''),
@@ -2243,6 +3294,10 @@ def modulo_boletim():
                                             <div class="info-label">Quarteirao</div>
                                             <div class="info-value">{p['quarteirao']}</div>
                                         </div>
+                                        <div class="info-item">
+                                            <div class="info-label">Ultima visita</div>
+                                            <div class="info-value">{p['ultima_visita']}</div>
+                                        </div>
                                     </div>
                                 </div>
                             """, unsafe_allow_html=True)
@@ -2269,7 +3324,10 @@ def modulo_boletim():
                         <div class="sys-card-title">🔵 Controle de I.E — Trimestral</div>
                         <div style="font-size:0.9rem; color:#566573; margin-bottom:16px;">
                             Periodo atual: <strong>{trimestre_label}</strong>  · 
-                            Dias restantes: <strong>{(fim_trimestre - hoje).days}</strong>
+                            Dias restantes: <strong>{(fim_trimestre - hoje).days}</strong>  · 
+                            Boletins: <strong>{resumo_trimestre.get('boletins', 0)}</strong>  · 
+                            Com criadouro: <strong>{resumo_trimestre.get('positivos', 0)}</strong>  · 
+                            Com tratamento: <strong>{resumo_trimestre.get('tratamentos', 0)}</strong>
                         </div>
                     </div>
                 """, unsafe_allow_html=True)
@@ -2279,12 +3337,13 @@ def modulo_boletim():
                     ie_realizados = []
 
                     for idx_ie, row_ie in df_ie.iterrows():
-                        label_ie = f"I.E - {row_ie.get('nome_fantasia', '')} (No {row_ie.get('numero_cadastro', '')})"
-                        foi_feito = any(label_ie in item for item in imoveis_feitos_trimestre)
+                        foi_feito = str(idx_ie) in visitados_trimestre
+                        ultima = visitas.ultima_visita(indice_visitas, idx_ie)
 
                         dados_ie = {
                             "id": idx_ie,
-                            "label": label_ie,
+                            "label": rotulos_pe_ie.get(idx_ie, ''),
+                            "ultima_visita": ultima.strftime('%d/%m/%Y') if ultima else "Nunca",
                             "nome_fantasia": row_ie.get('nome_fantasia', ''),
                             "numero_cadastro": row_ie.get('numero_cadastro', ''),
                             "endereco": row_ie.get('endereco', ''),
@@ -2342,6 +3401,10 @@ def modulo_boletim():
                                             <div class="info-label">Quarteirao</div>
                                             <div class="info-value">{p['quarteirao']}</div>
                                         </div>
+                                        <div class="info-item">
+                                            <div class="info-label">Ultima visita</div>
+                                            <div class="info-value">{p['ultima_visita']}</div>
+                                        </div>
                                     </div>
                                 </div>
                             """, unsafe_allow_html=True)
@@ -2370,10 +3433,15 @@ def modulo_boletim():
                 st.caption("Gera PDF com tabela de P.E e/ou I.E com colunas para preenchimento em campo.")
                 st.markdown('</div>', unsafe_allow_html=True)
 
+                data_pdf = date.today()
+                resumos_pdf = {
+                    'P.E': carregar_resumo_pe_ie(visitas.chave_quinzena(data_pdf)),
+                    'I.E': carregar_resumo_pe_ie(visitas.chave_trimestre(data_pdf)),
+                }
                 col_exp1, col_exp2, col_exp3 = st.columns(3)
                 with col_exp1:
-                    pdf_pe = gerar_pdf_pe_ie(df_pe_ie, "P.E")
-                    hoje_str = date.today().strftime('%d-%m-%Y')
+                    pdf_pe = relatorio_sob_demanda(gerar_pdf_pe_ie, df_pe_ie, "P.E", resumos_pdf, data_pdf, nos=['pe_ie_cadastros'])
+                    hoje_str = data_pdf.strftime('%d-%m-%Y')
                     st.download_button(
                         label="🟢 Baixar PDF — P.E",
                         data=pdf_pe,
@@ -2383,7 +3451,7 @@ def modulo_boletim():
                         key="download_pdf_pe"
                     )
                 with col_exp2:
-                    pdf_ie = gerar_pdf_pe_ie(df_pe_ie, "I.E")
+                    pdf_ie = relatorio_sob_demanda(gerar_pdf_pe_ie, df_pe_ie, "I.E", resumos_pdf, data_pdf, nos=['pe_ie_cadastros'])
                     st.download_button(
                         label="🔵 Baixar PDF — I.E",
                         data=pdf_ie,
@@ -2393,7 +3461,7 @@ def modulo_boletim():
                         key="download_pdf_ie"
                     )
                 with col_exp3:
-                    pdf_todos = gerar_pdf_pe_ie(df_pe_ie, "Todos")
+                    pdf_todos = relatorio_sob_demanda(gerar_pdf_pe_ie, df_pe_ie, "Todos", resumos_pdf, data_pdf, nos=['pe_ie_cadastros'])
                     st.download_button(
                         label="📄 Baixar PDF — Todos",
                         data=pdf_todos,
@@ -2479,11 +3547,11 @@ def modulo_boletim():
                                         "latitude": lat_edit,
                                         "longitude": lon_edit,
                                     }
-                                    db.reference(f'pe_ie_cadastros/{idx}').update(dados_atualizados)
+                                    atualizar_registro('pe_ie_cadastros', idx, dados_atualizados)
                                     log_atividade(st.session_state.get('username'), f"Editou {tipo_sigla_edit}", f"No Cadastro: {num_cad_edit}, Nome: {nome_fan_edit}")
                                     st.success(f"Cadastro '{nome_fan_edit}' atualizado com sucesso!")
                                     st.session_state.pe_ie_editando_id = None
-                                    st.cache_data.clear()
+                                    recarregar_versoes_nos()
                                     st.rerun()
 
                                 if cancelar:
@@ -2529,10 +3597,10 @@ def modulo_boletim():
                                     st.rerun()
                             with col_act2:
                                 if st.button("🗑️ Deletar", key=f"del_pe_ie_{idx}", use_container_width=True):
-                                    db.reference(f'pe_ie_cadastros/{idx}').delete()
+                                    remover_registro('pe_ie_cadastros', idx)
                                     log_atividade(st.session_state.get('username'), f"Deletou {tipo_label}", f"No Cadastro: {num_cad}, Nome: {nome_fan}")
                                     st.success(f"Cadastro '{nome_fan}' deletado com sucesso.")
-                                    st.cache_data.clear()
+                                    recarregar_versoes_nos()
                                     st.rerun()
 
             else:
@@ -2548,28 +3616,48 @@ def modulo_boletim():
                 st.markdown('<div class="sys-card"><div class="sys-card-title">📥 Exportar Historico em PDF</div>', unsafe_allow_html=True)
                 st.markdown('</div>', unsafe_allow_html=True)
 
-                meses_nomes = ["Janeiro", "Fevereiro", "Marco", "Abril", "Maio", "Junho", "Julho", "Agosto", "Setembro", "Outubro", "Novembro", "Dezembro"]
                 hoje = date.today()
+                anos_exp = list(range(hoje.year - 2, hoje.year + 1))
 
+                abrangencia = st.radio("Abrangencia", ["Quinzena", "Ano inteiro", "Intervalo de datas"], horizontal=True, key="exp_abrangencia")
                 col_q, col_m, col_a, col_btn = st.columns([1, 1, 1, 1])
-                with col_q:
-                    quinzena_exp = st.selectbox("Quinzena", [1, 2], format_func=lambda x: f"{x}a Quinzena", key="exp_quinzena")
-                with col_m:
-                    mes_exp = st.selectbox("Mes", list(range(1, 13)), index=hoje.month - 1, format_func=lambda x: meses_nomes[x - 1], key="exp_mes")
-                with col_a:
-                    ano_exp = st.selectbox("Ano", list(range(hoje.year - 2, hoje.year + 1)), index=2, key="exp_ano")
-                with col_btn:
-                    st.markdown("<br>", unsafe_allow_html=True)
-                    pdf_hist = gerar_pdf_historico_boletins(df_boletins_pe_ie, quinzena_exp, mes_exp, ano_exp)
-                    label_pdf = f"{quinzena_exp}a_Quinzena_{meses_nomes[mes_exp-1]}_{ano_exp}"
-                    st.download_button(
-                        label="📄 Baixar PDF",
-                        data=pdf_hist,
-                        file_name=f"Historico_PE_IE_{label_pdf}.pdf",
-                        mime="application/pdf",
-                        use_container_width=True,
-                        key="download_hist_pdf"
-                    )
+                if abrangencia == "Quinzena":
+                    with col_q:
+                        quinzena_exp = st.selectbox("Quinzena", [1, 2], format_func=lambda x: f"{x}a Quinzena", key="exp_quinzena")
+                    with col_m:
+                        mes_exp = st.selectbox("Mes", list(range(1, 13)), index=hoje.month - 1, format_func=lambda x: MESES_PDF[x - 1], key="exp_mes")
+                    with col_a:
+                        ano_exp = st.selectbox("Ano", anos_exp, index=2, key="exp_ano")
+                    periodos_exp = [periodo_quinzena(quinzena_exp, mes_exp, ano_exp)]
+                    label_pdf = f"{quinzena_exp}a_Quinzena_{MESES_PDF[mes_exp-1]}_{ano_exp}"
+                elif abrangencia == "Ano inteiro":
+                    with col_q:
+                        ano_exp = st.selectbox("Ano", anos_exp, index=2, key="exp_ano_inteiro")
+                    periodos_exp = periodos_quinzenas_ano(ano_exp)
+                    label_pdf = f"Ano_{ano_exp}"
+                else:
+                    with col_q:
+                        inicio_exp = st.date_input("De", value=hoje.replace(day=1), format="DD/MM/YYYY", key="exp_inicio")
+                    with col_m:
+                        fim_exp = st.date_input("Ate", value=hoje, format="DD/MM/YYYY", key="exp_fim")
+                    if inicio_exp > fim_exp:
+                        periodos_exp = []
+                        st.warning("A data inicial não pode ser posterior à data final.")
+                    else:
+                        periodos_exp = [(inicio_exp, fim_exp, f"{inicio_exp.strftime('%d/%m/%Y')} a {fim_exp.strftime('%d/%m/%Y')}")]
+                    label_pdf = f"{inicio_exp.strftime('%Y%m%d')}_{fim_exp.strftime('%Y%m%d')}"
+                if periodos_exp:
+                    with col_btn:
+                        st.markdown("<br>", unsafe_allow_html=True)
+                        pdf_hist = relatorio_sob_demanda(gerar_pdf_historico_boletins, df_boletins_pe_ie, periodos_exp, nos=['boletins_pe_ie'])
+                        st.download_button(
+                            label="📄 Baixar PDF",
+                            data=pdf_hist,
+                            file_name=f"Historico_PE_IE_{label_pdf}.pdf",
+                            mime="application/pdf",
+                            use_container_width=True,
+                            key="download_hist_pdf"
+                        )
 
                 st.markdown('<div class="sys-divider"></div>', unsafe_allow_html=True)
 
@@ -2661,31 +3749,40 @@ def modulo_boletim():
                             )
 
                             if st.button("💾 Salvar tratamento", key=f"save_trat_{idx_bol}", use_container_width=True):
-                                db.reference(f'boletins_pe_ie/{idx_bol}').update({
+                                operacoes = [operacao_atualizar('boletins_pe_ie', idx_bol, {
                                     "tratamento_realizado": True,
                                     "data_tratamento": data_tratamento_input.strftime("%Y-%m-%d")
-                                })
+                                })]
+                                if not visitas.marcado(tratamento_atual):
+                                    operacoes.append(operacoes_resumo_pe_ie({**boletim.to_dict(), "tratamento_realizado": True}, 1, campos=('tratamentos',)))
+                                gravar_em_lote(*operacoes)
                                 log_atividade(st.session_state.get('username'), "Registrou tratamento P.E/I.E", f"Boletim: {data_fmt}, Data tratamento: {data_tratamento_input.strftime('%d/%m/%Y')}")
                                 st.success("Tratamento registrado com sucesso!")
-                                st.cache_data.clear()
+                                recarregar_versoes_nos()
                                 st.rerun()
                         else:
                             if tratamento_atual:
                                 if st.button("❌ Remover registro de tratamento", key=f"rem_trat_{idx_bol}"):
-                                    db.reference(f'boletins_pe_ie/{idx_bol}').update({
+                                    operacoes = [operacao_atualizar('boletins_pe_ie', idx_bol, {
                                         "tratamento_realizado": False,
                                         "data_tratamento": None
-                                    })
+                                    })]
+                                    if visitas.marcado(tratamento_atual):
+                                        operacoes.append(operacoes_resumo_pe_ie({**boletim.to_dict(), "tratamento_realizado": True}, -1, campos=('tratamentos',)))
+                                    gravar_em_lote(*operacoes)
                                     log_atividade(st.session_state.get('username'), "Removeu tratamento P.E/I.E", f"Boletim: {data_fmt}")
                                     st.success("Registro de tratamento removido.")
-                                    st.cache_data.clear()
+                                    recarregar_versoes_nos()
                                     st.rerun()
 
                     if st.button(f"🗑️ Deletar boletim de {data_fmt}", key=f"del_bol_pe_{idx_bol}"):
-                        db.reference(f'boletins_pe_ie/{idx_bol}').delete()
+                        gravar_em_lote(
+                            operacao_remover('boletins_pe_ie', idx_bol),
+                            operacoes_resumo_pe_ie(boletim.to_dict(), -1),
+                        )
                         log_atividade(st.session_state.get('username'), "Deletou boletim P.E/I.E", f"Data: {data_fmt}")
                         st.success("Boletim deletado com sucesso.")
-                        st.cache_data.clear()
+                        recarregar_versoes_nos()
                         st.rerun()
 
             else:
@@ -2720,7 +3817,7 @@ def modulo_boletim():
                 
                 st.divider()
                 
-                report_bytes = create_boletim_word_report(dados_boletim)
+                report_bytes = relatorio_sob_demanda(create_boletim_word_report, dados_boletim, modelo='boletim')
                 st.download_button(
                     label="📥 Baixar Boletim (.docx)",
                     data=report_bytes,
@@ -2767,7 +3864,15 @@ def modulo_boletim():
                         nome_map_full = {formatar_nome(nome): nome for nome in df_funcionarios['nome']}
                         lista_nomes_curtos_full_edit = sorted(list(nome_map_full.keys()))
 
-                        motoristas_edit_curtos = st.multiselect("Motorista(s)", options=lista_nomes_curtos_full_edit, default=[formatar_nome(nome) for nome in dados_boletim.get('motoristas', [])])
+                        # Mesmo filtro do cadastro: quem está de licença na data do boletim não
+                        # é oferecido como motorista; os já gravados continuam na lista.
+                        nome_map_disponiveis_edit, de_licenca_curtos_edit = funcionarios_disponiveis(df_funcionarios, pd.to_datetime(boletim_id_selecionado).date())
+                        motoristas_gravados = {formatar_nome(nome): nome for nome in dados_boletim.get('motoristas', [])}
+                        if de_licenca_curtos_edit:
+                            st.caption(f"🌴 De férias/abonada nesta data: {', '.join(de_licenca_curtos_edit)}")
+                        opcoes_motoristas_edit = sorted(set(nome_map_disponiveis_edit) | set(motoristas_gravados))
+
+                        motoristas_edit_curtos = st.multiselect("Motorista(s)", options=opcoes_motoristas_edit, default=list(motoristas_gravados))
                         
                         st.markdown("**Editar Faltas**")
                         faltas_manha_edit_curtos = st.multiselect("Ausentes (Manhã)", options=lista_nomes_curtos_full_edit, default=[formatar_nome(nome) for nome in dados_boletim.get('faltas_manha', {}).get('nomes', [])])
@@ -2778,7 +3883,7 @@ def modulo_boletim():
                         submit_button = st.form_submit_button(label='Salvar Alterações')
 
                         if submit_button:
-                            motoristas_completos_edit = [nome_map_full[nome] for nome in motoristas_edit_curtos]
+                            motoristas_completos_edit = [motoristas_gravados.get(nome) or nome_map_disponiveis_edit[nome] for nome in motoristas_edit_curtos]
                             faltas_manha_completos_edit = [nome_map_full[nome] for nome in faltas_manha_edit_curtos]
                             faltas_tarde_completos_edit = [nome_map_full[nome] for nome in faltas_tarde_edit_curtos]
 
@@ -2790,21 +3895,20 @@ def modulo_boletim():
                                 "faltas_tarde": {"nomes": faltas_tarde_completos_edit, "motivo": motivo_tarde_edit},
                             }
                             try:
-                                ref = db.reference(f'boletins/{boletim_id_selecionado}')
-                                ref.update(dados_atualizados)
+                                atualizar_registro('boletins', boletim_id_selecionado, dados_atualizados)
 
                                 log_atividade(st.session_state.get('username'), "Editou boletim", f"Boletim: {boletim_id_selecionado}")
 
                                 st.success("Boletim atualizado com sucesso!")
-                                st.cache_data.clear()
+                                recarregar_versoes_nos()
                                 st.rerun()
                             except Exception as e:
                                 st.error(f"Erro ao atualizar o boletim: {e}")
 
     with tab3:
         st.subheader("Mapa de Atividades por Dia")
-        if df_boletins.empty or df_geo_quarteiroes.empty:
-            st.warning("Aviso: Dados de geolocalização dos quarteirões estão ausentes (arquivos no GitHub).")
+        if df_boletins.empty or not contornos_quadras:
+            st.warning("Aviso: Dados de geolocalização dos quarteirões estão ausentes (arquivos KML/CSV locais).")
         else:
             data_mapa = st.date_input("Selecione a data para visualizar no mapa", date.today(), key="mapa_data_plotly")
             boletim_id_mapa = data_mapa.strftime("%Y-%m-%d")
@@ -2829,32 +3933,97 @@ def modulo_boletim():
                     st.info(f"Nenhuma atividade de campo registrada para o dia {data_mapa.strftime('%d/%m/%Y')}.")
                 else:
                     df_atividades_mapa = pd.DataFrame(atividades_locs)
-                    df_mapa_final = pd.merge(df_atividades_mapa, df_geo_quarteiroes, left_on='quarteirao', right_on='quadra', how='inner')
+                    # Uma linha por quadra: a atividade mais frequente define a cor.
+                    atividades_por_quadra = df_atividades_mapa.groupby('quarteirao').agg(
+                        atividade=('atividade', lambda a: a.mode().iat[0]),
+                        atividades=('atividade', lambda a: ", ".join(sorted(set(a)))),
+                        equipes=('equipe', lambda e: " | ".join(sorted(set(e)))),
+                    )
+                    detalhado = contornos_quadras[max(contornos_quadras)]
+                    trabalhadas = detalhado[detalhado['quadra'].isin(atividades_por_quadra.index)]
 
-                    if df_mapa_final.empty:
+                    if trabalhadas.empty:
                         st.warning("Não foi possível encontrar as coordenadas para os quarteirões trabalhados.")
                     else:
-                        st.info(f"Exibindo {len(df_mapa_final)} atividades no mapa para {data_mapa.strftime('%d/%m/%Y')}.")
-
-                        fig = px.scatter_mapbox(
-                            df_mapa_final,
-                            lat="lat",
-                            lon="lon",
-                            color="atividade",
-                            hover_name="quarteirao",
-                            hover_data={"equipe": True, "atividade": True, "lat": False, "lon": False},
-                            zoom=13,
-                            height=600,
-                            title="Distribuição de Atividades por Quarteirão"
+                        st.info(f"Exibindo {len(df_atividades_mapa)} atividades em {trabalhadas['quadra'].nunique()} quarteirões para {data_mapa.strftime('%d/%m/%Y')}.")
+
+                        # O enquadramento das quadras trabalhadas define o zoom, e o zoom
+                        # escolhe o nível de simplificação de todas as quadras desenhadas.
+                        # O nível é escolhido uma vez, pela vista inicial: aproximar ou
+                        # afastar no navegador não troca de nível (o pydeck não devolve o
+                        # zoom ao script), então de muito perto as formas ficam mais grosseiras.
+                        vista = pdk.data_utils.compute_view([v for poligono in trabalhadas['poligono'] for v in poligono])
+                        vista.zoom = min(vista.zoom, 17)
+                        vista.pitch, vista.bearing = 0, 0
+                        camada_quadras = geodados.nivel_para_zoom(contornos_quadras, vista.zoom).merge(
+                            atividades_por_quadra, left_on='quadra', right_index=True, how='left'
                         )
-                        
-                        fig.update_layout(
-                            mapbox_style="open-street-map",
-                            margin={"r":0, "t":40, "l":0, "b":0},
-                            legend_title_text='Atividades'
+
+                        paleta = px.colors.qualitative.Plotly
+                        cores_atividade = {
+                            atividade: [int(paleta[i % len(paleta)][j:j + 2], 16) for j in (1, 3, 5)]
+                            for i, atividade in enumerate(sorted(atividades_por_quadra['atividade'].unique()))
+                        }
+                        ativas = camada_quadras['atividade'].notna()
+                        estimadas = camada_quadras['origem'] == 'estimado'
+                        camada_quadras['rotulo'] = (
+                            "<b>Quarteirão " + camada_quadras['quadra'] + "</b><br/>"
+                            + camada_quadras['atividades'].fillna("") + "<br/>" + camada_quadras['equipes'].fillna("")
+                            + np.where(estimadas, "<br/><i>Contorno estimado</i>", "")
                         )
-                        
-                        st.plotly_chart(fig, use_container_width=True)
+                        # Formas estimadas (quadra sem contorno no KML) ficam mais claras e com borda tênue.
+                        camada_quadras['cor'] = [
+                            cores_atividade[atividade] + [120 if estimada else 190] if ativa else [150, 150, 150, 45]
+                            for atividade, ativa, estimada in zip(camada_quadras['atividade'], ativas, estimadas)
+                        ]
+                        camada_quadras['cor_borda'] = [
+                            [40, 40, 40, 90] if estimada else [40, 40, 40, 220] for estimada in estimadas
+                        ]
+
+                        # Ruas só a partir do zoom de bairro: o nível inteiro na área das quadras
+                        # trabalhadas, com folga. A largura real do gráfico não chega ao script,
+                        # então a área não depende dela; arrastar para longe dessa área mostra
+                        # o mapa sem ruas.
+                        ruas_visiveis = geodados.ruas_na_janela(
+                            carregar_niveis_ruas(),
+                            *geodados.janela_dos_poligonos(trabalhadas['poligono']),
+                            vista.zoom,
+                        )
+                        ruas_visiveis['rotulo'] = ruas_visiveis['rua'].str.title()
+
+                        camadas = [
+                            pdk.Layer(
+                                "PolygonLayer", camada_quadras[~ativas][['poligono', 'cor']],
+                                get_polygon="poligono", get_fill_color="cor",
+                                get_line_color=[120, 120, 120, 120], line_width_min_pixels=0.5,
+                                stroked=True, filled=True, pickable=False,
+                            ),
+                            pdk.Layer(
+                                "PathLayer", ruas_visiveis[['caminho', 'rotulo']],
+                                get_path="caminho", get_color=[90, 90, 90, 200],
+                                width_units="pixels", get_width=1.5, pickable=True,
+                            ),
+                            pdk.Layer(
+                                "PolygonLayer", camada_quadras[ativas][['poligono', 'cor', 'cor_borda', 'rotulo']],
+                                get_polygon="poligono", get_fill_color="cor",
+                                get_line_color="cor_borda", line_width_min_pixels=1,
+                                stroked=True, filled=True, pickable=True, auto_highlight=True,
+                            ),
+                        ]
+                        st.pydeck_chart(pdk.Deck(
+                            layers=camadas,
+                            initial_view_state=vista,
+                            map_style=pdk.map_styles.LIGHT,
+                            tooltip={"html": "{rotulo}"},
+                        ), use_container_width=True, height=ALTURA_MAPA_ATIVIDADES_PX)
+
+                        st.markdown(" ".join(
+                            f"<span style='display:inline-block; width:12px; height:12px; background:rgb({r},{g},{b}); "
+                            f"margin:0 4px 0 12px; border-radius:2px;'></span>{atividade}"
+                            for atividade, (r, g, b) in cores_atividade.items()
+                        ), unsafe_allow_html=True)
+                        if estimadas[ativas].any():
+                            st.caption("Quadras sem contorno no KML aparecem com formas estimadas a partir do seu ponto (cores mais claras); servem só como referência de localização.")
             else:
                 st.info(f"Nenhum boletim encontrado para o dia {data_mapa.strftime('%d/%m/%Y')}.")
 
@@ -2873,44 +4042,30 @@ def modulo_boletim():
             )
 
             if data_inicio_dash and data_fim_dash and data_inicio_dash <= data_fim_dash:
-                df_boletins['data_dt'] = pd.to_datetime(df_boletins['data']).dt.date
-                df_boletins_filtrado = df_boletins[
-                    (df_boletins['data_dt'] >= data_inicio_dash) &
-                    (df_boletins['data_dt'] <= data_fim_dash)
-                ]
+                datas_boletins = pd.to_datetime(df_boletins['data'], errors='coerce').dt.date
+                tem_boletins = ((datas_boletins >= data_inicio_dash) & (datas_boletins <= data_fim_dash)).any()
 
-                if df_boletins_filtrado.empty:
+                if not tem_boletins:
                     st.warning("Nenhum boletim encontrado no período selecionado.")
                 else:
-                    dados_analise = []
-                    for _, boletim in df_boletins_filtrado.iterrows():
-                        data = boletim['data']
-                        for turno in ['equipes_manha', 'equipes_tarde']:
-                            if turno in boletim and boletim[turno] and isinstance(boletim[turno], list):
-                                for equipe in boletim[turno]:
-                                    membros = equipe.get('membros', [])
-                                    atividades = equipe.get('atividades', [])
-                                    quarteiroes = equipe.get('quarteiroes', [])
-                                    for membro in membros:
-                                        dados_analise.append({'data': data, 'membro': formatar_nome(membro)})
-                                    for atividade in atividades:
-                                        dados_analise.append({'data': data, 'atividade': atividade})
-                                    for quarteirao in quarteiroes:
-                                        dados_analise.append({'data': data, 'quarteirao': quarteirao})
-
-                    if not dados_analise:
+                    rollup_diario = carregar_produtividade_diaria()
+                    top_quarteiroes = produtividade.somar_periodo(rollup_diario, data_inicio_dash, data_fim_dash, 'quarteirao')
+                    top_atividades = produtividade.somar_periodo(rollup_diario, data_inicio_dash, data_fim_dash, 'atividade')
+                    participacao = produtividade.somar_periodo(rollup_diario, data_inicio_dash, data_fim_dash, 'membro')
+                    if not participacao.empty:
+                        participacao = participacao.groupby(participacao.index.map(formatar_nome)).sum().sort_values(ascending=False)
+
+                    if top_quarteiroes.empty and top_atividades.empty and participacao.empty:
                         st.info("Nenhuma atividade registrada no período para análise.")
                     else:
-                        df_analise = pd.DataFrame(dados_analise)
-
                         st.divider()
                         st.markdown("#### Análise Gráfica do Período")
                         col1, col2 = st.columns(2)
 
                         with col1:
                             st.markdown("**Quarteirões Mais Trabalhados**")
-                            if 'quarteirao' in df_analise.columns and not df_analise['quarteirao'].dropna().empty:
-                                top_quarteiroes = df_analise['quarteirao'].value_counts().nlargest(15)
+                            if not top_quarteiroes.empty:
+                                top_quarteiroes = top_quarteiroes.nlargest(15)
                                 fig = px.bar(top_quarteiroes, x=top_quarteiroes.index, y=top_quarteiroes.values,
                                              labels={'y': 'Nº de Vezes Trabalhado', 'x': 'Quarteirão'}, text_auto=True)
                                 fig.update_layout(title_x=0.5, xaxis_title="", yaxis_title="")
@@ -2920,8 +4075,7 @@ def modulo_boletim():
                         
                         with col2:
                             st.markdown("**Atividades Mais Executadas**")
-                            if 'atividade' in df_analise.columns and not df_analise['atividade'].dropna().empty:
-                                top_atividades = df_analise['atividade'].value_counts()
+                            if not top_atividades.empty:
                                 fig_pie = px.pie(top_atividades, values=top_atividades.values, names=top_atividades.index, 
                                                  hole=.3, color_discrete_sequence=px.colors.sequential.RdBu)
                                 fig_pie.update_layout(title_x=0.5)
@@ -2931,8 +4085,7 @@ def modulo_boletim():
                         
                         st.divider()
                         st.markdown("**Participação dos Funcionários (por turnos trabalhados)**")
-                        if 'membro' in df_analise.columns and not df_analise['membro'].dropna().empty:
-                            participacao = df_analise['membro'].value_counts()
+                        if not participacao.empty:
                             fig_part = px.bar(participacao, x=participacao.index, y=participacao.values,
                                              labels={'y': 'Nº de Turnos', 'x': 'Funcionário'}, text_auto=True)
                             fig_part.update_layout(title_x=0.5, xaxis_title="", yaxis_title="")
@@ -2941,6 +4094,31 @@ def modulo_boletim():
                             st.info("Nenhum dado de participação no período.")
 
 
+# --- MOVIMENTAÇÃO DE ESTOQUE ---
+# A quantidade muda numa transação no próprio produto: se ele foi removido nesse meio-
+# tempo nada é gravado (um incremento solto criaria um produto só com 'quantidade'), e
+# uma saída maior que o saldo gravado no servidor é recusada. O valor devolvido é o que
+# ficou gravado, não uma conta feita com o espelho local.
+class EstoqueInsuficiente(Exception):
+    pass
+
+def movimentar_estoque(prod_id, delta):
+    resultado = {}
+    def aplicar(atual):
+        resultado.clear()
+        if not isinstance(atual, dict):
+            return atual
+        quantidade = int(atual.get('quantidade') or 0)
+        if quantidade + delta < 0:
+            resultado['disponivel'] = quantidade
+            return atual
+        resultado['quantidade'] = quantidade + delta
+        return {**atual, 'quantidade': quantidade + delta, 'updated_at': CARIMBO_SERVIDOR}
+    db.reference(f'estoque_produtos/{prod_id}').transaction(aplicar)
+    if 'disponivel' in resultado:
+        raise EstoqueInsuficiente(f"Quantidade insuficiente em estoque. Disponivel: {resultado['disponivel']}")
+    return resultado.get('quantidade')
+
 def modulo_estoque():
     st.markdown("""
         <div class="mod-header">
@@ -2949,9 +4127,9 @@ def modulo_estoque():
         </div>
     """, unsafe_allow_html=True)
 
-    df_estoque = carregar_dados_firebase('estoque_produtos')
-    df_entregas = carregar_dados_firebase('estoque_entregas')
-    df_funcionarios = carregar_dados_firebase('funcionarios')
+    df_estoque, df_entregas, df_funcionarios = carregar_em_paralelo(
+        'estoque_produtos', 'estoque_entregas', 'funcionarios'
+    )
 
     if not df_funcionarios.empty:
         nome_map_est = {formatar_nome(nome): nome for nome in df_funcionarios['nome']}
@@ -3023,11 +4201,10 @@ def modulo_estoque():
                 "data_cadastro": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             }
             try:
-                ref = db.reference(f'estoque_produtos/{produto_id}')
-                ref.set(produto_data)
+                gravar_registro('estoque_produtos', produto_id, produto_data)
                 log_atividade(st.session_state.get('username'), "Cadastrou produto no estoque", f"Nome: {nome_produto}, Tipo: {tipo_produto}, Qtd: {quantidade_produto}")
                 st.success(f"Produto '{nome_produto}' cadastrado com sucesso!")
-                st.cache_data.clear()
+                recarregar_versoes_nos()
                 st.rerun()
             except Exception as e:
                 st.error(f"Erro ao cadastrar produto: {e}")
@@ -3090,7 +4267,7 @@ def modulo_estoque():
                             col_b1, col_b2 = st.columns(2)
                             with col_b1:
                                 if st.form_submit_button("✅ Salvar", use_container_width=True):
-                                    db.reference(f'estoque_produtos/{idx_prod}').update({
+                                    atualizar_registro('estoque_produtos', idx_prod, {
                                         "tipo": tipo_edit, "nome": nome_edit, "tamanho": tam_edit,
                                         "ca": ca_edit, "validade": val_edit, "marca": marca_edit,
                                         "quantidade": qtd_edit
@@ -3098,7 +4275,7 @@ def modulo_estoque():
                                     log_atividade(st.session_state.get('username'), "Editou produto", f"Nome: {nome_edit}")
                                     st.success(f"Produto '{nome_edit}' atualizado!")
                                     st.session_state.est_editando_id = None
-                                    st.cache_data.clear()
+                                    recarregar_versoes_nos()
                                     st.rerun()
                             with col_b2:
                                 if st.form_submit_button("Cancelar", use_container_width=True):
@@ -3138,10 +4315,10 @@ def modulo_estoque():
                                 st.rerun()
                         with col_a2:
                             if st.button("🗑️ Deletar", key=f"del_est_{idx_prod}", use_container_width=True):
-                                db.reference(f'estoque_produtos/{idx_prod}').delete()
+                                remover_registro('estoque_produtos', idx_prod)
                                 log_atividade(st.session_state.get('username'), "Deletou produto", f"Nome: {p_nome}")
                                 st.success(f"Produto '{p_nome}' deletado.")
-                                st.cache_data.clear()
+                                recarregar_versoes_nos()
                                 st.rerun()
         else:
             st.markdown("""
@@ -3223,16 +4400,25 @@ def modulo_estoque():
                             }
 
                             try:
-                                db.reference(f'estoque_entregas/{entrega_id}').set(entrega_data)
-
-                                novo_estoque = estoque_atual - qtd_entrega
-                                db.reference(f'estoque_produtos/{prod_id}').update({"quantidade": novo_estoque})
+                                novo_estoque = movimentar_estoque(prod_id, -qtd_entrega)
+                                if novo_estoque is None:
+                                    raise EstoqueInsuficiente("Este produto foi removido do estoque.")
+                                try:
+                                    gravar_em_lote(
+                                        operacao_gravar('estoque_entregas', entrega_id, entrega_data),
+                                        {'_versoes/estoque_produtos': INCREMENTO_VERSAO}
+                                    )
+                                except Exception:
+                                    movimentar_estoque(prod_id, qtd_entrega)
+                                    raise
 
                                 log_atividade(st.session_state.get('username'), "Registrou entrega de estoque", f"Produto: {prod_dados.get('nome', '')}, Qtd: {qtd_entrega}, Para: {dest_nome}")
 
                                 st.success(f"Entrega registrada! {qtd_entrega}x {prod_dados.get('nome', '')} para {dest_nome}. Estoque restante: {novo_estoque}")
-                                st.cache_data.clear()
+                                recarregar_versoes_nos()
                                 st.rerun()
+                            except EstoqueInsuficiente as e:
+                                st.error(str(e))
                             except Exception as e:
                                 st.error(f"Erro ao registrar entrega: {e}")
                 else:
@@ -3313,20 +4499,22 @@ def modulo_estoque():
                             prod_id = entrega.get('produto_id')
                             qtd_devolvida = int(e_qtd)
                             
-                            if prod_id:
-                                prod_ref = db.reference(f'estoque_produtos/{prod_id}').get()
-                                if prod_ref:
-                                    estoque_atual = int(prod_ref.get('quantidade', 0))
-                                    db.reference(f'estoque_produtos/{prod_id}').update({
-                                        'quantidade': estoque_atual + qtd_devolvida
-                                    })
-                            
-                            db.reference(f'estoque_entregas/{idx_ent}').delete()
+                            # Só devolve ao estoque se o produto ainda existir (checado na transação).
+                            estoque_final = movimentar_estoque(prod_id, qtd_devolvida) if prod_id else None
+                            try:
+                                gravar_em_lote(operacao_remover('estoque_entregas', idx_ent), {'_versoes/estoque_produtos': INCREMENTO_VERSAO})
+                            except Exception:
+                                if estoque_final is not None:
+                                    movimentar_estoque(prod_id, -qtd_devolvida)
+                                raise
                             
                             log_atividade(st.session_state.get('username'), "Deletou entrega e restaurou estoque", f"Produto: {e_prod}, Qtd: {qtd_devolvida}, Destinatário: {e_dest}")
                             
-                            st.success(f"Registro apagado. A quantidade de {qtd_devolvida} {e_prod} retornou ao estoque.")
-                            st.cache_data.clear()
+                            if estoque_final is None:
+                                st.success(f"Registro apagado. O produto {e_prod} não existe mais no estoque, então nada foi devolvido.")
+                            else:
+                                st.success(f"Registro apagado. A quantidade de {qtd_devolvida} {e_prod} retornou ao estoque (estoque atual: {estoque_final}).")
+                            recarregar_versoes_nos()
                             time.sleep(1)
                             st.rerun()
                         except Exception as e:
@@ -3349,36 +4537,78 @@ def modulo_logs():
         </div>
     """, unsafe_allow_html=True)
 
-    df_logs = carregar_dados_firebase('logs_de_atividade')
+    _migracao_logs_legados()
+    aba_periodo, aba_historico = st.tabs(["📄 Registros por Período", "📊 Histórico (contagens)"])
 
-    if not df_logs.empty:
-        df_logs['timestamp_dt'] = pd.to_datetime(df_logs['timestamp'])
-        df_logs_display = df_logs.sort_values(by='timestamp_dt', ascending=False).copy()
-        
-        st.sidebar.markdown("---")
-        st.sidebar.subheader("Filtrar Logs")
-        usuarios_logados = sorted(df_logs_display['usuario'].unique().tolist())
-        filtro_usuario = st.sidebar.selectbox("Filtrar por Usuário", options=["Todos"] + usuarios_logados)
-
-        acoes_disponiveis = sorted(df_logs_display['acao'].unique().tolist())
-        filtro_acao = st.sidebar.multiselect("Filtrar por Ação", options=acoes_disponiveis)
-
-        if filtro_usuario != "Todos":
-            df_logs_display = df_logs_display[df_logs_display['usuario'] == filtro_usuario]
-
-        if filtro_acao:
-            df_logs_display = df_logs_display[df_logs_display['acao'].isin(filtro_acao)]
-
-        cols_to_display = ['timestamp', 'usuario', 'acao', 'detalhes']
-        st.dataframe(
-            df_logs_display[cols_to_display].rename(
-                columns={'timestamp': 'Data/Hora', 'usuario': 'Usuário', 'acao': 'Ação', 'detalhes': 'Detalhes'}
-            ),
-            use_container_width=True,
-            hide_index=True
-        )
-    else:
-        st.info("Nenhum log de atividade encontrado.")
+    with aba_periodo:
+        hoje = date.today()
+        periodo = st.date_input("Período", value=(hoje - timedelta(days=7), hoje), max_value=hoje, key="logs_periodo", format="DD/MM/YYYY")
+        if isinstance(periodo, (tuple, list)) and len(periodo) == 2:
+            inicio_logs, fim_logs = periodo
+        else:
+            inicio_logs = fim_logs = periodo[0] if isinstance(periodo, (tuple, list)) else periodo
+
+        df_logs = carregar_logs_periodo(inicio_logs, fim_logs)
+
+        if not df_logs.empty:
+            df_logs_display = df_logs.sort_values(by='timestamp', ascending=False).copy()
+            
+            st.sidebar.markdown("---")
+            st.sidebar.subheader("Filtrar Logs")
+            usuarios_logados = sorted(df_logs_display['usuario'].dropna().unique().tolist())
+            filtro_usuario = st.sidebar.selectbox("Filtrar por Usuário", options=["Todos"] + usuarios_logados)
+
+            acoes_disponiveis = sorted(df_logs_display['acao'].dropna().unique().tolist())
+            filtro_acao = st.sidebar.multiselect("Filtrar por Ação", options=acoes_disponiveis)
+
+            if filtro_usuario != "Todos":
+                df_logs_display = df_logs_display[df_logs_display['usuario'] == filtro_usuario]
+
+            if filtro_acao:
+                df_logs_display = df_logs_display[df_logs_display['acao'].isin(filtro_acao)]
+
+            cols_to_display = ['timestamp', 'usuario', 'acao', 'detalhes']
+            st.dataframe(
+                df_logs_display[cols_to_display].rename(
+                    columns={'timestamp': 'Data/Hora', 'usuario': 'Usuário', 'acao': 'Ação', 'detalhes': 'Detalhes'}
+                ),
+                use_container_width=True,
+                hide_index=True
+            )
+        else:
+            st.info("Nenhum log de atividade encontrado no período.")
+
+    with aba_historico:
+        df_resumo_logs = carregar_resumo_logs()
+        if not df_resumo_logs.empty:
+            st.markdown("##### Ações por mês (meses arquivados)")
+            por_mes = df_resumo_logs.groupby('mes')['quantidade'].sum().sort_index()
+            fig_logs = px.bar(por_mes, x=por_mes.index, y=por_mes.values, labels={'x': 'Mês', 'y': 'Ações'}, text_auto=True)
+            st.plotly_chart(fig_logs, use_container_width=True)
+            tabela_resumo = df_resumo_logs.groupby(['mes', 'usuario', 'acao'], as_index=False)['quantidade'].sum().sort_values(['mes', 'quantidade'], ascending=[False, False])
+            st.dataframe(tabela_resumo.rename(columns={'mes': 'Mês', 'usuario': 'Usuário', 'acao': 'Ação', 'quantidade': 'Quantidade'}), use_container_width=True, hide_index=True)
+        else:
+            st.info("Nenhum mês arquivado ainda.")
+
+        if is_admin():
+            st.divider()
+            st.markdown("##### Arquivar meses antigos")
+            limite_online = date.today().replace(day=1) - relativedelta(months=LOG_MESES_ONLINE)
+            meses_para_arquivar = [(a, m) for a, m in listar_meses_logs() if date(a, m, 1) < limite_online]
+            if meses_para_arquivar:
+                st.caption(f"Meses anteriores a {limite_online.strftime('%m/%Y')} ainda no Firebase: {', '.join(f'{m:02d}/{a}' for a, m in meses_para_arquivar)}")
+                if st.button("🗄️ Arquivar meses antigos", key="arquivar_logs"):
+                    try:
+                        for ano_arq, mes_arq in meses_para_arquivar:
+                            arquivar_mes_logs(ano_arq, mes_arq)
+                        log_atividade(st.session_state.get('username'), "Arquivou logs", f"Meses: {len(meses_para_arquivar)}")
+                        st.success(f"{len(meses_para_arquivar)} mês(es) arquivado(s) no banco ({LOG_ARQUIVO_RAIZ}).")
+                        recarregar_versoes_nos()
+                        st.rerun()
+                    except Exception as e:
+                        st.error(f"Erro ao arquivar logs: {e}")
+            else:
+                st.caption(f"Nenhum mês com mais de {LOG_MESES_ONLINE} meses no Firebase.")
 
 
 def modulo_contas():
@@ -3504,7 +4734,7 @@ def login_screen():
             st.rerun()
             
         # Mostra o iframe ocupando quase a tela toda (850px de altura)
-        components.iframe("https://fernandafrisson.github.io/sistema-gestao/mapa.html?v=6", height=850, scrolling=True)
+        components.iframe("https://fernandafrisson.github.io/sistema-gestao/mapa.html?v=7", height=850, scrolling=True)
         
     else:
         # Mostra a tela de login normal com a sua logo personalizada
@@ -3606,6 +4836,7 @@ def main_app():
                 st.rerun()
 
     else:
+        carregar_em_paralelo('funcionarios', 'avisos', 'folgas_ferias', 'boletins')
         st.markdown("""
             <div class="mod-header">
                 <h2>🏥 Painel de Controle</h2>
@@ -3712,13 +4943,13 @@ def main_app():
                                 'descricao': descricao_edit,
                                 'participantes': participantes_edit
                             }
-                            db.reference(f'avisos/{st.session_state.evento_para_editar_id}').update(dados_atualizados)
+                            atualizar_registro('avisos', st.session_state.evento_para_editar_id, dados_atualizados)
                             
                             log_atividade(st.session_state.get('username'), "Editou aviso no mural", f"Título: {titulo_edit}")
 
                             st.success("Evento atualizado com sucesso!")
                             st.session_state.evento_para_editar_id = None
-                            st.cache_data.clear()
+                            recarregar_versoes_nos()
                             st.rerun()
 
                     with col_cancel:
@@ -3747,8 +4978,7 @@ def main_app():
                     if aviso_titulo and aviso_data:
                         try:
                             aviso_id = str(int(time.time() * 1000))
-                            ref = db.reference(f'avisos/{aviso_id}')
-                            ref.set({
+                            gravar_registro('avisos', aviso_id, {
                                 'titulo': aviso_titulo,
                                 'data': aviso_data.strftime("%Y-%m-%d"),
                                 'tipo_aviso': st.session_state.tipo_evento_selecionado,
@@ -3759,7 +4989,7 @@ def main_app():
                             log_atividade(st.session_state.get('username'), "Adicionou aviso no mural", f"Título: {aviso_titulo}")
 
                             st.success("Evento salvo no mural com sucesso!")
-                            st.cache_data.clear()
+                            recarregar_versoes_nos()
                             st.rerun()
                         except Exception as e:
                             st.error(f"Erro ao salvar o aviso: {e}")
@@ -3798,12 +5028,12 @@ def main_app():
                                     st.rerun()
                             with col_b2:
                                 if st.button("🗑️ Deletar", key=f"del_{id}", type="primary", use_container_width=True):
-                                    db.reference(f'avisos/{id}').delete()
+                                    remover_registro('avisos', id)
                                     
                                     log_atividade(st.session_state.get('username'), "Deletou aviso no mural", f"Título: {aviso.get('titulo')}")
 
                                     st.success(f"Evento '{aviso.get('titulo')}' deletado.")
-                                    st.cache_data.clear()
+                                    recarregar_versoes_nos()
                                     st.rerun()
             else:
                 st.info("Nenhum evento no mural para exibir.")
@@ -3822,62 +5052,34 @@ def main_app():
             )
             st.markdown("<br>", unsafe_allow_html=True)
             
-            df_folgas = carregar_dados_firebase('folgas_ferias')
-            df_avisos_cal = carregar_dados_firebase('avisos')
-            
-            calendar_events = []
+            # Só o mês visível (mais a margem da grade) vai para o calendário.
+            if 'mes_calendario' not in st.session_state:
+                st.session_state.mes_calendario = calendario.primeiro_dia_do_mes(date.today())
+            col_ant, col_mes, col_hoje, col_prox = st.columns([1, 2, 1, 1])
+            if col_ant.button("◀ Anterior", key="cal_mes_anterior", use_container_width=True):
+                st.session_state.mes_calendario = calendario.deslocar_mes(st.session_state.mes_calendario, -1)
+            if col_hoje.button("Hoje", key="cal_mes_atual", use_container_width=True):
+                st.session_state.mes_calendario = calendario.primeiro_dia_do_mes(date.today())
+            if col_prox.button("Próximo ▶", key="cal_mes_proximo", use_container_width=True):
+                st.session_state.mes_calendario = calendario.deslocar_mes(st.session_state.mes_calendario, 1)
+            mes_calendario = st.session_state.mes_calendario
+            col_mes.markdown(
+                f"<h4 style='text-align: center; margin: 0;'>{relatorios.MESES_PT[mes_calendario.month - 1]} de {mes_calendario.year}</h4>",
+                unsafe_allow_html=True,
+            )
 
-            # 1. Carrega e filtra Férias/Abonadas
-            if not df_folgas.empty:
-                for _, row in df_folgas.iterrows():
-                    tipo_ausencia = row.get('tipo', 'Ausência')
-                    
-                    # Exibe se o filtro for "Todos" ou se bater exatamente com o tipo selecionado
-                    if filtro_selecionado == "Todos" or filtro_selecionado == tipo_ausencia:
-                        nome_ausente = formatar_nome(row.get('nome_funcionario', ''))
-                        cor_evento = "#FF4B4B" if tipo_ausencia == "Férias" else "#FFA07A"
-                        
-                        data_inicio_obj = pd.to_datetime(row['data_inicio']).date()
-                        data_fim_obj = pd.to_datetime(row['data_fim']).date()
-                        
-                        # Lógica para quebrar as férias dia por dia (evita faixas longas poluidoras)
-                        dias_total = (data_fim_obj - data_inicio_obj).days + 1
-                        for i in range(dias_total):
-                            dia_atual = data_inicio_obj + timedelta(days=i)
-                            calendar_events.append({
-                                "title": f"AUSÊNCIA: {nome_ausente} ({tipo_ausencia})",
-                                "start": dia_atual.strftime("%Y-%m-%d"),
-                                "color": cor_evento,
-                            })
-            
-            # 2. Carrega e filtra Eventos do Mural
-            if not df_avisos_cal.empty:
-                event_colors = {
-                    "Aviso": "#ffc107",
-                    "Compromisso": "#28a745",
-                    "Reunião": "#007bff",
-                    "Curso": "#6f42c1",
-                    "Educativa": "#fd7e14"
-                }
-                for _, row in df_avisos_cal.iterrows():
-                    event_type = row.get('tipo_aviso', 'Aviso')
-                    
-                    # Exibe se o filtro for "Todos" ou se bater exatamente com o tipo selecionado
-                    if filtro_selecionado == "Todos" or filtro_selecionado == event_type:
-                        calendar_events.append({
-                            "title": f"{event_type.upper()}: {row['titulo']}",
-                            "start": row['data'],
-                            "end": (pd.to_datetime(row['data']) + timedelta(days=1)).strftime("%Y-%m-%d"),
-                            "color": event_colors.get(event_type, "#1B4F72"),
-                        })
+            calendar_events = carregar_eventos_calendario(
+                mes_calendario, None if filtro_selecionado == "Todos" else filtro_selecionado
+            )
 
             # Opções de renderização do calendário
             calendar_options = {
                 "initialView": "dayGridMonth",
+                "initialDate": mes_calendario.strftime("%Y-%m-%d"),
                 "height": "800px",
                 "locale": "pt-br",
                 "headerToolbar": {
-                    "left": "prev,next today",
+                    "left": "",
                     "center": "title",
                     "right": "dayGridMonth,timeGridWeek"
                 },
@@ -3890,7 +5092,7 @@ def main_app():
             
             # Renderiza o calendário
             if calendar_events:
-                calendar(events=calendar_events, options=calendar_options, key="calendario_mural_atualizado")
+                calendar(events=calendar_events, options=calendar_options, key=f"calendario_mural_{mes_calendario:%Y_%m}")
             else:
                 st.info("Nenhum evento corresponde ao filtro selecionado.")
 
@@ -0,0 +1,154 @@
+import bisect
+import statistics
+from collections import defaultdict
+from datetime import date
+
+import pandas as pd
+
+# --- ÍNDICE DE AUSÊNCIAS ---
+# Reúne férias e abonadas ('folgas_ferias') e as faltas anotadas nos boletins num único
+# índice de intervalos [inicio, fim] (datas inclusivas). Cada bloco é uma árvore de
+# intervalos centrada: cada nó guarda os intervalos que contêm o seu ponto central,
+# ordenados pelo início e pelo fim, e delega os que terminam antes ou começam depois
+# aos filhos. Uma consulta custa O(log n + k), mesmo com ausências longas (uma licença
+# de anos não obriga a revisitar tudo o que começou depois dela).
+ORIGEM_FOLGAS = 'folgas_ferias'
+ORIGEM_BOLETIM = 'boletins'
+TIPOS_LICENCA = ['Férias', 'Abonada']
+TURNOS_FALTA = {'faltas_manha': 'Falta (Manhã)', 'faltas_tarde': 'Falta (Tarde)'}
+
+
+def _datas(valores):
+    return pd.to_datetime(valores, errors='coerce', format='mixed').dt.date
+
+def _intervalos_folgas(df_folgas):
+    if df_folgas.empty or not {'tipo', 'data_inicio', 'data_fim'}.issubset(df_folgas.columns):
+        return []
+    df = pd.DataFrame({
+        'chave': df_folgas.index.astype(str),
+        'id_funcionario': df_folgas['id_funcionario'] if 'id_funcionario' in df_folgas.columns else None,
+        'nome': df_folgas['nome_funcionario'] if 'nome_funcionario' in df_folgas.columns else '',
+        'tipo': df_folgas['tipo'],
+        'inicio': _datas(df_folgas['data_inicio']),
+        'fim': _datas(df_folgas['data_fim']),
+    }).dropna(subset=['inicio', 'fim'])
+    df['id_funcionario'] = df['id_funcionario'].map(lambda v: str(v) if pd.notna(v) else None)
+    df['origem'] = ORIGEM_FOLGAS
+    return df.to_dict('records')
+
+def _intervalos_boletins(df_boletins, nome_para_id):
+    intervalos = []
+    if df_boletins.empty:
+        return intervalos
+    for chave, boletim in df_boletins.iterrows():
+        dia = pd.to_datetime(boletim.get('data') or chave, errors='coerce')
+        if pd.isna(dia):
+            continue
+        for campo, tipo in TURNOS_FALTA.items():
+            faltas = boletim.get(campo)
+            if not isinstance(faltas, dict):
+                continue
+            for nome in faltas.get('nomes', []) or []:
+                intervalos.append({
+                    'chave': str(chave), 'id_funcionario': nome_para_id.get(nome), 'nome': nome,
+                    'tipo': tipo, 'inicio': dia.date(), 'fim': dia.date(), 'origem': ORIGEM_BOLETIM,
+                    'motivo': faltas.get('motivo', ''),
+                })
+    return intervalos
+
+def _arvore(posicoes, inicios, fins):
+    # posicoes vem ordenada pelo início; o centro é a mediana dos extremos.
+    if not posicoes:
+        return None
+    centro = statistics.median_low([inicios[p] for p in posicoes] + [fins[p] for p in posicoes])
+    esquerda, direita, no_centro = [], [], []
+    for p in posicoes:
+        if fins[p] < centro:
+            esquerda.append(p)
+        elif inicios[p] > centro:
+            direita.append(p)
+        else:
+            no_centro.append(p)
+    por_fim = sorted(no_centro, key=lambda p: fins[p], reverse=True)
+    return {
+        'centro': centro,
+        'por_inicio': no_centro,
+        'inicios': [inicios[p] for p in no_centro],
+        'por_fim': por_fim,
+        'fins_desc': [-fins[p] for p in por_fim],
+        'esquerda': _arvore(esquerda, inicios, fins),
+        'direita': _arvore(direita, inicios, fins),
+    }
+
+def _bloco(intervalos):
+    intervalos = sorted(intervalos, key=lambda i: (i['inicio'], i['fim']))
+    inicios = [i['inicio'].toordinal() for i in intervalos]
+    fins = [i['fim'].toordinal() for i in intervalos]
+    return {
+        'intervalos': intervalos,
+        'arvore': _arvore(list(range(len(intervalos))), inicios, fins),
+    }
+
+def construir_indice_ausencias(df_folgas, df_boletins=None, df_funcionarios=None):
+    nome_para_id = {}
+    if df_funcionarios is not None and not df_funcionarios.empty and 'nome' in df_funcionarios.columns:
+        nome_para_id = dict(zip(df_funcionarios['nome'], df_funcionarios['id'].astype(str)))
+    folgas = _intervalos_folgas(df_folgas)
+    boletins = _intervalos_boletins(df_boletins, nome_para_id) if df_boletins is not None else []
+
+    por_funcionario = defaultdict(list)
+    for intervalo in folgas + boletins:
+        if intervalo['id_funcionario']:
+            por_funcionario[intervalo['id_funcionario']].append(intervalo)
+    return {
+        'geral': _bloco(folgas + boletins),
+        'por_funcionario': {chave: _bloco(lista) for chave, lista in por_funcionario.items()},
+        'tem_folgas': bool(folgas),
+    }
+
+def _sobrepostos(bloco, inicio, fim, tipos=None):
+    inicio, fim = inicio.toordinal(), fim.toordinal()
+    posicoes, pendentes = [], [bloco['arvore']]
+    while pendentes:
+        no = pendentes.pop()
+        if no is None:
+            continue
+        if fim < no['centro']:
+            # Todos no nó terminam depois de fim; basta começarem até fim.
+            posicoes.extend(no['por_inicio'][:bisect.bisect_right(no['inicios'], fim)])
+            pendentes.append(no['esquerda'])
+        elif inicio > no['centro']:
+            # Todos no nó começam antes de inicio; basta terminarem a partir dele.
+            posicoes.extend(no['por_fim'][:bisect.bisect_right(no['fins_desc'], -inicio)])
+            pendentes.append(no['direita'])
+        else:
+            posicoes.extend(no['por_inicio'])
+            pendentes.append(no['esquerda'])
+            pendentes.append(no['direita'])
+    intervalos = bloco['intervalos']
+    return [
+        intervalos[p] for p in sorted(posicoes)
+        if tipos is None or intervalos[p]['tipo'] in tipos
+    ]
+
+def ausentes_no_dia(indice, dia, tipos=None):
+    return _sobrepostos(indice['geral'], dia, dia, tipos)
+
+def ids_ausentes_no_dia(indice, dia, tipos=None):
+    return {i['id_funcionario'] for i in ausentes_no_dia(indice, dia, tipos) if i['id_funcionario']}
+
+def ausencias_no_periodo(indice, inicio, fim, tipos=None):
+    return _sobrepostos(indice['geral'], inicio, fim, tipos)
+
+def sobreposicoes(indice, id_funcionario, inicio, fim, tipos=None):
+    bloco = indice['por_funcionario'].get(str(id_funcionario))
+    return _sobrepostos(bloco, inicio, fim, tipos) if bloco else []
+
+def historico_funcionario(indice, id_funcionario, tipos=None, ano=None):
+    bloco = indice['por_funcionario'].get(str(id_funcionario))
+    if not bloco:
+        return []
+    return [
+        i for i in bloco['intervalos']
+        if (tipos is None or i['tipo'] in tipos) and (ano is None or i['inicio'].year == ano)
+    ]
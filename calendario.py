@@ -0,0 +1,79 @@
+import bisect
+from datetime import date, timedelta
+
+import pandas as pd
+
+from ausencias import ORIGEM_FOLGAS, ausencias_no_periodo
+
+# --- FEED DO CALENDÁRIO GERAL ---
+# O calendário recebe só o mês visível mais uma margem que cobre as semanas vizinhas
+# que a grade mensal mostra. Férias e abonadas viram um evento por intervalo (o 'end'
+# do FullCalendar é exclusivo, daí o dia a mais), achados no índice de ausências; os
+# avisos são indexados pela data e recortados por bisect.
+MARGEM_JANELA_DIAS = 14
+CORES_AUSENCIA = {'Férias': '#FF4B4B'}
+COR_AUSENCIA_PADRAO = '#FFA07A'
+CORES_AVISO = {
+    'Aviso': '#ffc107',
+    'Compromisso': '#28a745',
+    'Reunião': '#007bff',
+    'Curso': '#6f42c1',
+    'Educativa': '#fd7e14',
+}
+COR_AVISO_PADRAO = '#1B4F72'
+
+
+def primeiro_dia_do_mes(dia):
+    return dia.replace(day=1)
+
+def deslocar_mes(mes, passos):
+    indice = mes.year * 12 + mes.month - 1 + passos
+    return date(indice // 12, indice % 12 + 1, 1)
+
+def janela_do_mes(mes, margem_dias=MARGEM_JANELA_DIAS):
+    inicio = primeiro_dia_do_mes(mes)
+    fim = deslocar_mes(inicio, 1) - timedelta(days=1)
+    return inicio - timedelta(days=margem_dias), fim + timedelta(days=margem_dias)
+
+def indexar_avisos(df_avisos):
+    if df_avisos.empty or 'data' not in df_avisos.columns:
+        return {'datas': [], 'avisos': []}
+    dias = pd.to_datetime(df_avisos['data'], errors='coerce').dt.date
+    avisos = sorted(
+        ((dia, aviso) for dia, aviso in zip(dias, df_avisos.to_dict('records')) if pd.notna(dia)),
+        key=lambda par: par[0],
+    )
+    return {'datas': [dia for dia, _ in avisos], 'avisos': avisos}
+
+def avisos_no_periodo(indice, inicio, fim):
+    datas = indice['datas']
+    return indice['avisos'][bisect.bisect_left(datas, inicio):bisect.bisect_right(datas, fim)]
+
+def eventos_do_periodo(indice_ausencias, indice_avisos, inicio, fim, filtro=None, formatar_nome=str):
+    # filtro=None mostra tudo; senão só o tipo de ausência ou de aviso escolhido.
+    eventos = []
+    tipos = None if filtro is None else [filtro]
+    for ausencia in ausencias_no_periodo(indice_ausencias, inicio, fim, tipos):
+        if ausencia['origem'] != ORIGEM_FOLGAS:
+            continue
+        tipo_ausencia = ausencia['tipo'] or 'Ausência'
+        eventos.append({
+            'title': f"AUSÊNCIA: {formatar_nome(ausencia['nome'])} ({tipo_ausencia})",
+            'start': ausencia['inicio'].strftime('%Y-%m-%d'),
+            'end': (ausencia['fim'] + timedelta(days=1)).strftime('%Y-%m-%d'),
+            'allDay': True,
+            'color': CORES_AUSENCIA.get(tipo_ausencia, COR_AUSENCIA_PADRAO),
+        })
+
+    for dia, aviso in avisos_no_periodo(indice_avisos, inicio, fim):
+        tipo_aviso = aviso.get('tipo_aviso') or 'Aviso'
+        if filtro is not None and filtro != tipo_aviso:
+            continue
+        eventos.append({
+            'title': f"{tipo_aviso.upper()}: {aviso.get('titulo', '')}",
+            'start': dia.strftime('%Y-%m-%d'),
+            'end': (dia + timedelta(days=1)).strftime('%Y-%m-%d'),
+            'allDay': True,
+            'color': CORES_AVISO.get(tipo_aviso, COR_AVISO_PADRAO),
+        })
+    return eventos
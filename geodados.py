@@ -0,0 +1,569 @@
+import math
+import os
+import re
+import json
+import difflib
+import hashlib
+import tempfile
+import threading
+import contextlib
+import unicodedata
+import xml.etree.ElementTree as ET
+from collections import defaultdict
+
+try:
+    import fcntl
+except ImportError:  # Windows: sem trava entre processos, só entre threads.
+    fcntl = None
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+# --- ARQUIVOS GEOGRÁFICOS DO REPOSITÓRIO ---
+DIRETORIO_BASE = os.path.dirname(os.path.abspath(__file__))
+ARQUIVO_RUAS = os.path.join(DIRETORIO_BASE, 'Ruas.kml')
+ARQUIVO_QUADRAS = os.path.join(DIRETORIO_BASE, 'Quadras de Guará.kml')
+ARQUIVO_QUARTEIROES = os.path.join(DIRETORIO_BASE, 'Quarteirao.csv')
+ARQUIVOS_BAIRROS = [
+    os.path.join(DIRETORIO_BASE, nome) for nome in [
+        'Pingo de Ouro.kml', 'Rocinha.kml', 'São Dimas.kml', 'São Manoel.kml', 'Sta Edwirges.kml',
+        'Tamandaré.kml', 'Vista Alegre.kml', 'Jd do Vale.kml', 'Jd Esperança.kml'
+    ]
+]
+
+KML_NS = '{http://www.opengis.net/kml/2.2}'
+
+
+# --- LEITURA DE KML ---
+def _ler_coordenadas(texto):
+    coordenadas = []
+    for trecho in (texto or '').split():
+        partes = trecho.split(',')
+        if len(partes) >= 2:
+            coordenadas.append((float(partes[0]), float(partes[1])))
+    return coordenadas
+
+def ler_kml(caminho):
+    # Retorna um dicionário por Placemark: nome, atributos (ExtendedData) e geometrias
+    # como listas de (lon, lat). Em polígonos, só o anel externo é considerado.
+    placemarks = []
+    for placemark in ET.parse(caminho).getroot().iter(f'{KML_NS}Placemark'):
+        atributos = {
+            dado.get('name'): (dado.text or '').strip()
+            for dado in placemark.iter(f'{KML_NS}SimpleData')
+        }
+        geometrias = []
+        for ponto in placemark.iter(f'{KML_NS}Point'):
+            geometrias.append({'tipo': 'Point', 'coordenadas': _ler_coordenadas(ponto.findtext(f'{KML_NS}coordinates'))})
+        for linha in placemark.iter(f'{KML_NS}LineString'):
+            geometrias.append({'tipo': 'LineString', 'coordenadas': _ler_coordenadas(linha.findtext(f'{KML_NS}coordinates'))})
+        for poligono in placemark.iter(f'{KML_NS}Polygon'):
+            anel = poligono.find(f'{KML_NS}outerBoundaryIs/{KML_NS}LinearRing/{KML_NS}coordinates')
+            geometrias.append({'tipo': 'Polygon', 'coordenadas': _ler_coordenadas(anel.text if anel is not None else '')})
+        placemarks.append({
+            'nome': (placemark.findtext(f'{KML_NS}name') or '').strip(),
+            'atributos': atributos,
+            'geometrias': [g for g in geometrias if g['coordenadas']]
+        })
+    return placemarks
+
+
+# --- BASE COMPILADA (GEOPARQUET) ---
+# Os KMLs e o CSV são convertidos uma vez para GeoParquet (geometria em WKB) em
+# DIRETORIO_COMPILADO. O manifesto guarda o SHA-256 de cada fonte e, se algum arquivo
+# mudar, a base é recompilada na próxima leitura. Também pode ser gerada à mão com
+# "python geodados.py".
+#
+# A base é compilada no primeiro uso de cada deploy, e várias threads (e processos do
+# servidor) podem chegar juntas: a verificação e a compilação ficam sob uma trava de
+# thread e uma trava de arquivo, o manifesto é conferido de novo depois de obtê-las e
+# cada escrita usa um temporário próprio antes do os.replace.
+DIRETORIO_COMPILADO = os.path.join(DIRETORIO_BASE, 'geodados_compilados')
+ARQUIVO_MANIFESTO = 'manifesto.json'
+ARQUIVO_TRAVA = '.compilacao.lock'
+_TRAVA_COMPILACAO = threading.Lock()
+VERSAO_FORMATO = 1
+CRS_KML = 'EPSG:4326'
+
+def _fontes():
+    return [ARQUIVO_QUADRAS, ARQUIVO_RUAS, ARQUIVO_QUARTEIROES] + [c for c in ARQUIVOS_BAIRROS if os.path.exists(c)]
+
+def _hash_arquivo(caminho):
+    with open(caminho, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def _assinatura_fontes():
+    return {'versao': VERSAO_FORMATO, 'fontes': {os.path.basename(c): _hash_arquivo(c) for c in _fontes()}}
+
+def _geometria_shapely(geometria):
+    coordenadas = geometria['coordenadas']
+    if geometria['tipo'] == 'Point':
+        return shapely.Point(coordenadas[0])
+    if geometria['tipo'] == 'LineString' and len(coordenadas) >= 2:
+        return shapely.LineString(coordenadas)
+    if geometria['tipo'] == 'Polygon' and len(coordenadas) >= 3:
+        return shapely.Polygon(coordenadas)
+    return None
+
+def _camada_kml(placemarks, nome_placemark):
+    # Uma linha por geometria: placemarks com várias partes viram várias linhas.
+    linhas = []
+    for placemark in placemarks:
+        for geometria in placemark['geometrias']:
+            forma = _geometria_shapely(geometria)
+            if forma is not None:
+                linhas.append({'nome': nome_placemark(placemark), 'geometry': forma})
+    return gpd.GeoDataFrame(linhas, columns=['nome', 'geometry'], geometry='geometry', crs=CRS_KML)
+
+@contextlib.contextmanager
+def _trava_compilacao(destino):
+    os.makedirs(destino, exist_ok=True)
+    with _TRAVA_COMPILACAO, open(os.path.join(destino, ARQUIVO_TRAVA), 'a') as trava:
+        if fcntl is not None:
+            fcntl.flock(trava, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(trava, fcntl.LOCK_UN)
+
+@contextlib.contextmanager
+def _arquivo_temporario(caminho):
+    # Temporário exclusivo no mesmo diretório do destino (o os.replace exige o mesmo disco).
+    descritor, temporario = tempfile.mkstemp(dir=os.path.dirname(caminho), suffix='.tmp')
+    os.close(descritor)
+    try:
+        yield temporario
+        os.replace(temporario, caminho)
+    finally:
+        if os.path.exists(temporario):
+            os.remove(temporario)
+
+def _gravar_parquet(df, caminho):
+    with _arquivo_temporario(caminho) as temporario:
+        df.to_parquet(temporario, index=False)
+
+def _manifesto_atual(destino):
+    try:
+        with open(os.path.join(destino, ARQUIVO_MANIFESTO), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def compilar_geodados(destino=DIRETORIO_COMPILADO):
+    with _trava_compilacao(destino):
+        return _compilar_geodados(destino)
+
+def _compilar_geodados(destino):
+    # Chamada com a trava de compilação.
+    assinatura = _assinatura_fontes()
+
+    quadras = _camada_kml(ler_kml(ARQUIVO_QUADRAS), lambda p: p['nome'])
+    ruas = _camada_kml(ler_kml(ARQUIVO_RUAS), lambda p: p['atributos'].get('nome') or p['nome'])
+    ruas = ruas[ruas.geom_type == 'LineString']
+    partes_bairros = []
+    for caminho in ARQUIVOS_BAIRROS:
+        if os.path.exists(caminho):
+            padrao = os.path.splitext(os.path.basename(caminho))[0]
+            partes_bairros.append(_camada_kml(ler_kml(caminho), lambda p: p['nome'] or padrao))
+    bairros = pd.concat(partes_bairros, ignore_index=True) if partes_bairros else _camada_kml([], None)
+    bairros = bairros[bairros.geom_type == 'Polygon']
+    quarteiroes = pd.read_csv(ARQUIVO_QUARTEIROES, header=None, encoding='latin-1', dtype=str)
+    quarteiroes = pd.DataFrame({'quarteirao': quarteiroes[0].astype(str)})
+
+    _gravar_parquet(quadras, os.path.join(destino, 'quadras.parquet'))
+    _gravar_parquet(ruas, os.path.join(destino, 'ruas.parquet'))
+    _gravar_parquet(bairros, os.path.join(destino, 'bairros.parquet'))
+    _gravar_parquet(quarteiroes, os.path.join(destino, 'quarteiroes.parquet'))
+    # O manifesto é gravado por último: uma compilação interrompida é refeita.
+    with _arquivo_temporario(os.path.join(destino, ARQUIVO_MANIFESTO)) as temporario:
+        with open(temporario, 'w', encoding='utf-8') as f:
+            json.dump(assinatura, f, indent=2)
+    return destino
+
+def garantir_base_compilada(destino=DIRETORIO_COMPILADO):
+    assinatura = _assinatura_fontes()
+    if _manifesto_atual(destino) == assinatura:
+        return destino
+    with _trava_compilacao(destino):
+        # Outra thread ou processo pode ter compilado enquanto esta esperava a trava.
+        if _manifesto_atual(destino) != assinatura:
+            _compilar_geodados(destino)
+    return destino
+
+def carregar_camada(nome, destino=DIRETORIO_COMPILADO):
+    # 'quadras', 'ruas' e 'bairros' (GeoDataFrame com colunas nome/geometry).
+    caminho = os.path.join(garantir_base_compilada(destino), f'{nome}.parquet')
+    return gpd.read_parquet(caminho, memory_map=True)
+
+def carregar_quarteiroes(destino=DIRETORIO_COMPILADO):
+    caminho = os.path.join(garantir_base_compilada(destino), 'quarteiroes.parquet')
+    return sorted(pd.read_parquet(caminho, memory_map=True)['quarteirao'].unique().tolist())
+
+def carregar_centroides_quadras(destino=DIRETORIO_COMPILADO):
+    # Marcadores ficam como estão; contornos viram o centróide.
+    quadras = carregar_camada('quadras', destino)
+    centros = shapely.centroid(np.asarray(quadras.geometry))
+    df = pd.DataFrame({
+        'quadra': quadras['nome'].astype(str),
+        'lat': shapely.get_y(centros),
+        'lon': shapely.get_x(centros),
+    })
+    return df.dropna(subset=['lat', 'lon'])
+
+
+# --- CONTORNOS DAS QUADRAS PARA O MAPA ---
+# Só 19 quadras do KML têm contorno desenhado; as demais são marcadores. Para o mapa de
+# atividades, cada marcador recebe a sua célula de Voronoi (a área mais próxima dele do
+# que de qualquer outro marcador), recortada a RAIO_CELULA_QUADRA_M e sem os contornos
+# reais, o que aproxima o quarteirão. Tudo é calculado em metros (UTM 23S) e simplificado
+# uma vez por nível de zoom, com tolerância de cerca de um pixel naquele zoom.
+CRS_METRICO = 'EPSG:31983'
+RAIO_CELULA_QUADRA_M = 60
+ZOOMS_DETALHE = (12, 14, 16)
+CASAS_DECIMAIS_MAPA = 6
+
+def _metros_por_pixel(zoom, lat):
+    return 156543.03 * math.cos(math.radians(lat)) / 2 ** zoom
+
+def construir_contornos_quadras(destino=DIRETORIO_COMPILADO):
+    quadras = carregar_camada('quadras', destino)
+    quadras = quadras[quadras['nome'].str.contains(r'\d', regex=True)].to_crs(CRS_METRICO)
+    marcadores = quadras[quadras.geom_type == 'Point']
+    contornos = quadras[quadras.geom_type == 'Polygon']
+
+    pontos = np.asarray(marcadores.geometry)
+    celulas = shapely.get_parts(shapely.voronoi_polygons(
+        shapely.multipoints(pontos), extend_to=shapely.box(*quadras.total_bounds).buffer(RAIO_CELULA_QUADRA_M * 2)
+    ))
+    # voronoi_polygons não preserva a ordem dos pontos: cada célula volta ao seu marcador.
+    posicao_ponto, posicao_celula = shapely.STRtree(celulas).query(pontos, predicate='within')
+    celula_do_ponto = np.empty(len(pontos), dtype=object)
+    celula_do_ponto[posicao_ponto] = celulas[posicao_celula]
+    estimadas = shapely.intersection(celula_do_ponto, shapely.buffer(pontos, RAIO_CELULA_QUADRA_M, quad_segs=3))
+    if len(contornos):
+        estimadas = shapely.difference(estimadas, shapely.union_all(shapely.make_valid(np.asarray(contornos.geometry))))
+
+    partes = gpd.GeoDataFrame({
+        'nome': pd.concat([marcadores['nome'], contornos['nome']], ignore_index=True),
+        'origem': ['estimado'] * len(marcadores) + ['contorno'] * len(contornos),
+        'geometry': np.concatenate([estimadas, np.asarray(contornos.geometry)]),
+    }, geometry='geometry', crs=CRS_METRICO).explode(ignore_index=True)
+    return partes[partes.geom_type == 'Polygon'].reset_index(drop=True)
+
+def _aneis_externos(geometrias):
+    coordenadas, posicoes = shapely.get_coordinates(
+        shapely.get_exterior_ring(geometrias), return_index=True
+    )
+    coordenadas = np.round(coordenadas, CASAS_DECIMAIS_MAPA)
+    cortes = np.flatnonzero(np.diff(posicoes)) + 1
+    return [bloco.tolist() for bloco in np.split(coordenadas, cortes)] if len(coordenadas) else []
+
+def contornos_quadras_por_zoom(destino=DIRETORIO_COMPILADO, zooms=ZOOMS_DETALHE):
+    # {zoom: DataFrame(quadra, origem, poligono)}, com 'poligono' como lista de [lon, lat]
+    # pronta para o PolygonLayer do pydeck.
+    contornos = construir_contornos_quadras(destino)
+    lat_media = contornos.to_crs(CRS_KML).geometry.union_all().centroid.y if len(contornos) else 0
+    niveis = {}
+    for zoom in zooms:
+        simplificados = shapely.simplify(
+            np.asarray(contornos.geometry), _metros_por_pixel(zoom, lat_media), preserve_topology=True
+        )
+        em_graus = gpd.GeoSeries(simplificados, crs=CRS_METRICO).to_crs(CRS_KML)
+        niveis[zoom] = pd.DataFrame({
+            'quadra': contornos['nome'].astype(str).to_numpy(),
+            'origem': contornos['origem'].to_numpy(),
+            'poligono': _aneis_externos(np.asarray(em_graus)),
+        })
+    return niveis
+
+def nivel_para_zoom(niveis, zoom):
+    # O nível mais detalhado cujo zoom não passa do zoom pedido (ou o mais grosseiro).
+    adequados = [z for z in niveis if z <= zoom]
+    return niveis[max(adequados) if adequados else min(niveis)]
+
+
+# --- NORMALIZAÇÃO DE ENDEREÇOS ---
+TIPOS_LOGRADOURO = {
+    'R': 'RUA', 'RUA': 'RUA', 'AV': 'AVENIDA', 'AVN': 'AVENIDA', 'AVENIDA': 'AVENIDA',
+    'TV': 'TRAVESSA', 'TRAV': 'TRAVESSA', 'TRAVESSA': 'TRAVESSA', 'AL': 'ALAMEDA', 'ALAMEDA': 'ALAMEDA',
+    'PC': 'PRACA', 'PCA': 'PRACA', 'PRACA': 'PRACA', 'EST': 'ESTRADA', 'ESTR': 'ESTRADA', 'ESTRADA': 'ESTRADA',
+    'ROD': 'RODOVIA', 'RODOVIA': 'RODOVIA', 'VL': 'VIELA', 'VIELA': 'VIELA', 'LAD': 'LADEIRA', 'LADEIRA': 'LADEIRA',
+}
+
+ABREVIACOES = {
+    'DR': 'DOUTOR', 'DRA': 'DOUTORA', 'PROF': 'PROFESSOR', 'PROFA': 'PROFESSORA', 'ENG': 'ENGENHEIRO',
+    'CEL': 'CORONEL', 'CAP': 'CAPITAO', 'GAL': 'GENERAL', 'GEN': 'GENERAL', 'TEN': 'TENENTE', 'SGT': 'SARGENTO',
+    'MAL': 'MARECHAL', 'PRES': 'PRESIDENTE', 'PE': 'PADRE', 'STO': 'SANTO', 'STA': 'SANTA', 'S': 'SAO',
+    'N': 'NOSSA', 'SRA': 'SENHORA', 'JD': 'JARDIM', 'JARD': 'JARDIM', 'PQ': 'PARQUE', 'VL': 'VILA', 'CJ': 'CONJUNTO',
+}
+
+_UNIDADES = ['ZERO', 'UM', 'DOIS', 'TRES', 'QUATRO', 'CINCO', 'SEIS', 'SETE', 'OITO', 'NOVE', 'DEZ',
+             'ONZE', 'DOZE', 'TREZE', 'QUATORZE', 'QUINZE', 'DEZESSEIS', 'DEZESSETE', 'DEZOITO', 'DEZENOVE']
+_DEZENAS = ['', '', 'VINTE', 'TRINTA', 'QUARENTA', 'CINQUENTA', 'SESSENTA', 'SETENTA', 'OITENTA', 'NOVENTA']
+
+def _numero_por_extenso(numero):
+    # Ruas.kml grafa números por extenso ("RUA VINTE E CINCO DE JANEIRO").
+    if numero < 20:
+        return _UNIDADES[numero]
+    dezena, unidade = divmod(numero, 10)
+    return _DEZENAS[dezena] + (f' E {_UNIDADES[unidade]}' if unidade else '')
+
+def _ascii_maiusculo(texto):
+    texto = unicodedata.normalize('NFKD', str(texto or '')).encode('ascii', 'ignore').decode('ascii')
+    return re.sub(r'[^A-Z0-9 ]', ' ', texto.upper())
+
+def normalizar_texto(texto):
+    palavras = []
+    for palavra in _ascii_maiusculo(texto).split():
+        if palavra.isdigit() and int(palavra) < 100:
+            palavras.append(_numero_por_extenso(int(palavra)))
+        else:
+            palavras.append(ABREVIACOES.get(palavra, palavra))
+    return ' '.join(palavras)
+
+def separar_tipo_logradouro(logradouro):
+    # "AV PRESIDENTE VARGAS" -> ("AVENIDA", "PRESIDENTE VARGAS"). O núcleo é a chave de busca,
+    # já que o tipo costuma faltar ou vir abreviado no cadastro da denúncia.
+    palavras = _ascii_maiusculo(logradouro).split()
+    tipo = ''
+    if palavras and palavras[0] in TIPOS_LOGRADOURO:
+        tipo = TIPOS_LOGRADOURO[palavras[0]]
+        palavras = palavras[1:]
+    return tipo, normalizar_texto(' '.join(palavras))
+
+
+# --- GEOMETRIA PLANA (ESCALA MUNICIPAL) ---
+def _distancia_m(a, b):
+    lat_media = math.radians((a[1] + b[1]) / 2)
+    dx = (b[0] - a[0]) * 111320 * math.cos(lat_media)
+    dy = (b[1] - a[1]) * 110540
+    return math.hypot(dx, dy)
+
+def _comprimento(coordenadas):
+    return sum(_distancia_m(a, b) for a, b in zip(coordenadas, coordenadas[1:]))
+
+
+# --- GEOCODIFICADOR OFFLINE DE RUAS ---
+RAIO_AGRUPAMENTO_M = 400
+SIMILARIDADE_MINIMA = 0.85
+
+def _coordenadas_por_geometria(geometrias):
+    # Extrai os vértices de todas as geometrias numa só chamada e reparte por linha.
+    coordenadas, posicoes = shapely.get_coordinates(np.asarray(geometrias), return_index=True)
+    cortes = np.flatnonzero(np.diff(posicoes)) + 1
+    return [list(map(tuple, bloco.tolist())) for bloco in np.split(coordenadas, cortes)] if len(coordenadas) else []
+
+def construir_indice_ruas(destino=DIRETORIO_COMPILADO):
+    ruas = defaultdict(list)
+    camada = carregar_camada('ruas', destino)
+    for nome, geometria, coordenadas in zip(camada['nome'], camada.geometry, _coordenadas_por_geometria(camada.geometry)):
+        tipo, nucleo = separar_tipo_logradouro(nome)
+        if not nucleo or nucleo == 'SEM NOME':
+            continue
+        comprimento = _comprimento(coordenadas)
+        ruas[nucleo].append({
+            'tipo': tipo,
+            'nome': f"{tipo} {nucleo}".strip(),
+            'geometria': geometria,
+            'coordenadas': coordenadas,
+            'comprimento': comprimento,
+            'meio': coordenadas[len(coordenadas) // 2],
+        })
+    return {'ruas': dict(ruas), 'nomes': sorted(ruas), 'bairros': carregar_bairros(destino)}
+
+def carregar_bairros(destino=DIRETORIO_COMPILADO):
+    bairros = {}
+    camada = carregar_camada('bairros', destino)
+    for nome, geometria in zip(camada['nome'], camada.geometry):
+        # Preparado uma vez: os testes de interseção com os trechos de rua ficam rápidos.
+        shapely.prepare(geometria)
+        bairros[normalizar_texto(nome)] = {'nome': nome, 'poligono': geometria}
+    return bairros
+
+def _encontrar_bairro(indice, bairro):
+    chave = normalizar_texto(bairro)
+    if not chave:
+        return None
+    if chave in indice['bairros']:
+        return indice['bairros'][chave]
+    parecidos = difflib.get_close_matches(chave, list(indice['bairros']), n=1, cutoff=SIMILARIDADE_MINIMA)
+    return indice['bairros'][parecidos[0]] if parecidos else None
+
+def _agrupar_trechos(trechos):
+    # Ruas homônimas ("RUA UM") existem em vários loteamentos: agrupa os trechos próximos
+    # e devolve os grupos do maior para o menor comprimento total.
+    grupos = []
+    for trecho in sorted(trechos, key=lambda t: -t['comprimento']):
+        for grupo in grupos:
+            if any(_distancia_m(trecho['meio'], outro['meio']) <= RAIO_AGRUPAMENTO_M for outro in grupo):
+                grupo.append(trecho)
+                break
+        else:
+            grupos.append([trecho])
+    return sorted(grupos, key=lambda g: -sum(t['comprimento'] for t in g))
+
+def _ponto_representativo(grupo):
+    # Vértice da rua mais próximo do centro ponderado pelo comprimento dos trechos,
+    # para que a coordenada caia sobre a via.
+    peso_total = sum(t['comprimento'] for t in grupo) or 1
+    centro = (
+        sum(t['meio'][0] * t['comprimento'] for t in grupo) / peso_total,
+        sum(t['meio'][1] * t['comprimento'] for t in grupo) / peso_total,
+    )
+    return min((c for t in grupo for c in t['coordenadas']), key=lambda c: _distancia_m(c, centro))
+
+def geocodificar_endereco(indice, logradouro, bairro=''):
+    tipo, nucleo = separar_tipo_logradouro(logradouro)
+    if not nucleo:
+        return None
+
+    precisao = 'rua'
+    trechos = indice['ruas'].get(nucleo)
+    if not trechos:
+        parecidos = difflib.get_close_matches(nucleo, indice['nomes'], n=1, cutoff=SIMILARIDADE_MINIMA)
+        if not parecidos:
+            return None
+        trechos = indice['ruas'][parecidos[0]]
+        precisao = 'rua_aproximada'
+
+    if tipo:
+        trechos = [t for t in trechos if t['tipo'] == tipo] or trechos
+
+    dados_bairro = _encontrar_bairro(indice, bairro)
+    no_bairro = []
+    if dados_bairro:
+        cruzam = shapely.intersects(np.asarray([t['geometria'] for t in trechos], dtype=object), dados_bairro['poligono'])
+        no_bairro = [t for t, cruza in zip(trechos, cruzam) if cruza]
+        if no_bairro:
+            trechos = no_bairro
+            precisao += '_bairro'
+
+    grupos = _agrupar_trechos(trechos)
+    if not no_bairro and len(grupos) > 1:
+        # Homônimas em loteamentos diferentes e nenhum bairro para desempatar: devolve o
+        # maior grupo, mas marcado como ambíguo.
+        precisao += '_ambigua'
+    grupo = grupos[0]
+    lon, lat = _ponto_representativo(grupo)
+    return {'lat': lat, 'lon': lon, 'precisao': precisao, 'logradouro_encontrado': grupo[0]['nome']}
+
+
+# --- ÍNDICE ESPACIAL DAS QUADRAS ---
+# Quase todas as quadras do KML são marcadores (Point); só algumas têm contorno. A árvore
+# STR guarda as duas formas: um ponto pertence à quadra cujo contorno o contém ou, na
+# falta dele, à quadra de marcador mais próximo dentro de RAIO_QUADRA_M.
+RAIO_QUADRA_M = 150
+METROS_POR_GRAU = 111320
+
+def construir_indice_quadras(destino=DIRETORIO_COMPILADO):
+    quadras = carregar_camada('quadras', destino)
+    # Contornos auxiliares ("Polígono sem título") não identificam quadra.
+    quadras = quadras[quadras['nome'].str.contains(r'\d', regex=True)]
+    geometrias = np.asarray(quadras.geometry, dtype=object)
+    return {
+        'nomes': np.asarray(quadras['nome'], dtype=object),
+        'geometrias': geometrias,
+        'arvore': shapely.STRtree(geometrias),
+        'bairros': carregar_bairros(destino),
+    }
+
+def _nomes_quadras(indice, posicoes):
+    nomes = set(indice['nomes'][posicoes])
+    return sorted(nomes, key=lambda n: (float(n) if n.replace('.', '', 1).isdigit() else math.inf, n))
+
+def quadra_do_ponto(indice, lon, lat, raio_m=RAIO_QUADRA_M):
+    ponto = shapely.Point(lon, lat)
+    contendo = indice['arvore'].query(ponto, predicate='within')
+    if len(contendo):
+        return indice['nomes'][contendo[0]]
+    # A distância da árvore é em graus; o raio em longitude é o maior dos dois eixos
+    # e a distância real é conferida em metros logo abaixo.
+    raio_graus = raio_m / (METROS_POR_GRAU * math.cos(math.radians(lat)))
+    proximos = indice['arvore'].query_nearest(ponto, max_distance=raio_graus)
+    if not len(proximos):
+        return None
+    posicao = proximos[0]
+    mais_proximo = shapely.get_coordinates(shapely.shortest_line(ponto, indice['geometrias'][posicao]))[-1]
+    if _distancia_m((lon, lat), tuple(mais_proximo)) > raio_m:
+        return None
+    return indice['nomes'][posicao]
+
+def quadras_no_bairro(indice, bairro):
+    dados_bairro = _encontrar_bairro(indice, bairro)
+    if not dados_bairro:
+        return []
+    return _nomes_quadras(indice, indice['arvore'].query(dados_bairro['poligono'], predicate='intersects'))
+
+def quadras_na_janela(indice, lon_min, lat_min, lon_max, lat_max):
+    janela = shapely.box(lon_min, lat_min, lon_max, lat_max)
+    return _nomes_quadras(indice, indice['arvore'].query(janela, predicate='intersects'))
+
+
+# --- RUAS POR JANELA DE VISUALIZAÇÃO ---
+# Ruas.kml inteiro é pesado demais para ir ao navegador. A malha é simplificada uma vez
+# por nível de zoom (tolerância de um pixel, descartando trechos menores que alguns
+# pixels) e cada nível ganha a sua árvore STR; o mapa pede só os trechos que cruzam a
+# área das quadras trabalhadas (com folga), já recortados nela. Abaixo de
+# ZOOM_MINIMO_RUAS nada é enviado.
+ZOOMS_RUAS = (13, 15, 17)
+ZOOM_MINIMO_RUAS = 13
+PIXELS_TRECHO_MINIMO = 3
+FOLGA_MINIMA_RUAS_M = 500
+
+def construir_niveis_ruas(destino=DIRETORIO_COMPILADO, zooms=ZOOMS_RUAS):
+    ruas = carregar_camada('ruas', destino)
+    lat_media = (ruas.total_bounds[1] + ruas.total_bounds[3]) / 2 if len(ruas) else 0
+    ruas = ruas.to_crs(CRS_METRICO)
+    niveis = {}
+    for zoom in zooms:
+        tolerancia = _metros_por_pixel(zoom, lat_media)
+        simplificadas = shapely.simplify(np.asarray(ruas.geometry), tolerancia)
+        manter = shapely.length(simplificadas) >= tolerancia * PIXELS_TRECHO_MINIMO
+        geometrias = np.asarray(gpd.GeoSeries(simplificadas[manter], crs=CRS_METRICO).to_crs(CRS_KML))
+        niveis[zoom] = {
+            'nomes': ruas['nome'].astype(str).to_numpy()[manter],
+            'geometrias': geometrias,
+            'arvore': shapely.STRtree(geometrias),
+        }
+    return niveis
+
+def janela_dos_poligonos(poligonos, margem=0.5, folga_minima_m=FOLGA_MINIMA_RUAS_M):
+    # Caixa (lon_min, lat_min, lon_max, lat_max) que cobre os polígonos (listas de
+    # [lon, lat]), alargada em 'margem' do tamanho de cada lado e em pelo menos
+    # folga_minima_m: o mapa abre enquadrando essas quadras, e a folga cobre o que fica
+    # visível em volta delas qualquer que seja a largura do gráfico e pequenos arrastes.
+    coordenadas = np.asarray([v for poligono in poligonos for v in poligono], dtype=float)
+    lon_min, lat_min = coordenadas.min(axis=0)
+    lon_max, lat_max = coordenadas.max(axis=0)
+    lat = (lat_min + lat_max) / 2
+    folga_lat = folga_minima_m / METROS_POR_GRAU
+    folga_lon = folga_lat / math.cos(math.radians(lat))
+    folga_lon = max(folga_lon, (lon_max - lon_min) * margem)
+    folga_lat = max(folga_lat, (lat_max - lat_min) * margem)
+    return lon_min - folga_lon, lat_min - folga_lat, lon_max + folga_lon, lat_max + folga_lat
+
+def ruas_na_janela(niveis, lon_min, lat_min, lon_max, lat_max, zoom):
+    # DataFrame(rua, caminho), com 'caminho' como lista de [lon, lat] para o PathLayer.
+    if zoom < ZOOM_MINIMO_RUAS or not niveis:
+        return pd.DataFrame(columns=['rua', 'caminho'])
+    nivel = nivel_para_zoom(niveis, zoom)
+    janela = shapely.box(lon_min, lat_min, lon_max, lat_max)
+    posicoes = nivel['arvore'].query(janela, predicate='intersects')
+    recortes = shapely.intersection(nivel['geometrias'][posicoes], janela)
+    partes, origem = shapely.get_parts(recortes, return_index=True)
+    linhas = shapely.get_type_id(partes) == shapely.GeometryType.LINESTRING
+    partes, origem = partes[linhas], origem[linhas]
+    coordenadas, posicoes_partes = shapely.get_coordinates(partes, return_index=True)
+    coordenadas = np.round(coordenadas, CASAS_DECIMAIS_MAPA)
+    cortes = np.flatnonzero(np.diff(posicoes_partes)) + 1
+    return pd.DataFrame({
+        'rua': nivel['nomes'][posicoes][origem],
+        'caminho': [bloco.tolist() for bloco in np.split(coordenadas, cortes)] if len(coordenadas) else [],
+    })
+
+
+if __name__ == '__main__':
+    print(f"Base geográfica compilada em {compilar_geodados()}")
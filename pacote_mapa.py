@@ -0,0 +1,108 @@
+import os
+import re
+import glob
+import json
+import hashlib
+
+import numpy as np
+import shapely
+
+import geodados
+
+# --- PACOTE DE DADOS DO MAPA.HTML ---
+# O mapa.html (publicado junto do repositório e aberto num iframe na tela de login) lia
+# os KMLs dos bairros um a um e os interpretava no navegador. Este passo de build junta
+# bairros e quadras, já lidos da base compilada (geodados.py), num único TopoJSON
+# quantizado e compacto, com o hash do conteúdo no nome do arquivo: a página faz uma só
+# requisição, que pode ficar em cache para sempre, e não interpreta XML.
+# Rodar "python pacote_mapa.py" sempre que algum KML mudar.
+DIRETORIO_PACOTE = os.path.join(geodados.DIRETORIO_BASE, 'mapa_dados')
+ARQUIVO_PAGINA = os.path.join(geodados.DIRETORIO_BASE, 'mapa.html')
+PREFIXO_PACOTE = 'mapa'
+# 10^5 posições por eixo: na extensão do município, um passo de cerca de 30 cm.
+QUANTIZACAO = 100000
+_REFERENCIA_PACOTE = re.compile(r"(var PACOTE_MAPA = ')[^']*(';)")
+
+
+def _transformacao(limites):
+    x0, y0, x1, y1 = limites
+    return {
+        'scale': [(x1 - x0) / (QUANTIZACAO - 1) or 1, (y1 - y0) / (QUANTIZACAO - 1) or 1],
+        'translate': [x0, y0],
+    }
+
+def _quantizar(coordenadas, transformacao):
+    escala, origem = np.asarray(transformacao['scale']), np.asarray(transformacao['translate'])
+    return np.round((np.asarray(coordenadas) - origem) / escala).astype(np.int64)
+
+def _arco(anel, transformacao):
+    # Vértices que caem no mesmo ponto da grade são descartados; o arco guarda o
+    # primeiro ponto e, depois, só os deslocamentos (delta) entre vizinhos.
+    pontos = _quantizar(anel, transformacao)
+    pontos = pontos[np.r_[True, np.any(np.diff(pontos, axis=0) != 0, axis=1)]]
+    if len(pontos) < 4:
+        return None
+    return np.vstack([pontos[:1], np.diff(pontos, axis=0)]).tolist()
+
+def _geometria_topo(geometria, propriedades, arcos, transformacao):
+    if geometria.geom_type == 'Point':
+        x, y = _quantizar([[geometria.x, geometria.y]], transformacao)[0].tolist()
+        return {'type': 'Point', 'coordinates': [x, y], 'properties': propriedades}
+    arco = _arco(shapely.get_coordinates(geometria.exterior), transformacao)
+    if arco is None:
+        return None
+    arcos.append(arco)
+    return {'type': 'Polygon', 'arcs': [[len(arcos) - 1]], 'properties': propriedades}
+
+def montar_topologia(destino=geodados.DIRETORIO_COMPILADO):
+    bairros = geodados.carregar_camada('bairros', destino)
+    quadras = geodados.carregar_camada('quadras', destino)
+    quadras = quadras[quadras['nome'].str.contains(r'\d', regex=True)]
+
+    limites = np.asarray(shapely.total_bounds(np.concatenate([bairros.geometry, quadras.geometry])))
+    transformacao = _transformacao(limites.tolist())
+    arcos, objetos = [], {}
+    for nome_objeto, camada in (('bairros', bairros), ('quadras', quadras)):
+        geometrias = (
+            _geometria_topo(geometria, {'nome': nome}, arcos, transformacao)
+            for nome, geometria in zip(camada['nome'], camada.geometry)
+        )
+        objetos[nome_objeto] = {'type': 'GeometryCollection', 'geometries': [g for g in geometrias if g]}
+    return {
+        'type': 'Topology',
+        'bbox': limites.round(6).tolist(),
+        'transform': transformacao,
+        'objects': objetos,
+        'arcs': arcos,
+    }
+
+def gerar_pacote(diretorio=DIRETORIO_PACOTE, pagina=ARQUIVO_PAGINA):
+    conteudo = json.dumps(montar_topologia(), ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    nome = f"{PREFIXO_PACOTE}.{hashlib.sha256(conteudo).hexdigest()[:12]}.topo.json"
+    os.makedirs(diretorio, exist_ok=True)
+    caminho = os.path.join(diretorio, nome)
+    if not os.path.exists(caminho):
+        temporario = f'{caminho}.tmp'
+        with open(temporario, 'wb') as f:
+            f.write(conteudo)
+        os.replace(temporario, caminho)
+
+    # A página passa a apontar para o pacote novo; só então os antigos são apagados.
+    with open(pagina, encoding='utf-8') as f:
+        html = f.read()
+    referencia = f"{os.path.basename(diretorio)}/{nome}"
+    html_novo, trocas = _REFERENCIA_PACOTE.subn(lambda m: f"{m.group(1)}{referencia}{m.group(2)}", html)
+    if not trocas:
+        raise ValueError(f"Referência 'var PACOTE_MAPA' não encontrada em {pagina}.")
+    if html_novo != html:
+        with open(pagina, 'w', encoding='utf-8') as f:
+            f.write(html_novo)
+    for antigo in glob.glob(os.path.join(diretorio, f'{PREFIXO_PACOTE}.*.topo.json')):
+        if os.path.basename(antigo) != nome:
+            os.remove(antigo)
+    return caminho
+
+
+if __name__ == '__main__':
+    caminho = gerar_pacote()
+    print(f"Pacote do mapa gerado em {caminho} ({os.path.getsize(caminho) / 1024:.0f} KB)")
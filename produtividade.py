@@ -0,0 +1,55 @@
+import pandas as pd
+
+# --- PRODUTIVIDADE DOS BOLETINS DIÁRIOS ---
+# Os boletins são achatados uma vez numa tabela de visitas em formato longo: uma linha
+# por (data, turno, equipe, dimensão, valor), com dimensão 'membro', 'atividade' ou
+# 'quarteirao'. Dela sai a contagem por dia; um período qualquer é a soma dos dias do
+# intervalo, sem voltar ao JSON aninhado.
+TURNOS = {'equipes_manha': 'Manhã', 'equipes_tarde': 'Tarde'}
+DIMENSOES = {'membro': 'membros', 'atividade': 'atividades', 'quarteirao': 'quarteiroes'}
+_COLUNAS_VISITAS = ['data', 'turno', 'equipe', 'dimensao', 'valor']
+
+
+def _lista(valor):
+    return valor if isinstance(valor, list) else []
+
+def tabela_visitas(df_boletins):
+    if df_boletins.empty or 'data' not in df_boletins.columns:
+        return pd.DataFrame(columns=_COLUNAS_VISITAS)
+    equipes = (
+        df_boletins.reindex(columns=['data', *TURNOS])
+        .assign(data=lambda df: pd.to_datetime(df['data'], errors='coerce').dt.normalize())
+        .dropna(subset=['data'])
+        .melt(id_vars='data', var_name='turno', value_name='equipes')
+    )
+    equipes['equipes'] = equipes['equipes'].map(_lista)
+    equipes = equipes.explode('equipes')
+    equipes['equipe'] = equipes.groupby(level=0).cumcount() + 1
+    equipes = equipes[equipes['equipes'].map(lambda e: isinstance(e, dict))].reset_index(drop=True)
+    equipes['turno'] = equipes['turno'].map(TURNOS)
+
+    partes = []
+    for dimensao, campo in DIMENSOES.items():
+        parte = equipes[['data', 'turno', 'equipe']].assign(
+            dimensao=dimensao, valor=equipes['equipes'].map(lambda e: _lista(e.get(campo))))
+        partes.append(parte.explode('valor'))
+    visitas = pd.concat(partes, ignore_index=True).dropna(subset=['valor'])
+    visitas['valor'] = visitas['valor'].astype(str)
+    return visitas[_COLUNAS_VISITAS]
+
+def rollup_diario(visitas):
+    # Série indexada por (data, dimensao, valor), ordenada pela data.
+    if visitas.empty:
+        return pd.Series(dtype='int64', index=pd.MultiIndex.from_tuples([], names=['data', 'dimensao', 'valor']))
+    return visitas.groupby(['data', 'dimensao', 'valor']).size().sort_index()
+
+def somar_periodo(rollup, inicio, fim, dimensao):
+    if rollup.empty:
+        return pd.Series(dtype='int64')
+    # O índice está ordenado pela data: o intervalo é uma fatia achada por busca binária.
+    datas = rollup.index.get_level_values('data')
+    no_periodo = rollup.iloc[datas.searchsorted(pd.Timestamp(inicio), 'left'):datas.searchsorted(pd.Timestamp(fim), 'right')]
+    no_periodo = no_periodo[no_periodo.index.get_level_values('dimensao') == dimensao]
+    if no_periodo.empty:
+        return pd.Series(dtype='int64')
+    return no_periodo.groupby(level='valor').sum().sort_values(ascending=False)
@@ -0,0 +1,273 @@
+import io
+import os
+import re
+import json
+import hashlib
+import inspect
+import zipfile
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from functools import lru_cache
+from xml.sax.saxutils import escape
+
+import pandas as pd
+import reportlab
+from reportlab.pdfgen.canvas import Canvas
+from reportlab.platypus import Frame
+
+# --- RELATÓRIOS EM WORD ---
+# Fica fora de app.py para que os processos da exportação em lote importem só o que
+# precisam para montar o .docx, sem reexecutar a página do Streamlit.
+#
+# Cada formulário é um modelo .docx em modelos/, editável no Word. O texto pode ter
+# campos {{nome}}, trocados pelo valor do contexto, e seções marcadas por parágrafos
+# que contêm só {{#lista}} ... {{/lista}} (repetidas para cada item da lista, cujos
+# campos ficam disponíveis dentro dela) ou {{^lista}} ... {{/lista}} (mostradas quando
+# a lista está vazia). O modelo é lido e compilado uma vez por processo (e de novo se o
+# arquivo mudar); a geração só substitui texto no XML e regrava o pacote.
+DIRETORIO_MODELOS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'modelos')
+RELATORIOS_POR_TAREFA = 25
+MIME_DOCX = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+CACHE_RELATORIOS_MAX_BYTES = 64 * 1024 * 1024
+MESES_PT = ("Janeiro", "Fevereiro", "Março", "Abril", "Maio", "Junho", "Julho", "Agosto", "Setembro", "Outubro", "Novembro", "Dezembro")
+
+_PARTE_COM_CAMPOS = re.compile(r'word/(document|header\d*|footer\d*)\.xml$')
+_CAMPO = re.compile(r'\{\{\s*([#^/]?)\s*(\w+)\s*\}\}')
+# Campo que o Word dividiu em várias execuções de texto: "{{no</w:t></w:r><w:r><w:t>me}}".
+_CAMPO_DIVIDIDO = re.compile(r'\{(?:<[^>]+>)*\{(?:[^{}<]|<[^>]+>)*?\}(?:<[^>]+>)*\}')
+_PARAGRAFO_SECAO = re.compile(r'<w:p[ >](?:(?!</w:p>).)*?\{\{\s*([#^/])\s*(\w+)\s*\}\}(?:(?!</w:p>).)*</w:p>', re.S)
+_QUEBRA_LINHA = '</w:t><w:br/><w:t xml:space="preserve">'
+
+
+def formatar_data_extenso(dt):
+    return f"{dt.day} de {MESES_PT[dt.month - 1]} de {dt.year}"
+
+def formatar_data_br(texto):
+    return datetime.strptime(texto, '%Y-%m-%d').strftime('%d/%m/%Y')
+
+def _compilar_texto(xml):
+    # Alterna trechos literais e nomes de campos: [literal, campo, literal, ...].
+    partes = _CAMPO.split(xml)
+    return ('texto', [parte for i, parte in enumerate(partes) if i % 3 != 1])
+
+def _compilar_parte(xml):
+    xml = _CAMPO_DIVIDIDO.sub(lambda m: re.sub(r'<[^>]+>', '', m.group(0)), xml)
+    xml = xml.replace('<w:t>', '<w:t xml:space="preserve">')
+    raiz = []
+    pilha = [(None, raiz)]
+    posicao = 0
+    for marcador in _PARAGRAFO_SECAO.finditer(xml):
+        pilha[-1][1].append(_compilar_texto(xml[posicao:marcador.start()]))
+        posicao = marcador.end()
+        tipo, nome = marcador.groups()
+        if tipo == '/':
+            if pilha[-1][0] != nome:
+                raise ValueError(f"Seção '{{{{/{nome}}}}}' fechada sem abrir no modelo.")
+            pilha.pop()
+        else:
+            filhos = []
+            pilha[-1][1].append(('secao', tipo, nome, filhos))
+            pilha.append((nome, filhos))
+    if len(pilha) > 1:
+        raise ValueError(f"Seção '{pilha[-1][0]}' não foi fechada no modelo.")
+    raiz.append(_compilar_texto(xml[posicao:]))
+    return raiz
+
+@lru_cache(maxsize=16)
+def _modelo_compilado(caminho, modificado_em):
+    # As entradas sem campos (estilos, tema, fontes) são compactadas uma única vez num
+    # pacote base; cada geração só acrescenta as partes preenchidas.
+    with open(caminho, 'rb') as arquivo:
+        versao = hashlib.sha256(arquivo.read()).hexdigest()[:16]
+    base = io.BytesIO()
+    partes = []
+    with zipfile.ZipFile(caminho) as pacote, zipfile.ZipFile(base, 'w', compression=zipfile.ZIP_DEFLATED) as saida:
+        for info in pacote.infolist():
+            conteudo = pacote.read(info.filename)
+            if _PARTE_COM_CAMPOS.match(info.filename):
+                partes.append((info.filename, _compilar_parte(conteudo.decode('utf-8'))))
+            else:
+                saida.writestr(info.filename, conteudo)
+    return {'base': base.getvalue(), 'partes': partes, 'versao': versao}
+
+def carregar_modelo(nome):
+    caminho = os.path.join(DIRETORIO_MODELOS, f'{nome}.docx')
+    return _modelo_compilado(caminho, os.path.getmtime(caminho))
+
+def versao_modelo(nome):
+    return carregar_modelo(nome)['versao']
+
+def _valor_xml(valor):
+    if valor is None:
+        return ''
+    if isinstance(valor, (list, tuple)):
+        valor = ', '.join(str(v) for v in valor)
+    return escape(str(valor)).replace('\n', _QUEBRA_LINHA)
+
+def _renderizar_segmentos(segmentos, contexto, saida):
+    for segmento in segmentos:
+        if segmento[0] == 'texto':
+            for i, parte in enumerate(segmento[1]):
+                saida.append(_valor_xml(contexto.get(parte)) if i % 2 else parte)
+            continue
+        _, tipo, nome, filhos = segmento
+        valor = contexto.get(nome)
+        if tipo == '^':
+            if not valor:
+                _renderizar_segmentos(filhos, contexto, saida)
+        elif isinstance(valor, (list, tuple)):
+            for item in valor:
+                _renderizar_segmentos(filhos, {**contexto, **item} if isinstance(item, dict) else contexto, saida)
+        elif valor:
+            _renderizar_segmentos(filhos, contexto, saida)
+
+def renderizar_modelo(nome, contexto):
+    modelo = carregar_modelo(nome)
+    buffer = io.BytesIO(modelo['base'])
+    with zipfile.ZipFile(buffer, 'a', compression=zipfile.ZIP_DEFLATED) as pacote:
+        for nome_parte, segmentos in modelo['partes']:
+            saida = []
+            _renderizar_segmentos(segmentos, contexto, saida)
+            pacote.writestr(nome_parte, ''.join(saida).encode('utf-8'))
+    return buffer.getvalue()
+
+def create_word_report(data):
+    try: data_formatada = formatar_data_br(data.get('data_denuncia', ''))
+    except (ValueError, TypeError): data_formatada = "Data não informada"
+    return renderizar_modelo('inspecao', {
+        'data': data_formatada,
+        'responsavel_atendimento': str(data.get('responsavel_atendimento', '')),
+        'endereco': f"{data.get('logradouro', '')}, {data.get('numero', '')} - {data.get('bairro', '')}",
+        'detalhes_denuncia': str(data.get('detalhes_denuncia', '')),
+        'relatorio_atendimento': str(data.get('relatorio_atendimento', '')),
+        'conclusao_atendimento': str(data.get('conclusao_atendimento', '')),
+    })
+
+# --- CACHE DE RELATÓRIOS GERADOS ---
+# Os bytes de cada documento ficam num LRU endereçado pelo conteúdo: a chave é o hash
+# das entradas, do código-fonte do módulo do gerador e deste módulo (onde ficam os
+# auxiliares que ele chama, como formatar_nome e formatar_data_extenso), da versão do
+# ReportLab e do modelo .docx. Tudo o que o documento usa precisa entrar como entrada:
+# nada de date.today() dentro do gerador. VERSAO_RELATORIOS é aumentada à mão quando a
+# saída muda por outro motivo. O limite é em bytes; os menos usados saem primeiro.
+VERSAO_RELATORIOS = 2
+
+def novo_cache_relatorios(limite_bytes=CACHE_RELATORIOS_MAX_BYTES):
+    return {'lock': threading.Lock(), 'itens': OrderedDict(), 'bytes': 0, 'limite': limite_bytes}
+
+@lru_cache(maxsize=16)
+def _hash_fonte(caminho, modificado_em):
+    with open(caminho, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def versao_funcao(funcao):
+    arquivos = {os.path.abspath(__file__)}
+    modulo = inspect.getmodule(funcao)
+    if getattr(modulo, '__file__', None):
+        arquivos.add(os.path.abspath(modulo.__file__))
+    partes = [f'{VERSAO_RELATORIOS}', reportlab.Version]
+    partes += [_hash_fonte(caminho, os.path.getmtime(caminho)) for caminho in sorted(arquivos)]
+    return hashlib.sha256(':'.join(partes).encode('utf-8')).hexdigest()[:16]
+
+def _digerir(hash_chave, valor):
+    if isinstance(valor, pd.DataFrame):
+        hash_chave.update(json.dumps([str(c) for c in valor.columns]).encode('utf-8'))
+        hash_chave.update(pd.util.hash_pandas_object(valor.astype(str), index=True).values.tobytes())
+        return
+    if isinstance(valor, pd.Series):
+        valor = valor.to_dict()
+    hash_chave.update(json.dumps(valor, sort_keys=True, default=str, ensure_ascii=False).encode('utf-8'))
+
+def chave_relatorio(tipo, versao, *entradas):
+    hash_chave = hashlib.sha256(f'{tipo}:{versao}'.encode('utf-8'))
+    for entrada in entradas:
+        _digerir(hash_chave, entrada)
+    return hash_chave.hexdigest()
+
+def obter_relatorio(cache, chave, gerar):
+    with cache['lock']:
+        if chave in cache['itens']:
+            cache['itens'].move_to_end(chave)
+            return cache['itens'][chave]
+    conteudo = gerar()
+    with cache['lock']:
+        if chave not in cache['itens']:
+            cache['itens'][chave] = conteudo
+            cache['bytes'] += len(conteudo)
+        while cache['bytes'] > cache['limite'] and len(cache['itens']) > 1:
+            _, removido = cache['itens'].popitem(last=False)
+            cache['bytes'] -= len(removido)
+    return conteudo
+
+# --- PDF EM BLOCOS ---
+def escrever_pdf_em_blocos(destino, blocos, pagesize, margens):
+    """Diagrama `blocos` (um iterável de listas de flowables) direto num canvas do
+    reportlab, página a página, e grava o PDF em `destino` (arquivo ou buffer).
+
+    Usa só a API pública (Canvas, Frame.add/Frame.split): cada página é fechada com
+    showPage() assim que o quadro enche, e só o bloco corrente fica em memória, em vez
+    da história inteira que doc.build() exigiria. `margens` é (esquerda, inferior,
+    direita, superior), como no SimpleDocTemplate.
+    """
+    esquerda, inferior, direita, superior = margens
+    largura, altura = pagesize
+    canv = Canvas(destino, pagesize=pagesize, pageCompression=1)
+
+    def novo_quadro():
+        return Frame(esquerda, inferior, largura - esquerda - direita, altura - inferior - superior)
+
+    quadro, vazio = novo_quadro(), True
+    for bloco in blocos:
+        pendentes = list(bloco)
+        while pendentes:
+            flowable = pendentes.pop(0)
+            if quadro.add(flowable, canv):
+                vazio = False
+                continue
+            # Não coube: divide no espaço que resta (tabelas repetem o cabeçalho).
+            partes = quadro.split(flowable, canv)
+            if partes and quadro.add(partes[0], canv):
+                pendentes[:0] = partes[1:]
+            elif vazio:
+                raise ValueError("Elemento maior que a página do PDF.")
+            else:
+                pendentes.insert(0, flowable)
+            canv.showPage()
+            quadro, vazio = novo_quadro(), True
+    if not vazio:
+        canv.showPage()
+    canv.save()
+
+def nome_relatorio_inspecao(protocolo):
+    return f"Relatorio_Inspecao_{protocolo}.docx"
+
+def _renderizar_lote(registros):
+    # Executado nos processos filhos: recebe dicionários simples e devolve (nome, bytes).
+    return [(nome_relatorio_inspecao(r.get('protocolo', '')), create_word_report(r)) for r in registros]
+
+def exportar_relatorios_zip(registros, destino, progresso=None, processos=None):
+    """Gera o relatório de cada denúncia em processos paralelos e grava todos num ZIP.
+
+    `registros` é uma lista de dicionários (um por denúncia); `destino` é um arquivo
+    aberto em modo binário. Os lotes são escritos no ZIP à medida que ficam prontos, e
+    `progresso(feitos, total)` é chamado a cada lote. Devolve a quantidade gravada.
+    """
+    total = len(registros)
+    lotes = [registros[i:i + RELATORIOS_POR_TAREFA] for i in range(0, total, RELATORIOS_POR_TAREFA)]
+    processos = processos or min(os.cpu_count() or 1, max(len(lotes), 1))
+    feitos = 0
+    # Os .docx já são compactados; ZIP_STORED evita comprimir de novo.
+    with zipfile.ZipFile(destino, 'w', compression=zipfile.ZIP_STORED) as arquivo_zip:
+        # 'spawn': o servidor do Streamlit tem várias threads, e um fork copiaria locks
+        # presos por elas. Os filhos importam só este módulo.
+        with ProcessPoolExecutor(max_workers=processos, mp_context=multiprocessing.get_context('spawn')) as executor:
+            for lote in executor.map(_renderizar_lote, lotes):
+                for nome, conteudo in lote:
+                    arquivo_zip.writestr(nome, conteudo)
+                feitos += len(lote)
+                if progresso:
+                    progresso(feitos, total)
+    return feitos
@@ -0,0 +1,133 @@
+import bisect
+import re
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+# --- ÍNDICE DE VISITAS P.E / I.E ---
+# Os boletins P.E/I.E guardam em 'imoveis_ids' as chaves dos cadastros visitados
+# ('pe_ie_cadastros'); 'imoveis_trabalhados' continua com os rótulos, só para exibição.
+# O índice leva cada cadastro às datas (ordenadas) em que foi visitado, então "visitado
+# no período" e "última visita" são um acesso ao dicionário mais um bisect.
+# Boletins antigos, sem 'imoveis_ids', são resolvidos pelo rótulo exato ou pelo par
+# (tipo, número de cadastro) que o rótulo carrega, nunca por busca de substring.
+_ROTULO = re.compile(r'^(P\.E|I\.E) - .*\(No (.*)\)$')
+
+
+def rotulo_cadastro(cadastro):
+    return f"{cadastro.get('tipo', '')} - {cadastro.get('nome_fantasia', '')} (No {cadastro.get('numero_cadastro', '')})"
+
+def _chave_tipo_numero(tipo, numero):
+    return (str(tipo).strip(), str(numero).strip())
+
+def construir_resolvedor(df_cadastros):
+    por_rotulo, por_numero = {}, {}
+    if df_cadastros is None or df_cadastros.empty:
+        return {'por_rotulo': por_rotulo, 'por_numero': por_numero}
+    for chave, cadastro in df_cadastros.to_dict('index').items():
+        por_rotulo[rotulo_cadastro(cadastro)] = str(chave)
+        por_numero[_chave_tipo_numero(cadastro.get('tipo', ''), cadastro.get('numero_cadastro', ''))] = str(chave)
+    return {'por_rotulo': por_rotulo, 'por_numero': por_numero}
+
+def resolver_rotulos(resolvedor, rotulos):
+    ids = []
+    for rotulo in rotulos or []:
+        chave = resolvedor['por_rotulo'].get(rotulo)
+        if chave is None:
+            partes = _ROTULO.match(str(rotulo))
+            if partes:
+                chave = resolvedor['por_numero'].get(_chave_tipo_numero(*partes.groups()))
+        if chave is not None and chave not in ids:
+            ids.append(chave)
+    return ids
+
+def ids_do_boletim(boletim, resolvedor):
+    ids = boletim.get('imoveis_ids')
+    if isinstance(ids, list):
+        return [str(i) for i in ids]
+    return resolver_rotulos(resolvedor, boletim.get('imoveis_trabalhados') if isinstance(boletim.get('imoveis_trabalhados'), list) else [])
+
+def construir_indice_visitas(df_cadastros, df_boletins):
+    resolvedor = construir_resolvedor(df_cadastros)
+    visitas = defaultdict(set)
+    if df_boletins is not None and not df_boletins.empty and 'data' in df_boletins.columns:
+        datas = pd.to_datetime(df_boletins['data'], errors='coerce').dt.date
+        for boletim, dia in zip(df_boletins.to_dict('records'), datas):
+            if pd.isna(dia):
+                continue
+            for chave in ids_do_boletim(boletim, resolvedor):
+                visitas[chave].add(dia)
+    return {
+        'visitas': {chave: sorted(dias) for chave, dias in visitas.items()},
+        'resolvedor': resolvedor,
+    }
+
+def visitado_no_periodo(indice, cadastro_id, inicio, fim):
+    dias = indice['visitas'].get(str(cadastro_id))
+    if not dias:
+        return False
+    posicao = bisect.bisect_left(dias, inicio)
+    return posicao < len(dias) and dias[posicao] <= fim
+
+def ultima_visita(indice, cadastro_id, ate=None):
+    dias = indice['visitas'].get(str(cadastro_id))
+    if not dias:
+        return None
+    if ate is None:
+        return dias[-1]
+    posicao = bisect.bisect_right(dias, ate)
+    return dias[posicao - 1] if posicao else None
+
+def situacao_no_periodo(indice, cadastro_ids, inicio, fim):
+    realizados, pendentes = [], []
+    for cadastro_id in cadastro_ids:
+        (realizados if visitado_no_periodo(indice, cadastro_id, inicio, fim) else pendentes).append(cadastro_id)
+    return realizados, pendentes
+
+# --- RESUMO MATERIALIZADO POR PERÍODO ---
+# 'resumo_pe_ie/{periodo}' guarda, para cada quinzena ('2025-03-Q1') e trimestre
+# ('2025-T1'), quantos boletins houve, quantos com criadouro e com tratamento, e quantas
+# vezes cada cadastro foi visitado. Cada gravação, edição ou exclusão de boletim soma ou
+# subtrai a sua contribuição na mesma escrita multi-caminho, então o controle lê só o nó
+# do período corrente.
+def chave_quinzena(dia):
+    return f"{dia.year}-{dia.month:02d}-Q{1 if dia.day <= 15 else 2}"
+
+def chave_trimestre(dia):
+    return f"{dia.year}-T{(dia.month - 1) // 3 + 1}"
+
+def periodos_do_dia(dia):
+    return [chave_quinzena(dia), chave_trimestre(dia)]
+
+def marcado(valor):
+    return isinstance(valor, (bool, np.bool_)) and bool(valor)
+
+def contribuicao_boletim(boletim, ids):
+    dia = pd.to_datetime(boletim.get('data'), errors='coerce')
+    if pd.isna(dia):
+        return {}
+    contribuicao = {
+        'boletins': 1,
+        'positivos': int(marcado(boletim.get('criadouro_encontrado'))),
+        'tratamentos': int(marcado(boletim.get('tratamento_realizado'))),
+        'visitados': {str(chave): 1 for chave in ids},
+    }
+    return {periodo: contribuicao for periodo in periodos_do_dia(dia.date())}
+
+def resumir_boletins(boletins, resolvedor):
+    resumo = {}
+    for boletim in boletins:
+        if not isinstance(boletim, dict):
+            continue
+        for periodo, contribuicao in contribuicao_boletim(boletim, ids_do_boletim(boletim, resolvedor)).items():
+            atual = resumo.setdefault(periodo, {'boletins': 0, 'positivos': 0, 'tratamentos': 0, 'visitados': {}})
+            for campo in ('boletins', 'positivos', 'tratamentos'):
+                atual[campo] += contribuicao[campo]
+            for chave in contribuicao['visitados']:
+                atual['visitados'][chave] = atual['visitados'].get(chave, 0) + 1
+    return resumo
+
+def visitados_no_resumo(resumo):
+    visitados = (resumo or {}).get('visitados') or {}
+    return {chave for chave, vezes in visitados.items() if isinstance(vezes, (int, float)) and vezes > 0}